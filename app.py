@@ -1,31 +1,118 @@
 import logging
 import os
+import threading
+import time
 import gradio as gr
-from langchain.chat_models import ChatOpenAI
+from typing import Iterator, Optional, Tuple
 
+from metaanalyser.api_keys import create_chat_model, resolve_openai_api_key, use_shared_openai_session
+from metaanalyser.cancellation import CancellationToken, RunCancelled
 from metaanalyser.chains import SRChain
+from metaanalyser.paper.vectorstore import get_text_splitter
 
 
 logger = logging.getLogger(__name__)
 logging.basicConfig()
 logging.getLogger("metaanalyser").setLevel(level=logging.DEBUG)
 
+# 同時にレビューを生成するワーカー数と、待ち行列に積めるリクエスト数
+CONCURRENCY_COUNT = int(os.environ.get("METAANALYSER_CONCURRENCY_COUNT", "2"))
+MAX_QUEUE_SIZE = int(os.environ.get("METAANALYSER_MAX_QUEUE_SIZE", "20"))
 
-def run(query: str, chain: SRChain):
-    if "OPENAI_API_KEY" not in os.environ or "SERPAPI_API_KEY" not in os.environ:
+# 生成中の出力を更新する間隔、この間隔でタブが閉じられたかどうかも分かる
+POLL_INTERVAL = 1.0
+
+WAITING_MESSAGE = "It will take a few minutes to output the results..."
+
+nb_cancelled_runs = 0
+nb_cancelled_runs_lock = threading.Lock()
+
+
+def get_chain(openai_api_key: Optional[str], serpapi_api_key: Optional[str]) -> SRChain:
+    """セッションの API キーでレビューを書く chain を作る
+
+    キーは他のセッションと共有しないように、環境変数ではなく各クライアントに渡す。None なら環境変数のキーを
+    使うが、その場合もキーをリクエスト毎に渡すので、他のセッションが設定した openai.api_key では送られない。
+    chain はリクエスト毎に作るが、作るのはキーを持つ軽いオブジェクトのみで、OpenAI への HTTP の接続は
+    use_shared_openai_session で全てのリクエストとスレッドの間で使い回す。
+    """
+    openai_api_key = resolve_openai_api_key(openai_api_key)
+    llm = create_chat_model(openai_api_key, temperature=0)
+    return SRChain(
+        llm=llm,
+        openai_api_key=openai_api_key,
+        serpapi_api_key=serpapi_api_key,
+        verbose=True,
+    )
+
+
+def run(
+        query: str,
+        openai_api_key: Optional[str],
+        serpapi_api_key: Optional[str],
+        previous_token: Optional[CancellationToken],
+) -> Iterator[Tuple[str, Optional[CancellationToken]]]:
+    """レビューを別スレッドで生成し、終わるまで経過時間を出力し続ける
+
+    同じセッションで新たに Send が押された場合は前回の生成を、タブが閉じられた場合 (ジェネレータが閉じられる)
+    は今回の生成を取り消すので、残りの論文の取得やセクションの執筆に API の料金を払い続けることはない。
+    API キーはセッション毎に入力されたものを使い、入力されていなければ環境変数のキーを使う。
+    """
+    if previous_token is not None:
+        previous_token.cancel("a new request is sent")
+
+    openai_api_key = openai_api_key or None
+    serpapi_api_key = serpapi_api_key or None
+
+    if (
+            (openai_api_key is None and "OPENAI_API_KEY" not in os.environ)
+            or (serpapi_api_key is None and "SERPAPI_API_KEY" not in os.environ)
+    ):
         raise gr.Error(f"Please paste your OpenAI (https://platform.openai.com/) key and SerpAPI (https://serpapi.com/) key to use.")
 
-    llm = ChatOpenAI(temperature=0)
-    chain = SRChain(llm=llm, verbose=True)
-    return chain.run({"query": query})
+    chain = get_chain(openai_api_key, serpapi_api_key)
+    token = CancellationToken()
+    result = {}
+
+    def target():
+        try:
+            result["text"] = chain.run({"query": query, "cancellation_token": token})
+        except Exception as e:
+            result["error"] = e
 
+    thread = threading.Thread(target=target, daemon=True)
+    start = time.perf_counter()
+    thread.start()
 
-def set_openai_api_key(api_key: str):
-    os.environ["OPENAI_API_KEY"] = api_key
+    try:
+        while thread.is_alive():
+            yield f"{WAITING_MESSAGE} ({time.perf_counter() - start:.0f}s)", token
+            thread.join(POLL_INTERVAL)
+    finally:
+        if thread.is_alive():
+            token.cancel("the request is closed")
+            record_cancelled_run(query, token)
 
+    if isinstance(result.get("error"), RunCancelled):
+        record_cancelled_run(query, token)
+        yield f"Cancelled: {token.reason}", None
+        return
 
-def set_serpapi_api_key(api_key: str):
-    os.environ["SERPAPI_API_KEY"] = api_key
+    if "error" in result:
+        raise result["error"]
+
+    yield result["text"], None
+
+
+def record_cancelled_run(query: str, token: CancellationToken):
+    global nb_cancelled_runs
+
+    with nb_cancelled_runs_lock:
+        nb_cancelled_runs += 1
+        logger.warning(
+            f"Cancelled the run of `{query}` ({token.reason}), "
+            f"number of cancelled runs: {nb_cancelled_runs}"
+        )
 
 
 block = gr.Blocks()
@@ -67,22 +154,45 @@ with block:
     )
 
     with gr.Row():
-        output = gr.Markdown("It will take a few minutes to output the results...")
+        output = gr.Markdown(WAITING_MESSAGE)
+
+    # セッション毎の、生成中のレビューを取り消すためのトークン
+    cancellation_token = gr.State(None)
+    # セッション毎の API キー、他のセッションのリクエストに使われないように環境変数には設定しない
+    openai_api_key = gr.State(None)
+    serpapi_api_key = gr.State(None)
 
     gr.HTML(
         "<center>Powered by <a href='https://github.com/hwchase17/langchain'>LangChain 🦜️🔗</a></center>"
     )
 
-    submit.click(fn=run, inputs=query, outputs=output)
+    submit.click(
+        fn=run,
+        inputs=[query, openai_api_key, serpapi_api_key, cancellation_token],
+        outputs=[output, cancellation_token],
+        api_name="run",
+    )
     openai_api_key_textbox.change(
-        set_openai_api_key,
+        lambda api_key: api_key,
         inputs=[openai_api_key_textbox],
+        outputs=[openai_api_key],
+        queue=False,
     )
     serpai_api_key_textbox.change(
-        set_serpapi_api_key,
+        lambda api_key: api_key,
         inputs=[serpai_api_key_textbox],
+        outputs=[serpapi_api_key],
+        queue=False,
     )
 
 
-
-block.launch(debug=True)
+if __name__ == "__main__":
+    # spaCy のモデルの読み込みはリクエストを受け付ける前に済ませておく、
+    # lru_cache は引数の渡し方毎にキャッシュするので create_papers_vectorstor と同じく位置引数で渡す
+    get_text_splitter("gpt-3.5-turbo", 150, 10)
+    # run はリクエスト毎にスレッドを立てるので、スレッド毎の HTTP セッションでは接続が使い回されない
+    use_shared_openai_session(pool_maxsize=CONCURRENCY_COUNT * 4)
+    block.queue(
+        concurrency_count=CONCURRENCY_COUNT,
+        max_size=MAX_QUEUE_SIZE,
+    ).launch(debug=True)
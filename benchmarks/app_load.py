@@ -0,0 +1,429 @@
+"""デモアプリ (app.py) の run エンドポイントに、同時に複数のユーザーからリクエストを送って負荷を計測する
+
+LLM と SerpApi、arXiv、埋め込みは遅延を指定できるローカルの偽物に置き換えたアプリを別プロセスで起動し、
+gradio_client で --nb-users 人のユーザーがそれぞれ --nb-requests-per-user 回ずつ順にリクエストを送る。
+スループット、レイテンシと待ち行列での待ち時間のパーセンタイル、アプリのプロセス全体のメモリ使用量 (RSS の増分) を
+報告する。キューのワーカーは一つのプロセスのスレッドなのでワーカー毎には測れない、--concurrency-count を変えて
+実行し、並列数毎の増分を比べる。
+
+    python benchmarks/app_load.py --nb-users 8 --concurrency-count 2 --llm-latency 2 --search-latency 0.5
+
+--url を指定すると起動済みのアプリに対して計測する (その場合メモリは --pid を指定した場合のみ計測する)。
+"""
+import argparse
+import datetime
+import hashlib
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+from typing import Dict, List, Optional
+
+# app.py はリポジトリのルートにある
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORDS = (
+    "language model agent tool retrieval reasoning planning benchmark dataset evaluation "
+    "transformer attention training inference prompt instruction feedback reward policy "
+    "memory search api code execution environment task performance accuracy latency robust"
+).split()
+
+
+def sleep_with_jitter(latency: float):
+    if latency > 0:
+        time.sleep(random.uniform(0.5, 1.5) * latency)
+
+
+def get_seed(text: str) -> int:
+    return int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16)
+
+
+def generate_text(seed: int, nb_words: int) -> str:
+    random_state = random.Random(seed)
+    sentences = []
+
+    while nb_words > 0:
+        sentence_len = random_state.randint(8, 20)
+        sentences.append(" ".join(random_state.choice(WORDS) for _ in range(sentence_len)).capitalize() + ".")
+        nb_words -= sentence_len
+
+    return " ".join(sentences)
+
+
+def create_fake_chat_model(latency: float):
+    import json
+    import re
+    import tiktoken
+    from langchain.chat_models.base import BaseChatModel
+    from langchain.schema import AIMessage, ChatGeneration, ChatResult
+
+    enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
+
+    class FakeChatModel(BaseChatModel):
+        """プロンプトの種類に応じて、出力パーサーが受け付ける形式の出力を返す偽の LLM
+        """
+
+        latency: float = 1.0
+
+        @property
+        def _llm_type(self) -> str:
+            return "fake-chat"
+
+        def get_num_tokens(self, text: str) -> int:
+            return len(enc.encode(text))
+
+        def _generate(self, messages, stop=None, run_manager=None) -> ChatResult:
+            sleep_with_jitter(self.latency)
+            prompt = messages[-1].content
+            text = self._respond(prompt)
+            token_usage = {
+                "prompt_tokens": sum(self.get_num_tokens(m.content) for m in messages),
+                "completion_tokens": self.get_num_tokens(text),
+            }
+            token_usage["total_tokens"] = token_usage["prompt_tokens"] + token_usage["completion_tokens"]
+
+            return ChatResult(
+                generations=[ChatGeneration(message=AIMessage(content=text))],
+                llm_output={"token_usage": token_usage},
+            )
+
+        async def _agenerate(self, messages, stop=None, run_manager=None) -> ChatResult:
+            return self._generate(messages, stop=stop)
+
+        def _combine_llm_outputs(self, llm_outputs):
+            token_usage = {}
+
+            for output in llm_outputs:
+                for k, v in (output or {}).get("token_usage", {}).items():
+                    token_usage[k] = token_usage.get(k, 0) + v
+
+            return {"token_usage": token_usage}
+
+        def _respond(self, prompt: str) -> str:
+            citation_ids = sorted({int(i) for i in re.findall(r"citation_id: (\d+)", prompt)}) or [1]
+            seed = get_seed(prompt)
+
+            if prompt.startswith("Write an overview"):
+                return json.dumps({
+                    "title": "A Systematic Review",
+                    "main_points": [generate_text(seed + i, 20) for i in range(3)],
+                    "overview": generate_text(seed, 120),
+                })
+
+            if prompt.startswith("Build an outline"):
+                def section(title, children=None):
+                    return {
+                        "title": title,
+                        "children": children,
+                        "description": generate_text(get_seed(title), 20),
+                        "citation_ids": citation_ids[:3],
+                    }
+
+                return json.dumps({
+                    "sections": [
+                        section("Introduction"),
+                        section("Methods", [section("Tool use"), section("Planning")]),
+                        section("Evaluation", [section("Benchmarks")]),
+                        section("Conclusion"),
+                    ],
+                    "citations_ids": citation_ids,
+                })
+
+            if prompt.startswith("Summarize"):
+                return f"citation_ids: {', '.join(map(str, citation_ids))}\nSummary: {generate_text(seed, 150)}"
+
+            if prompt.startswith("Take notes"):
+                return "\n".join(f"- {generate_text(seed + i, 15)} [^{i}]" for i in citation_ids[:5])
+
+            title = re.search(r'Write the "([^"]+)" section', prompt)
+            suffix = re.search(r"\(`(#+)`\)", prompt)
+
+            return (
+                f"{suffix.group(1) if suffix else '##'} {title.group(1) if title else 'Section'}\n\n"
+                + " ".join(f"{generate_text(seed + i, 40)} [^{i}]" for i in citation_ids[:4])
+            )
+
+    return FakeChatModel(latency=latency)
+
+
+class FakeEmbeddings:
+    """テキストから決まる、正規化された乱数のベクトルを返す偽の埋め込み
+    """
+
+    model = "fake-embedding"
+    # with_openai_api_key が包む OpenAI のクライアント、偽の埋め込みでは使わない
+    client = None
+
+    def __init__(self, dim: int, latency: float):
+        self.dim = dim
+        self.latency = latency
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        sleep_with_jitter(self.latency)
+        return [self._embed(t) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        sleep_with_jitter(self.latency)
+        return self._embed(text)
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.random.RandomState(get_seed(text)).normal(size=self.dim)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+
+def serve(args):
+    """偽のバックエンドに差し替えたアプリを起動する
+    """
+    # キャッシュとコーパスは計測毎に空の一時ディレクトリを使う、import する前に設定する
+    os.environ.setdefault("METAANALYSER_CACHE_DIR", tempfile.mkdtemp(prefix="metaanalyser-load-"))
+    os.environ["OPENAI_API_KEY"] = "fake"
+    os.environ["SERPAPI_API_KEY"] = "fake"
+    sys.path.insert(0, ROOT_DIR)
+
+    import arxiv
+    import app
+    from metaanalyser.paper import paper, vectorstore
+
+    def fetch_google_scholar(query: str, start: int, serpapi_api_key: Optional[str] = None) -> list:
+        sleep_with_jitter(args.search_latency)
+        # クエリ毎に別の論文を返して、コーパスにない論文の取り込みを毎回計測する
+        seed = get_seed(query)
+
+        return [{
+            "result_id": f"{seed}-{start + i}",
+            "title": f"Paper {start + i} of {query}",
+            "link": f"https://arxiv.org/abs/{2300 + seed % 100}.{(seed + start + i) % 100_000:05d}",
+            "inline_links": {"cited_by": {"total": random.randint(0, 500)}},
+        } for i in range(10)]
+
+    def fetch_google_scholar_cite(google_scholar_id: str, serpapi_api_key: Optional[str] = None) -> dict:
+        sleep_with_jitter(args.search_latency)
+        return {"citations": [{"title": "MLA", "snippet": f"Author, A. \"Paper {google_scholar_id}.\""}]}
+
+    def fetch_arxiv_result(arxiv_abs_link: str) -> arxiv.Result:
+        sleep_with_jitter(args.arxiv_latency)
+        seed = get_seed(arxiv_abs_link)
+
+        return arxiv.Result(
+            entry_id=arxiv_abs_link,
+            published=datetime.datetime(2023, 1, 1),
+            title=f"Paper {arxiv_abs_link}",
+            authors=[arxiv.Result.Author("Alice Smith"), arxiv.Result.Author("Bob Jones")],
+            summary=generate_text(seed, 200),
+            primary_category="cs.CL",
+            categories=["cs.CL", "cs.AI"],
+        )
+
+    def get_text_from_arxiv_search_result(arxiv_search_result: arxiv.Result) -> str:
+        sleep_with_jitter(args.arxiv_latency)
+        return generate_text(get_seed(arxiv_search_result.entry_id), args.nb_words_per_paper)
+
+    paper.fetch_google_scholar = fetch_google_scholar
+    paper.fetch_google_scholar_cite = fetch_google_scholar_cite
+    paper.fetch_arxiv_result = fetch_arxiv_result
+    paper.get_text_from_arxiv_search_result = get_text_from_arxiv_search_result
+    vectorstore.OpenAIEmbeddings = lambda **kwargs: FakeEmbeddings(args.embedding_dim, args.embedding_latency)
+    app.create_chat_model = lambda *_, **kwargs: create_fake_chat_model(args.llm_latency)
+
+    # 計測する最初のリクエストで spaCy を読み込まないように、get_paper_splitter と同じ位置引数で呼ぶ
+    app.get_text_splitter("gpt-3.5-turbo", 150, 10)
+    app.block.queue(
+        concurrency_count=args.concurrency_count,
+        max_size=args.max_queue_size,
+    ).launch(server_name="127.0.0.1", server_port=args.port)
+
+
+def get_rss(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+
+class RSSSampler(threading.Thread):
+
+    def __init__(self, pid: int, interval: float = 0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, get_rss(self.pid) or 0)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def simulate_user(url: str, user_idx: int, args, results: List[Dict]):
+    from gradio_client import Client
+    from gradio_client.utils import Status
+
+    client = Client(url, verbose=False)
+
+    for request_idx in range(args.nb_requests_per_user):
+        query = f"load test {args.run_id} user {user_idx} request {request_idx}"
+        submitted_at = time.time()
+        job = client.submit(query, api_name="/run")
+        started_at = None
+
+        while not job.done():
+            status = job.status()
+
+            if started_at is None and status.code in [Status.PROCESSING, Status.PROGRESS, Status.ITERATING]:
+                started_at = status.time.timestamp() if status.time else time.time()
+
+            time.sleep(args.poll_interval)
+
+        try:
+            job.result()
+            error = None
+        except Exception as e:
+            error = str(e)
+
+        finished_at = time.time()
+        results.append({
+            "latency": finished_at - submitted_at,
+            "queue_wait": started_at - submitted_at if started_at is not None else None,
+            "error": error,
+            "finished_at": finished_at,
+        })
+
+
+def wait_until_ready(url: str, process: Optional[subprocess.Popen], timeout: float):
+    from gradio_client import Client
+
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"The app exited with code {process.returncode}")
+
+        try:
+            Client(url, verbose=False)
+            return
+        except Exception:
+            time.sleep(1)
+
+    raise TimeoutError(f"The app did not start in {timeout} seconds")
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def format_percentiles(values: List[float]) -> str:
+    if not values:
+        return "n/a"
+
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+
+    return f"p50={p50:.2f}s p90={p90:.2f}s p99={p99:.2f}s max={max(values):.2f}s"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="URL of a running app, if not given the app is started with fake backends")
+    parser.add_argument("--pid", type=int, help="process id of the running app to measure the memory of")
+    parser.add_argument("--nb-users", type=int, default=4)
+    parser.add_argument("--nb-requests-per-user", type=int, default=2)
+    parser.add_argument("--concurrency-count", type=int, default=2)
+    parser.add_argument("--max-queue-size", type=int, default=100)
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="seconds per LLM call")
+    parser.add_argument("--search-latency", type=float, default=0.5, help="seconds per SerpApi call")
+    parser.add_argument("--arxiv-latency", type=float, default=0.5, help="seconds per arXiv call")
+    parser.add_argument("--embedding-latency", type=float, default=0.2, help="seconds per embedding call")
+    parser.add_argument("--embedding-dim", type=int, default=1536)
+    parser.add_argument("--nb-words-per-paper", type=int, default=3000)
+    parser.add_argument("--poll-interval", type=float, default=0.1)
+    parser.add_argument("--startup-timeout", type=float, default=120.0)
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    args.run_id = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+    process = None
+    url = args.url
+    pid = args.pid
+
+    if url is None:
+        port = args.port or get_free_port()
+        url = f"http://127.0.0.1:{port}/"
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--serve", "--port", str(port)]
+            + [a for a in sys.argv[1:] if a != "--serve"],
+            cwd=ROOT_DIR,
+        )
+        pid = process.pid
+
+    try:
+        wait_until_ready(url, process, args.startup_timeout)
+        baseline_rss = get_rss(pid) if pid is not None else None
+        sampler = RSSSampler(pid) if pid is not None else None
+
+        if sampler is not None:
+            sampler.start()
+
+        results: List[Dict] = []
+        start = time.time()
+        users = [
+            threading.Thread(target=simulate_user, args=(url, user_idx, args, results))
+            for user_idx in range(args.nb_users)
+        ]
+
+        for user in users:
+            user.start()
+
+        for user in users:
+            user.join()
+
+        elapsed = time.time() - start
+
+        if sampler is not None:
+            sampler.stop()
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    succeeded = [r for r in results if r["error"] is None]
+    queue_waits = [r["queue_wait"] for r in succeeded if r["queue_wait"] is not None]
+
+    print(
+        f"users={args.nb_users} requests={len(results)} succeeded={len(succeeded)}"
+        f" failed={len(results) - len(succeeded)} concurrency_count={args.concurrency_count}"
+    )
+    print(f"elapsed={elapsed:.2f}s throughput={len(succeeded) / elapsed * 60:.2f} reviews/min")
+    print(f"latency:    {format_percentiles([r['latency'] for r in succeeded])}")
+    print(f"queue wait: {format_percentiles(queue_waits)}")
+
+    if sampler is not None and baseline_rss:
+        print(
+            f"rss: baseline={baseline_rss / 2**20:.1f}MiB peak={sampler.peak / 2**20:.1f}MiB"
+            f" total growth at concurrency_count={args.concurrency_count}"
+            f"={(sampler.peak - baseline_rss) / 2**20:.1f}MiB"
+        )
+
+    for error in sorted({r["error"] for r in results if r["error"] is not None}):
+        print(f"error: {error}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""FAISS のインデックスの種類毎に、再現率と検索時間、メモリ使用量を比較する
+
+コーパス (METAANALYSER_CORPUS_DIR) に保存された埋め込みを使う、--nb-vectors を指定すると
+足りない分はそれらしい分布の乱数で補う。
+
+    python benchmarks/faiss_index.py --nb-vectors 100000 --nprobe 4 16 --ef-search 32 128
+"""
+import argparse
+import glob
+import os
+import pickle
+import time
+import numpy as np
+from langchain.vectorstores.faiss import dependable_faiss_import
+
+from metaanalyser.paper.corpus import CORPUS_DIR
+from metaanalyser.paper.index import build_faiss_index, set_search_params
+
+
+def load_corpus_embeddings(corpus_dir: str) -> np.ndarray:
+    embeddings = []
+
+    for path in glob.glob(os.path.join(corpus_dir, "*", "chunks-*.pkl")):
+        with open(path, "rb") as f:
+            _, paper_embeddings = pickle.load(f)
+
+        if paper_embeddings is not None:
+            embeddings.append(paper_embeddings[~np.isnan(paper_embeddings[:, 0])])
+
+    return np.concatenate(embeddings) if embeddings else np.zeros((0, 0), dtype=np.float32)
+
+
+def generate_embeddings(
+        nb_vectors: int,
+        dim: int,
+        nb_clusters: int = 100,
+        seed: int = 1,
+) -> np.ndarray:
+    # 論文のチャンクの埋め込みは話題毎にまとまるので、クラスタ構造を持たせた正規化済みのベクトルを作る
+    random_state = np.random.RandomState(seed)
+    centers = random_state.normal(size=(nb_clusters, dim))
+    embeddings = (
+        centers[random_state.randint(nb_clusters, size=nb_vectors)]
+        + 0.5 * random_state.normal(size=(nb_vectors, dim))
+    ).astype(np.float32)
+
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def measure(index, queries: np.ndarray, ground_truth: np.ndarray, k: int):
+    latencies = []
+    results = []
+
+    for query in queries:
+        start = time.perf_counter()
+        _, indices = index.search(query[None, :], k)
+        latencies.append(time.perf_counter() - start)
+        results.append(indices[0])
+
+    recall = np.mean([
+        len(set(result) & set(truth)) / k
+        for result, truth in zip(results, ground_truth)
+    ])
+
+    return recall, np.array(latencies) * 1_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus-dir", default=CORPUS_DIR)
+    parser.add_argument("--nb-vectors", type=int, default=0)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--nb-queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=100)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[8])
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[64])
+    parser.add_argument("--pq-m", type=int, default=16)
+    args = parser.parse_args()
+
+    faiss = dependable_faiss_import()
+    embeddings = load_corpus_embeddings(args.corpus_dir)
+    dim = embeddings.shape[1] if len(embeddings) else args.dim
+
+    if len(embeddings) < args.nb_vectors:
+        embeddings = np.concatenate([
+            embeddings.reshape(-1, dim),
+            generate_embeddings(args.nb_vectors - len(embeddings), dim),
+        ])
+
+    if len(embeddings) == 0:
+        parser.error(
+            f"No embeddings are found in {args.corpus_dir},"
+            " pass --nb-vectors to benchmark on generated vectors"
+        )
+
+    if len(embeddings) < args.k:
+        parser.error(f"--k ({args.k}) should not exceed the number of vectors ({len(embeddings)})")
+
+    random_state = np.random.RandomState(0)
+    queries = embeddings[random_state.choice(len(embeddings), size=args.nb_queries)]
+    queries = queries + 0.05 * random_state.normal(size=queries.shape).astype(np.float32)
+
+    # flat インデックスの結果を正解とする
+    flat = build_faiss_index(embeddings, "flat")
+    _, ground_truth = flat.search(queries, args.k)
+
+    print(f"vectors={len(embeddings)}, dim={dim}, queries={args.nb_queries}, k={args.k}")
+    print(f"{'index':<10} {'params':<14} {'build(s)':>9} {'memory(MB)':>11} {'recall':>7} {'p50(ms)':>8} {'p95(ms)':>8}")
+
+    for index_type in ["flat", "ivf", "hnsw", "ivfpq"]:
+        start = time.perf_counter()
+        index = build_faiss_index(embeddings, index_type, pq_m=args.pq_m)
+        build_time = time.perf_counter() - start
+        memory = len(faiss.serialize_index(index)) / 1024 ** 2
+
+        if isinstance(index, faiss.IndexIVF):
+            params = [("nprobe", nprobe, {"nprobe": nprobe}) for nprobe in args.nprobe]
+        elif isinstance(index, faiss.IndexHNSW):
+            params = [("ef_search", ef, {"ef_search": ef}) for ef in args.ef_search]
+        else:
+            params = [("", "", {})]
+
+        for name, value, search_params in params:
+            set_search_params(index, **search_params)
+            recall, latencies = measure(index, queries, ground_truth, args.k)
+            print(
+                f"{index_type:<10} {f'{name}={value}' if name else '-':<14}"
+                f" {build_time:>9.2f} {memory:>11.1f} {recall:>7.3f}"
+                f" {np.percentile(latencies, 50):>8.3f} {np.percentile(latencies, 95):>8.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import openai
+import os
+import requests
+from langchain.chat_models import ChatOpenAI
+from requests.adapters import HTTPAdapter
+from typing import Any, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class KeyedOpenAIClient:
+    """openai.ChatCompletion や openai.Embedding を包み、リクエスト毎に api_key を渡す
+
+    langchain の ChatOpenAI と OpenAIEmbeddings は API キーを openai.api_key (プロセス全体で共有) に設定するので、
+    一つのプロセスで複数のキーを使うと、最後に作ったクライアントのキーで全てのリクエストが送られてしまう。
+    """
+
+    def __init__(self, client: Any, api_key: str):
+        self.client = client
+        self.api_key = api_key
+
+    def create(self, **kwargs) -> Any:
+        return self.client.create(api_key=self.api_key, **kwargs)
+
+    async def acreate(self, **kwargs) -> Any:
+        return await self.client.acreate(api_key=self.api_key, **kwargs)
+
+
+def resolve_openai_api_key(api_key: Optional[str] = None) -> str:
+    """api_key が None (か空) なら環境変数 OPENAI_API_KEY のキーを返す
+    """
+    api_key = api_key or os.environ.get("OPENAI_API_KEY")
+
+    if not api_key:
+        raise ValueError("OpenAI API key is not given and OPENAI_API_KEY is not set")
+
+    return api_key
+
+
+def with_openai_api_key(model: T, api_key: Optional[str] = None) -> T:
+    """ChatOpenAI や OpenAIEmbeddings の model が、api_key で OpenAI の API を呼ぶようにする
+
+    api_key が None なら環境変数 OPENAI_API_KEY のキーを使う。どちらの場合もリクエスト毎にキーを渡すので、
+    他のセッションが (クライアントを作る度に) openai.api_key を書き換えても、そのキーで送られることはない。
+    """
+    client = model.client
+
+    if isinstance(client, KeyedOpenAIClient):
+        client = client.client
+
+    model.client = KeyedOpenAIClient(client, resolve_openai_api_key(api_key))
+
+    return model
+
+
+def create_chat_model(openai_api_key: Optional[str] = None, **kwargs) -> ChatOpenAI:
+    """openai_api_key (None なら環境変数のキー) で OpenAI の API を呼ぶ ChatOpenAI を返す
+    """
+    openai_api_key = resolve_openai_api_key(openai_api_key)
+
+    return with_openai_api_key(ChatOpenAI(openai_api_key=openai_api_key, **kwargs), openai_api_key)
+
+
+def use_shared_openai_session(pool_maxsize: int = 16) -> requests.Session:
+    """openai が全てのスレッドで、keep-alive で接続を使い回す一つの HTTP セッションを使うようにする
+
+    openai 0.27 は HTTP セッションをスレッド毎に作るので、リクエスト毎にスレッドを立てる app や
+    実行毎にスレッドプールを作る StageGraph では、リクエストの度に新しい接続を張ることになる。
+    API キーはリクエスト毎にヘッダで渡すので、セッションを共有しても他のキーで送られることはない。
+    """
+    if not isinstance(openai.requestssession, requests.Session):
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        openai.requestssession = session
+
+    return openai.requestssession
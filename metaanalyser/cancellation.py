@@ -0,0 +1,37 @@
+import threading
+from typing import Optional
+
+
+class RunCancelled(Exception):
+    """CancellationToken が取り消されたので、実行を中断した
+    """
+
+
+class CancellationToken:
+    """実行中のレビューの生成を途中で止めるためのトークン
+
+    取り消しは協調的で、SRChain や search_on_google_scholar などは処理の区切り (論文毎、セクション毎など) で
+    raise_if_cancelled を呼び、取り消されていれば RunCancelled を送出して後続の処理を行わない。
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason: Optional[str] = None
+
+    def cancel(self, reason: str = "cancelled"):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise RunCancelled(self.reason)
+
+
+def raise_if_cancelled(token: Optional[CancellationToken]):
+    if token is not None:
+        token.raise_if_cancelled()
@@ -2,6 +2,7 @@ from .overview import SROverviewChain
 from .outline import SROutlintChain
 from .section import SRSectionChain
 from .sr import SRChain
+from .summary import SRSummaryChain
 
 
 __all__ = [
@@ -9,4 +10,5 @@ __all__ = [
     "SROutlintChain",
     "SROverviewChain",
     "SRSectionChain",
+    "SRSummaryChain",
 ]
@@ -1,17 +1,55 @@
 import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from langchain.base_language import BaseLanguageModel
 from langchain.chains.llm import LLMChain
 from langchain.callbacks.manager import CallbackManagerForChainRun
 from langchain.output_parsers import RetryWithErrorOutputParser
 from langchain.prompts.base import BasePromptTemplate
 from langchain.schema import BaseOutputParser, OutputParserException
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+from ..profiling import in_current_stage
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class TokenUsage:
+    """LLM の呼び出しで使ったトークン数などを集計する、複数のスレッドから更新される
+    """
+
+    def __init__(self):
+        self.counts: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, key: str, value: int):
+        with self._lock:
+            self.counts[key] += value
+
+    def add_llm_output(self, llm_output: Optional[Dict[str, Any]]):
+        token_usage = (llm_output or {}).get("token_usage", {})
+
+        for key in ["prompt_tokens", "completion_tokens", "total_tokens"]:
+            self.add(key, token_usage.get(key, 0))
+
+        self.add("nb_calls", 1)
+
+    def __getitem__(self, key: str) -> int:
+        return self.counts[key]
+
+    def __str__(self) -> str:
+        return ", ".join(f"{k}={v}" for k, v in self.counts.items())
+
 
 class SRBaseChain(LLMChain):
 
+    # 指定されていれば、LLM の呼び出しで使ったトークン数をここに集計する
+    token_usage: Optional[TokenUsage] = None
+
     def _call(
         self,
         inputs: Dict[str, Any],
@@ -20,6 +58,10 @@ class SRBaseChain(LLMChain):
         response = self.generate(inputs, run_manager=run_manager)
         # トークンの利用状況を確認したい
         logger.info(f"LLM utilization: {response.llm_output}")
+
+        if self.token_usage is not None:
+            self.token_usage.add_llm_output(response.llm_output)
+
         return self.create_outputs(response)[0]
 
     def _acall(
@@ -29,6 +71,10 @@ class SRBaseChain(LLMChain):
     ) -> Dict[str, str]:
         response = self.agenerate(inputs, run_manager=run_manager)
         logger.info(f"LLM utilization: {response.llm_output}")
+
+        if self.token_usage is not None:
+            self.token_usage.add_llm_output(response.llm_output)
+
         return self.create_outputs(response)[0]
 
 
@@ -56,3 +102,17 @@ def maybe_retry_with_error_output_parser(
         )
 
     return {output_key: output_text}
+
+
+def run_concurrently(
+        fn: Callable[[T], R],
+        items: List[T],
+        nb_max_concurrency: int,
+) -> List[R]:
+    """items のそれぞれに fn を高々 nb_max_concurrency 並列で適用し、items と同じ順序で結果を返す
+    """
+    if nb_max_concurrency <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(nb_max_concurrency, len(items))) as executor:
+        return list(executor.map(in_current_stage(fn), items))
@@ -13,6 +13,7 @@ from ..base import (
     maybe_retry_with_error_output_parser,
 )
 from ..overview import Overview
+from ..summary import get_abstracts
 from .prompt import OUTLINE_PROMPT, output_parser
 
 
@@ -21,11 +22,35 @@ class SROutlintChain(SRBaseChain):
     prompt: BasePromptTemplate = OUTLINE_PROMPT
     nb_categories: int = 3
     nb_token_limit: int = 1_500
+    # "map_reduce" なら全ての論文の要約を並列にまとめてからプロンプトに含める
+    mode: str = "stuff"
+    nb_map_batch_token_limit: int = 2_000
+    nb_max_concurrency: int = 4
 
     @property
     def input_keys(self) -> List[str]:
         return ["query", "papers", "overview"]
 
+    def _get_abstracts(self, inputs: Dict[str, Any]) -> Optional[str]:
+        # SRChain から要約済みの abstracts が渡されていればそれを使う
+        if "abstracts" in inputs:
+            return inputs["abstracts"]
+
+        if self.mode != "map_reduce":
+            return None
+
+        return get_abstracts(
+            self.llm,
+            inputs["query"],
+            inputs["papers"],
+            self.nb_categories,
+            self.nb_token_limit,
+            mode=self.mode,
+            nb_map_batch_token_limit=self.nb_map_batch_token_limit,
+            nb_max_concurrency=self.nb_max_concurrency,
+            verbose=self.verbose,
+        )
+
     def _call(
         self,
         inputs: Dict[str, Any],
@@ -38,6 +63,7 @@ class SROutlintChain(SRBaseChain):
             inputs["overview"],
             self.nb_categories,
             self.nb_token_limit,
+            self._get_abstracts(inputs),
         )
         output = super()._call(input_list, run_manager=run_manager)
         return maybe_retry_with_error_output_parser(
@@ -61,6 +87,7 @@ class SROutlintChain(SRBaseChain):
             inputs["overview"],
             self.nb_categories,
             self.nb_token_limit,
+            self._get_abstracts(inputs),
         )
         output = super()._acall(input_list, run_manager=run_manager)
         return maybe_retry_with_error_output_parser(
@@ -80,10 +107,14 @@ def get_input_list(
         overview: Overview,
         nb_categories: int,
         nb_token_limit: int,
+        abstracts: Optional[str] = None,
 ):
     return [{
         "query": query,
         "overview": overview,
         "categories": get_categories_string(papers, nb_categories),
-        "abstracts": get_abstract_with_token_limit(llm, papers, nb_token_limit)
+        "abstracts": (
+            abstracts if abstracts is not None
+            else get_abstract_with_token_limit(llm, papers, nb_token_limit)
+        )
     }]
@@ -6,7 +6,7 @@ from langchain.prompts import (
     HumanMessagePromptTemplate,
 )
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Callable, List, Optional, Tuple
 
 
 class Section(BaseModel):
@@ -23,8 +23,38 @@ class Outlint(BaseModel):
     citations_ids: List[int] = Field(description="citation ids to all paper abstracts cited in this paper")
 
     def __str__(self):
-        def section_string(idx: int, section: Section, indent_level: int):
-            result = [f"{idx}. {section.title}: {section.description}"]
+        return self._to_string(lambda _: True)
+
+    def to_compact_string(self, current: Section) -> str:
+        """current のセクションとその祖先、それらの前後の兄弟、current の子のみ説明を付け、
+        他のセクションはタイトルのみにした目次を返す
+        """
+        path = get_section_path(self.sections, current)
+
+        if path is None:
+            return str(self)
+
+        detailed = set()
+
+        for depth in range(len(path) + 1):
+            parent = path[:depth]
+            siblings = get_children(self.sections, parent)
+
+            if depth < len(path):
+                idx = path[depth]
+                neighbours = range(max(idx - 1, 0), min(idx + 2, len(siblings)))
+                detailed.update(parent + (i,) for i in neighbours)
+            else:
+                detailed.update(parent + (i,) for i in range(len(siblings)))
+
+        return self._to_string(lambda position: position in detailed)
+
+    def _to_string(self, is_detailed: Callable[[Tuple[int, ...]], bool]) -> str:
+        def section_string(idx: int, section: Section, indent_level: int, position: Tuple[int, ...]):
+            if is_detailed(position):
+                result = [f"{idx}. {section.title}: {section.description}"]
+            else:
+                result = [f"{idx}. {section.title}"]
 
             if not section.children:
                 return result[0]
@@ -33,18 +63,41 @@ class Outlint(BaseModel):
                 section_string(
                     ("    " * (indent_level + 1)) + f"{child_idx}",
                     child,
-                    indent_level + 1
+                    indent_level + 1,
+                    position + (child_idx - 1,),
                 )
                 for child_idx, child in enumerate(section.children, start=1)
             ]
             return "\n".join(result)
 
         return "\n".join([
-            section_string(idx, s, 0)
+            section_string(idx, s, 0, (idx - 1,))
             for idx, s in enumerate(self.sections, start=1)
         ])
 
 
+def get_section_path(sections: List[Section], target: Section) -> Optional[Tuple[int, ...]]:
+    """target までの各階層での添字を返す、見つからなければ None を返す
+    """
+    for idx, section in enumerate(sections):
+        if section == target:
+            return (idx,)
+
+        path = get_section_path(section.children or [], target)
+
+        if path is not None:
+            return (idx,) + path
+
+    return None
+
+
+def get_children(sections: List[Section], position: Tuple[int, ...]) -> List[Section]:
+    for idx in position:
+        sections = sections[idx].children or []
+
+    return sections
+
+
 output_parser = PydanticOutputParser(pydantic_object=Outlint)
 
 system_template = "You are a research scientist and intereseted in {categories}. You are working on writing a systematic review regarding \"{query}\"."
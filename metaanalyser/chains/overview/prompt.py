@@ -1,3 +1,4 @@
+import re
 from langchain.output_parsers import PydanticOutputParser
 from langchain.prompts import (
     ChatPromptTemplate,
@@ -22,6 +23,19 @@ Title: {self.title}
 Points:
   - {points}
 Overview: {self.overview}
+""".strip()
+
+    def to_compact_string(self, nb_sentences: int = 2) -> str:
+        """overview を先頭の nb_sentences 文に縮めたものを返す
+        """
+        points = "\n  - ".join(self.main_points)
+        sentences = re.split(r"(?<=[.!?])\s+", self.overview.strip())
+        overview = " ".join(sentences[:nb_sentences])
+        return f"""
+Title: {self.title}
+Points:
+  - {points}
+Overview: {overview}
 """.strip()
 
     def _repr_html_(self):
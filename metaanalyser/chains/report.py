@@ -0,0 +1,75 @@
+import contextlib
+import io
+import logging
+from typing import Iterator, List, Optional, Set, TextIO
+
+from ..paper import Paper
+from .outline import Outlint
+from .overview import Overview
+
+logger = logging.getLogger(__name__)
+
+
+class ReportWriter:
+    """システマティックレビューを Markdown として逐次書き出す
+
+    セクションは書き上がる度に書き出すので、途中でプロセスが落ちてもそこまでの出力は残る。
+    引用された citation_id は集合で保持しておき、最後に References をまとめて書き出す。
+    """
+
+    def __init__(self, fp: TextIO):
+        self.fp = fp
+        self.citation_ids: Set[int] = set()
+
+    def write_header(self, overview: Overview, outline: Outlint):
+        self.citation_ids.update(int(c) for c in outline.citations_ids)
+        self._write(
+            f"# {overview.title}\n\n{overview.overview}\n\n"
+            f"## Table of contents\n\n{outline}"
+        )
+
+    def write_section(self, section_as_md: str, citation_ids: List[int]):
+        self.citation_ids.update(int(c) for c in citation_ids)
+        self._write(f"\n\n{section_as_md}")
+
+    def write_references(self, papers: List[Paper]):
+        papers_citation_id_map = {p.citation_id: p for p in papers}
+
+        self._write("\n\n## References\n")
+
+        for idx, citation_id in enumerate(sorted(self.citation_ids)):
+            citation = papers_citation_id_map[citation_id]
+            self._write(
+                ("\n\n" if idx > 0 else "")
+                + f"[^{citation_id}]: "
+                + f"[{citation.mla_citiation.snippet}]({citation.link})"
+            )
+
+    def getvalue(self) -> str:
+        """メモリ上に書き出した場合のみ、書き出した Markdown を返す
+
+        ファイルに書き出した場合は、レビュー全体をメモリに読み戻さないように内容を保持しない。
+        """
+        if not isinstance(self.fp, io.StringIO):
+            raise ValueError(f"The report is written to {self.fp.name} and is not kept in memory")
+
+        return self.fp.getvalue()
+
+    def _write(self, text: str):
+        self.fp.write(text)
+        self.fp.flush()
+
+
+@contextlib.contextmanager
+def open_report_writer(path: Optional[str] = None) -> Iterator[ReportWriter]:
+    """path が指定されていればそのファイルに、されていなければメモリ上に書き出す ReportWriter を返す
+    """
+
+    if path is None:
+        yield ReportWriter(io.StringIO())
+        return
+
+    logger.info(f"Writing the review to {path}")
+
+    with open(path, "w", encoding="utf-8") as fp:
+        yield ReportWriter(fp)
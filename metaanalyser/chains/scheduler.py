@@ -0,0 +1,105 @@
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional
+
+from ..cancellation import CancellationToken, raise_if_cancelled
+
+logger = logging.getLogger(__name__)
+
+
+class StageGraph:
+    """依存関係のある段階を、依存する段階が全て終わり次第並列に実行する
+
+    段階の関数は依存する段階の結果を、その段階の名前のキーワード引数として受け取る。
+    e.g. graph.add("outline", write_outline, ["papers", "overview"]) なら
+    write_outline(papers=..., overview=...) と呼ばれる。
+    """
+
+    def __init__(self):
+        self._fns: Dict[str, Callable[..., Any]] = {}
+        self._dependencies: Dict[str, List[str]] = {}
+
+    def add(
+            self,
+            name: str,
+            fn: Callable[..., Any],
+            dependencies: Optional[List[str]] = None,
+    ) -> "StageGraph":
+        dependencies = dependencies or []
+
+        if name in self._fns:
+            raise ValueError(f"Stage {name} is already added")
+
+        for d in dependencies:
+            if d not in self._fns:
+                # 依存先を先に追加させることで循環しないことを保証する
+                raise ValueError(f"Stage {name} depends on unknown stage {d}")
+
+        self._fns[name] = fn
+        self._dependencies[name] = dependencies
+
+        return self
+
+    def run(
+            self,
+            nb_max_workers: int = 4,
+            cancellation_token: Optional[CancellationToken] = None,
+    ) -> Dict[str, Any]:
+        """全ての段階を実行して、段階の名前から結果への dict を返す
+
+        いずれかの段階で例外が起きた場合は、まだ始まっていない段階を取り消してその例外を送出する。
+        cancellation_token が取り消された場合は、新たな段階を始めずに RunCancelled を送出する。
+        """
+        results: Dict[str, Any] = {}
+        elapsed: Dict[str, float] = {}
+        running: Dict[Future, str] = {}
+        waiting = list(self._fns)
+        start = time.perf_counter()
+
+        def timed(name: str, kwargs: Dict[str, Any]) -> Any:
+            stage_start = time.perf_counter()
+
+            try:
+                return self._fns[name](**kwargs)
+            finally:
+                elapsed[name] = time.perf_counter() - stage_start
+
+        with ThreadPoolExecutor(max_workers=max(nb_max_workers, 1)) as executor:
+            while waiting or running:
+                for name in [n for n in waiting if all(d in results for d in self._dependencies[n])]:
+                    waiting.remove(name)
+                    kwargs = {d: results[d] for d in self._dependencies[name]}
+                    running[executor.submit(timed, name, kwargs)] = name
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    name = running.pop(future)
+
+                    try:
+                        results[name] = future.result()
+                    except BaseException:
+                        for f in running:
+                            f.cancel()
+
+                        logger.info(
+                            f"Stage {name} failed, not started: {', '.join(waiting) or 'none'}"
+                        )
+                        raise
+
+                if waiting and cancellation_token is not None and cancellation_token.is_cancelled:
+                    # 実行中の段階は自分で RunCancelled を送出するので、新しい段階を始めないだけでよい
+                    logger.info(f"Cancelled, not started: {', '.join(waiting)}")
+                    waiting = []
+
+        raise_if_cancelled(cancellation_token)
+
+        wall_time = time.perf_counter() - start
+
+        logger.info(
+            f"Stages finished in {wall_time:.2f}s (sum of stages: {sum(elapsed.values()):.2f}s), "
+            + ", ".join(f"{n}={t:.2f}s" for n, t in elapsed.items())
+        )
+
+        return results
@@ -1,6 +1,7 @@
-from .section import SRSectionChain
+from .section import SRSectionChain, get_evidence_fingerprint
 
 
 __all__ = [
-    "SRSectionChain"
+    "SRSectionChain",
+    "get_evidence_fingerprint",
 ]
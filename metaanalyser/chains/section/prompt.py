@@ -31,3 +31,20 @@ SECTION_PROMPT = ChatPromptTemplate.from_messages([
     system_prompt,
     human_prompt,
 ])
+
+condense_system_template = "You are a research scientist and intereseted in {categories}. You are working on writing a systematic review regarding \"{query}\"."
+condense_system_prompt = SystemMessagePromptTemplate.from_template(condense_system_template)
+
+condense_human_template = """Take notes from the following list of snippets or abstracts of relative papers, which you will use to write the "{section_title}: {section_description}" section of this systematic review.
+
+-----
+{snippets}
+-----
+
+Write only the facts, methods and findings relevant to this section as a list of brief notes (approximately {nb_words} words maximum in total). Each note should be followed by the citation in the form `[^<ID>]` where `ID` refers to the citation_id of the paper it is based on."""
+condense_human_prompt = HumanMessagePromptTemplate.from_template(condense_human_template)
+
+CONDENSE_PROMPT = ChatPromptTemplate.from_messages([
+    condense_system_prompt,
+    condense_human_prompt,
+])
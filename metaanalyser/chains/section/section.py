@@ -1,32 +1,54 @@
+import hashlib
+import logging
+import numpy as np
 from langchain.base_language import BaseLanguageModel
 from langchain.docstore.document import Document
 from langchain.callbacks.manager import CallbackManagerForChainRun
 from langchain.prompts.base import BasePromptTemplate
-from langchain.vectorstores.base import VectorStore
 from pydantic import BaseModel
 from typing import Any, Dict, List, Optional
 
 from ...paper import (
     Paper,
-    get_abstract_with_token_limit,
     get_categories_string,
 )
+from ...paper.compression import compress_texts
+from ...paper.packing import PackItem, pack_with_token_limit
+from ...paper.vectorstore import PaperVectorStore, similarity_search_with_vectors
 from ..base import (
     SRBaseChain,
+    TokenUsage,
     maybe_retry_with_error_output_parser,
+    run_concurrently,
 )
 from ..outline import Outlint
 from ..overview import Overview
-from .prompt import SECTION_PROMPT
+from ..summary.summary import split_into_batches
+from .prompt import CONDENSE_PROMPT, SECTION_PROMPT
+
+logger = logging.getLogger(__name__)
 
 
 class SRSectionChain(SRBaseChain):
 
-    paper_store: VectorStore
+    paper_store: PaperVectorStore
     prompt: BasePromptTemplate = SECTION_PROMPT
     nb_categories: int = 3
     nb_token_limit: int = 1_500
     nb_max_retry: int = 3
+    # "map_reduce" なら、検索したスニペットを nb_token_limit 毎のまとまりに分けて並列にメモへ要約し、
+    # そのメモからセクションを書く。要約するスニペットは合計 nb_total_token_limit までとする
+    mode: str = "stuff"
+    nb_total_token_limit: int = 6_000
+    nb_max_concurrency: int = 4
+    # スニペットを詰める際の関連度と冗長性の重み、1 なら関連度の順に詰める
+    mmr_lambda: float = 0.7
+    # "compact" なら、プロンプトの目次はこのセクションの周辺のみ説明を付け、overview も縮める
+    context_mode: str = "full"
+    # 1 未満なら、詰める前に各スニペットからセクションとの関連の強い文をこの割合まで残す (compress_texts を参照)
+    compression_ratio: float = 1.0
+    # スニペットの検索方法、"vector", "hybrid" (BM25 と合わせる) か "lexical" (BM25 のみ、埋め込みの API を呼ばない)
+    retrieval_mode: str = "vector"
 
     @property
     def input_keys(self) -> List[str]:
@@ -56,6 +78,16 @@ class SRSectionChain(SRBaseChain):
             inputs["flatten_sections"],
             self.nb_categories,
             self.nb_token_limit,
+            mode=self.mode,
+            nb_total_token_limit=self.nb_total_token_limit,
+            nb_max_concurrency=self.nb_max_concurrency,
+            mmr_lambda=self.mmr_lambda,
+            compression_ratio=self.compression_ratio,
+            retrieval_mode=self.retrieval_mode,
+            context_mode=self.context_mode,
+            token_usage=self.token_usage,
+            evidence=inputs.get("evidence"),
+            verbose=self.verbose,
         )
         return super()._call(input_list, run_manager=run_manager)
 
@@ -75,17 +107,80 @@ class SRSectionChain(SRBaseChain):
             inputs["flatten_sections"],
             self.nb_categories,
             self.nb_token_limit,
+            mode=self.mode,
+            nb_total_token_limit=self.nb_total_token_limit,
+            nb_max_concurrency=self.nb_max_concurrency,
+            mmr_lambda=self.mmr_lambda,
+            compression_ratio=self.compression_ratio,
+            retrieval_mode=self.retrieval_mode,
+            context_mode=self.context_mode,
+            token_usage=self.token_usage,
+            evidence=inputs.get("evidence"),
+            verbose=self.verbose,
         )
         return super()._acall(input_list, run_manager=run_manager)
 
+    def get_evidence(self, section_idx: int, papers: List[Paper], flatten_sections) -> List[str]:
+        """このセクションを書く際に LLM に渡す根拠のスニペットを返す、
+        これを入力の "evidence" に渡せば検索し直さずにセクションを書く
+        """
+        return get_evidence(
+            self.llm,
+            self.paper_store,
+            flatten_sections[section_idx],
+            papers,
+            self.nb_token_limit,
+            mode=self.mode,
+            nb_total_token_limit=self.nb_total_token_limit,
+            mmr_lambda=self.mmr_lambda,
+            compression_ratio=self.compression_ratio,
+            retrieval_mode=self.retrieval_mode,
+        )
+
+
+class SRSectionCondenseChain(SRBaseChain):
+    """セクションを書くためのメモを、スニペットのまとまりから作る
+    """
+
+    prompt: BasePromptTemplate = CONDENSE_PROMPT
+    nb_words: int = 200
+
+    @property
+    def input_keys(self) -> List[str]:
+        return [
+            "query",
+            "categories",
+            "section_title",
+            "section_description",
+            "snippets",
+        ]
+
+    def _call(
+        self,
+        inputs: Dict[str, Any],
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> Dict[str, str]:
+        input_list = [{
+            **{k: inputs[k] for k in self.input_keys},
+            "nb_words": self.nb_words,
+        }]
+        return super()._call(input_list, run_manager=run_manager)
+
 
 class TextSplit(BaseModel):
     """get_input_list 向けのヘルパークラス
+
+    relevance はセクションとの関連度、vector はスニペットの埋め込みで、スニペットを詰める際に使う。
     """
 
     title: str
     citation_id: int
     text: str
+    relevance: float = 1.0
+    vector: Optional[np.ndarray] = None
+
+    class Config:
+        arbitrary_types_allowed = True
 
     @classmethod
     def from_paper(cls, paper: Paper) -> "TextSplit":
@@ -96,17 +191,25 @@ class TextSplit(BaseModel):
         )
 
     @classmethod
-    def from_snippet(cls, snippet: Document) -> "TextSplit":
+    def from_snippet(
+            cls,
+            snippet: Document,
+            paper_metadata: Dict[str, Any],
+            relevance: float = 1.0,
+            vector: Optional[np.ndarray] = None,
+    ) -> "TextSplit":
         return cls(
-            title=snippet.metadata["title"],
-            citation_id=snippet.metadata["citation_id"],
+            title=paper_metadata["title"],
+            citation_id=paper_metadata["citation_id"],
             text=snippet.page_content,
+            relevance=relevance,
+            vector=vector,
         )
 
 
 def get_input_list(
         llm: BaseLanguageModel,
-        paper_store: VectorStore,
+        paper_store: PaperVectorStore,
         section_idx: int,
         query: str,
         papers: List[Paper],
@@ -116,8 +219,136 @@ def get_input_list(
         nb_categories: int,
         nb_token_limit: int,
         max_paper_store_search_size: int = 100,
+        mode: str = "stuff",
+        nb_total_token_limit: int = 6_000,
+        nb_max_concurrency: int = 4,
+        mmr_lambda: float = 0.7,
+        compression_ratio: float = 1.0,
+        retrieval_mode: str = "vector",
+        context_mode: str = "full",
+        token_usage: Optional[TokenUsage] = None,
+        evidence: Optional[List[str]] = None,
+        verbose: bool = False,
 ):
+    """evidence が指定されていなければ、get_evidence でセクションの根拠とするスニペットを検索する
+    """
     section = flatten_sections[section_idx]
+    categories = get_categories_string(papers, nb_categories)
+
+    if evidence is None:
+        evidence = get_evidence(
+            llm,
+            paper_store,
+            section,
+            papers,
+            nb_token_limit,
+            max_paper_store_search_size,
+            mode=mode,
+            nb_total_token_limit=nb_total_token_limit,
+            mmr_lambda=mmr_lambda,
+            compression_ratio=compression_ratio,
+            retrieval_mode=retrieval_mode,
+        )
+
+    if mode == "map_reduce":
+        snippets = condense_snippets(
+            llm,
+            query,
+            categories,
+            section,
+            evidence,
+            nb_token_limit,
+            nb_max_concurrency,
+            verbose,
+        )
+    else:
+        snippets = "\n".join(evidence).strip()
+
+    if context_mode == "compact":
+        overview_context = overview.to_compact_string()
+        outline_context = outline.to_compact_string(section.section)
+    else:
+        overview_context, outline_context = str(overview), str(outline)
+
+    if token_usage is not None:
+        # 全てのセクションのプロンプトで繰り返し送る部分なので、縮めた効果を集計する
+        token_usage.add("context_tokens", llm.get_num_tokens(overview_context + outline_context))
+        token_usage.add("full_context_tokens", llm.get_num_tokens(f"{overview}{outline}"))
+
+    return [{
+        "query": query,
+        "title": overview.title,
+        "overview": overview_context,
+        "section_title": section.section.title,
+        "section_description": section.section.description,
+        "section_level": section.level,
+        "md_title_suffix": "#" * section.level,
+        "outline": outline_context,
+        "categories": categories,
+        "snippets": snippets,
+    }]
+
+
+def get_evidence(
+        llm: BaseLanguageModel,
+        paper_store: PaperVectorStore,
+        section,
+        papers: List[Paper],
+        nb_token_limit: int,
+        max_paper_store_search_size: int = 100,
+        mode: str = "stuff",
+        nb_total_token_limit: int = 6_000,
+        mmr_lambda: float = 0.7,
+        compression_ratio: float = 1.0,
+        retrieval_mode: str = "vector",
+) -> List[str]:
+    """セクションの根拠として LLM に渡すスニペットを返す
+
+    "map_reduce" なら要約する前の、合計 nb_total_token_limit までのスニペットを返す。
+    compression_ratio が 1 未満なら、各スニペットをセクションと関連の強い文のみに縮めてから詰める。
+    """
+    related_splits = get_related_splits(
+        paper_store,
+        section,
+        papers,
+        max_paper_store_search_size,
+        retrieval_mode,
+    )
+
+    if compression_ratio < 1.0:
+        related_splits = compress_splits(section, related_splits, compression_ratio)
+    limit = nb_total_token_limit if mode == "map_reduce" else nb_token_limit
+
+    return pack_splits(llm, related_splits, limit, mmr_lambda)
+
+
+def compress_splits(section, splits: List[TextSplit], compression_ratio: float) -> List[TextSplit]:
+    texts = compress_texts(
+        f"{section.section.title} {section.section.description}",
+        [split.text for split in splits],
+        compression_ratio,
+    )
+    nb_chars = sum(len(split.text) for split in splits)
+
+    logger.info(
+        f"Compressed {len(splits)} snippets for section `{section.section.title}`"
+        f" from {nb_chars} to {sum(len(t) for t in texts)} characters"
+    )
+
+    return [split.copy(update={"text": text}) for split, text in zip(splits, texts)]
+
+
+def get_evidence_fingerprint(evidence: List[str]) -> str:
+    return hashlib.sha1("\n".join(evidence).encode("utf-8")).hexdigest()
+
+
+def get_related_splits(
+        paper_store: PaperVectorStore,
+        section,
+        papers: List[Paper],
+        max_paper_store_search_size: int,
+        retrieval_mode: str = "vector",
+) -> List[TextSplit]:
     papers_citation_id_map = {p.citation_id: p for p in papers}
 
     if section.section.citation_ids:
@@ -130,46 +361,100 @@ def get_input_list(
         related_splits = [TextSplit.from_paper(p) for p in papers]
 
     related_splits += [
-        TextSplit.from_snippet(snippet) for snippet in
-        paper_store.similarity_search(
+        TextSplit.from_snippet(
+            snippet,
+            paper_store.get_paper_metadata(snippet),
+            relevance=relevance,
+            vector=vector,
+        )
+        for snippet, relevance, vector in similarity_search_with_vectors(
+            paper_store,
             f"{section.section.title} {section.section.description}",
             k=max_paper_store_search_size,
+            retrieval_mode=retrieval_mode,
         )
     ]
 
-    def get_snippet(split: TextSplit):
-        text = split.text.replace("\n", " ")
-        return f"""
+    return related_splits
+
+
+def get_snippet(split: TextSplit) -> str:
+    text = split.text.replace("\n", " ")
+    return f"""
 Title: {split.title}
 citation_id: {split.citation_id}
 Text: {text}
 """
 
-    snippets = []
-    total_num_tokens = 0
-    idx = 0
 
-    while idx < len(related_splits):
-        split = related_splits[idx]
-        snippet_text = get_snippet(split)
-        num_tokens = llm.get_num_tokens(snippet_text)
+def pack_splits(
+        llm: BaseLanguageModel,
+        splits: List[TextSplit],
+        nb_token_limit: int,
+        mmr_lambda: float,
+) -> List[str]:
+    """関連度と、既に選んだスニペットとの冗長性 (埋め込みの類似度と、同じ論文かどうか) を釣り合わせながら
+    nb_token_limit に収まるだけスニペットを詰める
+    """
+    snippets = [get_snippet(split) for split in splits]
+    items = [
+        PackItem(
+            text=snippet,
+            num_tokens=llm.get_num_tokens(snippet),
+            relevance=split.relevance,
+            vector=split.vector,
+            group=split.citation_id,
+        )
+        for split, snippet in zip(splits, snippets)
+    ]
 
-        if total_num_tokens + num_tokens > nb_token_limit:
-            break
+    return [snippets[idx] for idx in pack_with_token_limit(items, nb_token_limit, mmr_lambda)]
 
-        snippets.append(snippet_text)
-        total_num_tokens += num_tokens
-        idx += 1
 
-    return [{
-        "query": query,
-        "title": overview.title,
-        "overview": overview,
-        "section_title": section.section.title,
-        "section_description": section.section.description,
-        "section_level": section.level,
-        "md_title_suffix": "#" * section.level,
-        "outline": outline,
-        "categories": get_categories_string(papers, nb_categories),
-        "snippets": "\n".join(snippets).strip(),
-    }]
+def get_snippets_with_token_limit(
+        llm: BaseLanguageModel,
+        snippets: List[str],
+        nb_token_limit: int,
+) -> List[str]:
+    items = [PackItem(text=s, num_tokens=llm.get_num_tokens(s)) for s in snippets]
+    return [snippets[idx] for idx in sorted(pack_with_token_limit(items, nb_token_limit))]
+
+
+def condense_snippets(
+        llm: BaseLanguageModel,
+        query: str,
+        categories: str,
+        section,
+        snippets: List[str],
+        nb_token_limit: int,
+        nb_max_concurrency: int,
+        verbose: bool = False,
+) -> str:
+    """snippets を nb_token_limit 毎のまとまりに分け、それぞれを並列にメモへ要約して、
+    nb_token_limit に収まる分のメモを返す
+    """
+    num_tokens = [llm.get_num_tokens(s) for s in snippets]
+    groups = split_into_batches(snippets, num_tokens, nb_token_limit)
+
+    if len(groups) <= 1:
+        return "\n".join(snippets).strip()
+
+    logger.info(
+        f"Condensing {len(snippets)} snippets ({sum(num_tokens)} tokens)"
+        f" in {len(groups)} groups for section `{section.section.title}`"
+    )
+
+    chain = SRSectionCondenseChain(llm=llm, verbose=verbose)
+    notes = run_concurrently(
+        lambda group: chain.run({
+            "query": query,
+            "categories": categories,
+            "section_title": section.section.title,
+            "section_description": section.section.description,
+            "snippets": "\n".join(group).strip(),
+        }).strip(),
+        groups,
+        nb_max_concurrency,
+    )
+
+    return "\n\n".join(get_snippets_with_token_limit(llm, notes, nb_token_limit))
@@ -1,14 +1,30 @@
 import logging
+import time
 from langchain.base_language import BaseLanguageModel
 from langchain.chains.base import Chain
 from langchain.callbacks.manager import CallbackManagerForChainRun
 from pydantic import BaseModel
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple, Union
 
-from ..paper import Paper, search_on_google_scholar, create_papers_vectorstor
+from ..paper import (
+    Paper,
+    PaperVectorStore,
+    create_papers_vectorstor,
+    search_on_google_scholar,
+    stream_papers_vectorstor,
+)
+from ..cancellation import CancellationToken, RunCancelled, raise_if_cancelled
+from ..memory import LRUCache
+from ..paper.vectorstore import get_paper_store_key
+from ..profiling import NullProfiler, StageProfiler, get_profiler
 from .outline import SROutlintChain, Outlint, Section
 from .overview import SROverviewChain, Overview
-from .section import SRSectionChain
+from .base import TokenUsage
+from .report import open_report_writer
+from .scheduler import StageGraph
+from .section import SRSectionChain, get_evidence_fingerprint
+from .state import ReviewState, SectionState, load_review_state, merge_papers, save_review_state
+from .summary import summarize_abstracts
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +33,46 @@ class SRChain(Chain):
 
     llm: BaseLanguageModel
     output_key: str = "text"
+    # 指定されていれば、書き上がったセクションから順にこのファイルへ書き出し、レビューの本文の代わりにこのパスを返す
+    output_path: Optional[str] = None
+    # "partial" なら論文の本文は References の見出しか max_pages ページ目までしか抽出しない
+    extraction_mode: str = "full"
+    max_pages: int = 0
+    # "local" なら引用を SerpApi ではなく arXiv のメタデータから作る
+    citation_source: str = "serpapi"
+    # ベクトルストアのインデックスの種類とそのパラメータ、build_faiss_index を参照
+    index_type: str = "flat"
+    index_params: Dict[str, Any] = {}
+    # 検索する論文数、"map_reduce" なら全ての論文の要約をまとめてから overview と outline を書く
+    nb_papers: int = 10
+    # 指定されていれば、タイトルと要約、被引用数で上位のこの件数の論文のみ本文を取得する (残りは要約を使う)
+    nb_full_text: Optional[int] = None
+    # 真なら、論文の本文の取得から埋め込み、インデックスへの追加までを論文毎に流れ作業で行う
+    # (stream_papers_vectorstor を参照)。overview と outline は本文を待たずに書き始める。
+    # インデックスに論文毎に追加するのは flat と hnsw のみで、ivf と ivfpq は全てのベクトルを溜めてから作る
+    streaming_ingest: bool = False
+    summary_mode: str = "stuff"
+    # "map_reduce" なら検索したスニペットを並列にメモへ要約してから各セクションを書く
+    section_mode: str = "stuff"
+    # "compact" なら各セクションのプロンプトに目次と overview を縮めて渡す
+    section_context_mode: str = "full"
+    # 1 未満なら、各セクションのスニペットを関連の強い文のみに縮めてから詰める
+    section_compression_ratio: float = 1.0
+    # 各セクションのスニペットの検索方法、SRSectionChain の retrieval_mode を参照
+    retrieval_mode: str = "vector"
+    nb_max_concurrency: int = 4
+    # 指定されていれば (か環境変数 METAANALYSER_PROFILE_DIR)、段階毎のプロファイルをここに書き出す
+    profile_dir: Optional[str] = None
+    # 指定されていれば、実行結果をここに保存する。既に同じクエリの結果があれば、新しい論文を追加して
+    # 根拠とするスニペットが変わったセクションのみ書き直す (overview と outline は前回のものを使う)
+    state_path: Optional[str] = None
+    # 指定されていなければ環境変数 OPENAI_API_KEY と SERPAPI_API_KEY のキーを使う、
+    # 一つのプロセスで複数のキーを使う場合は llm も with_openai_api_key で同じキーを使うようにする
+    openai_api_key: Optional[str] = None
+    serpapi_api_key: Optional[str] = None
+    # 指定されていれば、作ったベクトルストアを本文を取得した論文と共にここに保持し、同じ論文から同じ作り方で
+    # 作る場合 (常駐するサービスで同じクエリのレビューを書き直す場合など) は本文の取得や埋め込みをやり直さない
+    paper_store_cache: Optional[LRUCache] = None
 
     @property
     def input_keys(self) -> List[str]:
@@ -31,46 +87,257 @@ class SRChain(Chain):
         inputs: Dict[str, Any],
         run_manager: Optional[CallbackManagerForChainRun] = None,
     ) -> Dict[str, str]:
-        query = inputs["query"]
-        logger.info(f"Searching `{query}` on Google Scholar.")
-        papers = search_on_google_scholar(query)
+        """inputs に "cancellation_token" (CancellationToken) が渡されていれば、
+        それが取り消された時点で後続の処理を止めて RunCancelled を送出する
+        """
+        profiler = get_profiler(self.profile_dir)
+        cancellation_token = inputs.get("cancellation_token")
+        start = time.perf_counter()
 
-        logger.info(f"Writing an overview of the paper.")
-        overview_chain = SROverviewChain(llm=self.llm, verbose=self.verbose)
-        overview: Overview = overview_chain.run({"query": query, "papers": papers})
+        try:
+            return {self.output_key: self._run(inputs["query"], profiler, cancellation_token)}
+        except RunCancelled as e:
+            logger.warning(
+                f"Run of `{inputs['query']}` is cancelled after {time.perf_counter() - start:.2f}s, "
+                f"reason: {e}"
+            )
+            raise
+        finally:
+            profiler.dump()
 
-        logger.info(f"Building the outline of the paper.")
+    def _run(
+            self,
+            query: str,
+            profiler: Union[StageProfiler, NullProfiler],
+            cancellation_token: Optional[CancellationToken] = None,
+    ) -> str:
+        # ベクトルストアの構築は papers にしか依存しないので、overview と outline の執筆と並行して行う
+        overview_chain = SROverviewChain(llm=self.llm, verbose=self.verbose)
         outline_chain = SROutlintChain(llm=self.llm, verbose=self.verbose)
-        outline: Outlint = outline_chain.run({
-            "query": query,
-            "papers": papers,
-            "overview": overview
-        })
+        state = load_review_state(self.state_path) if self.state_path else None
+
+        if state is not None and state.query != query:
+            logger.warning(
+                f"{self.state_path} is the state of `{state.query}`, writing a review from scratch."
+            )
+            state = None
+
+        def search() -> List[Paper]:
+            logger.info(f"Searching `{query}` on Google Scholar.")
+
+            with profiler.stage("search"):
+                papers = search_on_google_scholar(
+                    query,
+                    n=self.nb_papers,
+                    extraction_mode=self.extraction_mode,
+                    max_pages=self.max_pages,
+                    citation_source=self.citation_source,
+                    cancellation_token=cancellation_token,
+                    nb_full_text=self.nb_full_text,
+                    fetch_text=not self.streaming_ingest,
+                    serpapi_api_key=self.serpapi_api_key,
+                )
+
+            if state is not None:
+                papers = merge_papers(state.papers, papers)
+
+            return papers
+
+        def summarize(papers: List[Paper]) -> str:
+            # overview と outline で同じ要約を使い回す
+            logger.info(f"Summarizing the abstracts of {len(papers)} papers.")
+
+            with profiler.stage("summary"):
+                return summarize_abstracts(
+                    self.llm,
+                    query,
+                    papers,
+                    nb_categories=overview_chain.nb_categories,
+                    nb_token_limit=overview_chain.nb_token_limit,
+                    nb_max_concurrency=self.nb_max_concurrency,
+                    verbose=self.verbose,
+                )
 
-        logger.info(f"Creating vector store.")
-        db = create_papers_vectorstor(papers)
+        def write_overview(papers: List[Paper], abstracts: Optional[str] = None) -> Overview:
+            logger.info(f"Writing an overview of the paper.")
 
-        section_chain = SRSectionChain(llm=self.llm, paper_store=db, verbose=self.verbose)
-        flatten_sections = get_flatten_sections(outline)
-        sections_as_md = []
+            with profiler.stage("overview"):
+                return overview_chain.run({
+                    "query": query,
+                    "papers": papers,
+                    **get_abstracts_inputs(abstracts),
+                })
 
-        for section_idx in range(len(flatten_sections)):
-            logger.info(f"Writing sections: [{section_idx + 1} / {len(flatten_sections)}]")
+        def build_outline(
+                papers: List[Paper],
+                overview: Overview,
+                abstracts: Optional[str] = None,
+        ) -> Outlint:
+            logger.info(f"Building the outline of the paper.")
 
-            sections_as_md.append(
-                section_chain.run({
-                    "section_idx": section_idx,
+            with profiler.stage("outline"):
+                return outline_chain.run({
                     "query": query,
                     "papers": papers,
                     "overview": overview,
-                    "outline": outline,
-                    "flatten_sections": flatten_sections,
+                    **get_abstracts_inputs(abstracts),
                 })
+
+        def create_vectorstore(papers: List[Paper]) -> Tuple[List[Paper], PaperVectorStore]:
+            # streaming_ingest なら papers は本文を持たないので、本文を取得した論文も返してセクションの執筆に使う
+            paper_store_key = get_paper_store_key(
+                query,
+                papers,
+                extraction_mode=self.extraction_mode,
+                max_pages=self.max_pages,
+                nb_full_text=self.nb_full_text,
+                index_type=self.index_type,
+                index_params=self.index_params,
+            )
+
+            if self.paper_store_cache is not None:
+                cached = self.paper_store_cache.get(paper_store_key)
+
+                if cached is not None:
+                    logger.info(f"Reusing the vector store of {len(papers)} papers.")
+                    return cached
+
+            logger.info(f"Creating vector store.")
+
+            with profiler.stage("vectorstore"):
+                if self.streaming_ingest:
+                    papers, paper_store = stream_papers_vectorstor(
+                        query,
+                        papers,
+                        extraction_mode=self.extraction_mode,
+                        max_pages=self.max_pages,
+                        nb_full_text=self.nb_full_text,
+                        index_type=self.index_type,
+                        index_params=self.index_params,
+                        cancellation_token=cancellation_token,
+                        openai_api_key=self.openai_api_key,
+                    )
+                else:
+                    paper_store = create_papers_vectorstor(
+                        papers,
+                        index_type=self.index_type,
+                        index_params=self.index_params,
+                        cancellation_token=cancellation_token,
+                        openai_api_key=self.openai_api_key,
+                    )
+
+            if self.paper_store_cache is not None:
+                self.paper_store_cache.put(paper_store_key, (papers, paper_store))
+
+            return papers, paper_store
+
+        def write_sections(
+                overview: Overview,
+                outline: Outlint,
+                paper_store: Tuple[List[Paper], PaperVectorStore],
+        ) -> str:
+            papers, paper_store = paper_store
+            token_usage = TokenUsage()
+            section_chain = SRSectionChain(
+                llm=self.llm,
+                paper_store=paper_store,
+                mode=self.section_mode,
+                nb_max_concurrency=self.nb_max_concurrency,
+                context_mode=self.section_context_mode,
+                compression_ratio=self.section_compression_ratio,
+                retrieval_mode=self.retrieval_mode,
+                token_usage=token_usage,
+                verbose=self.verbose,
             )
+            flatten_sections = get_flatten_sections(outline)
+            section_states = []
+            nb_reused = 0
+
+            with open_report_writer(self.output_path) as writer:
+                writer.write_header(overview, outline)
+
+                for section_idx, section in enumerate(flatten_sections):
+                    raise_if_cancelled(cancellation_token)
+                    logger.info(f"Writing sections: [{section_idx + 1} / {len(flatten_sections)}]")
+
+                    with profiler.stage("sections"):
+                        evidence = section_chain.get_evidence(section_idx, papers, flatten_sections)
+                        fingerprint = get_evidence_fingerprint(evidence)
+                        previous = (
+                            state.get_section(section_idx, section.section.title)
+                            if state is not None else None
+                        )
+
+                        if previous is not None and previous.fingerprint == fingerprint:
+                            logger.info(f"Evidence of `{section.section.title}` is unchanged, reusing it.")
+                            section_as_md = previous.markdown
+                            nb_reused += 1
+                        else:
+                            section_as_md = section_chain.run({
+                                "section_idx": section_idx,
+                                "query": query,
+                                "papers": papers,
+                                "overview": overview,
+                                "outline": outline,
+                                "flatten_sections": flatten_sections,
+                                "evidence": evidence,
+                            })
+
+                    if self.state_path:
+                        # 書き上げたセクションは保存する場合のみ保持し、それ以外はメモリに溜めない
+                        section_states.append(SectionState(
+                            title=section.section.title,
+                            fingerprint=fingerprint,
+                            markdown=section_as_md,
+                        ))
+
+                    writer.write_section(section_as_md, section.section.citation_ids)
+
+                writer.write_references(papers)
+
+                if state is not None:
+                    logger.info(f"Reused {nb_reused} / {len(flatten_sections)} sections.")
+
+                saved_tokens = token_usage["full_context_tokens"] - token_usage["context_tokens"]
+
+                logger.info(
+                    f"Token usage of {len(flatten_sections)} sections: {token_usage}, "
+                    f"saved by the {self.section_context_mode} context: {saved_tokens} prompt tokens"
+                )
 
-        return {
-            self.output_key: create_output(outline, overview, papers, flatten_sections, sections_as_md)
-        }
+                if self.state_path:
+                    save_review_state(self.state_path, ReviewState(
+                        query=query,
+                        papers=papers,
+                        overview=overview,
+                        outline=outline,
+                        sections=section_states,
+                    ))
+
+                return writer.getvalue() if self.output_path is None else self.output_path
+
+        abstracts_dependencies = []
+        graph = StageGraph().add("papers", search)
+
+        if state is not None:
+            # 前回の目次をそのまま使うことで、セクションを前回のものと対応付けられる
+            graph.add("overview", lambda: state.overview)
+            graph.add("outline", lambda: state.outline)
+        else:
+            if self.summary_mode == "map_reduce":
+                graph.add("abstracts", summarize, ["papers"])
+                abstracts_dependencies = ["abstracts"]
+
+            graph.add("overview", write_overview, ["papers"] + abstracts_dependencies)
+            graph.add("outline", build_outline, ["papers", "overview"] + abstracts_dependencies)
+
+        graph.add("paper_store", create_vectorstore, ["papers"])
+        graph.add("text", write_sections, ["overview", "outline", "paper_store"])
+
+        return graph.run(
+            nb_max_workers=self.nb_max_concurrency,
+            cancellation_token=cancellation_token,
+        )["text"]
 
 
 class FlattenSection(BaseModel):
@@ -105,6 +372,10 @@ def get_flatten_sections(
     ], [])
 
 
+def get_abstracts_inputs(abstracts: Optional[str]) -> Dict[str, str]:
+    return {"abstracts": abstracts} if abstracts is not None else {}
+
+
 def create_output(
         outline: Outlint,
         overview: Overview,
@@ -112,26 +383,12 @@ def create_output(
         flatten_sections: List[FlattenSection],
         sections_as_md: List[str],
 ) -> str:
-    papers_citation_id_map = {p.citation_id: p for p in papers}
-    all_citation_ids = list(set(
-        outline.citations_ids + sum([
-            s.section.citation_ids for s in flatten_sections
-        ], [])
-    ))
-
-    citations = []
-
-    for citation_id in all_citation_ids:
-        citation = papers_citation_id_map[int(citation_id)]
-        citations.append(
-            f"[^{citation_id}]: "
-            f"[{citation.mla_citiation.snippet}]({citation.link})"
-        )
+    with open_report_writer() as writer:
+        writer.write_header(overview, outline)
+
+        for section, section_as_md in zip(flatten_sections, sections_as_md):
+            writer.write_section(section_as_md, section.section.citation_ids)
+
+        writer.write_references(papers)
 
-    return (
-        f"# {overview.title}\n\n{overview.overview}\n\n"
-        + f"## Table of contents\n\n{outline}\n\n"
-        + "\n\n".join(sections_as_md)
-        + "\n\n## References\n"
-        + "\n\n".join(citations)
-    )
+        return writer.getvalue()
@@ -0,0 +1,94 @@
+import logging
+import os
+import tempfile
+from pydantic import BaseModel
+from typing import List, Optional
+
+from ..paper import Paper
+from .outline import Outlint
+from .overview import Overview
+
+logger = logging.getLogger(__name__)
+
+
+class SectionState(BaseModel):
+    """書き上げたセクションと、その根拠としたスニペットのフィンガープリント
+    """
+
+    title: str
+    fingerprint: str
+    markdown: str
+
+
+class ReviewState(BaseModel):
+    """前回の実行結果、同じクエリのレビューを更新する際に使う
+    """
+
+    query: str
+    papers: List[Paper]
+    overview: Overview
+    outline: Outlint
+    sections: List[SectionState]
+
+    def get_section(self, section_idx: int, title: str) -> Optional[SectionState]:
+        if section_idx < len(self.sections) and self.sections[section_idx].title == title:
+            return self.sections[section_idx]
+
+        return None
+
+
+def load_review_state(path: str) -> Optional[ReviewState]:
+    if not os.path.exists(path):
+        return None
+
+    return ReviewState.parse_file(path)
+
+
+def save_review_state(path: str, state: ReviewState):
+    dir_name = os.path.dirname(path) or "."
+    os.makedirs(dir_name, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name, suffix=".tmp")
+
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(state.json(ensure_ascii=False))
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def merge_papers(previous_papers: List[Paper], papers: List[Paper]) -> List[Paper]:
+    """前回の論文に、今回の検索で新たに見つかった論文を追加する
+
+    前回の論文の citation_id は変えずに (セクションの引用が変わらないように)、新しい論文には続きの citation_id を振る。
+    今回の検索で見つからなかった論文も、既存のセクションが引用しているかもしれないので残す。
+    今回の論文が本文を持たなければ (本文を取得せずに検索した場合など)、前回取得した本文を引き継ぐ。
+    """
+    def merge(previous: Paper, paper: Paper) -> Paper:
+        update = {"citation_id": previous.citation_id}
+
+        if paper.text is None and previous.text is not None:
+            update.update(text=previous.text, extraction=previous.extraction)
+
+        return paper.copy(update=update)
+
+    papers_map = {p.arxiv_id: p for p in papers}
+    result = [
+        merge(p, papers_map[p.arxiv_id]) if p.arxiv_id in papers_map else p
+        for p in previous_papers
+    ]
+    previous_ids = {p.arxiv_id for p in previous_papers}
+    next_citation_id = max((p.citation_id for p in previous_papers), default=0) + 1
+    new_papers = [p for p in papers if p.arxiv_id not in previous_ids]
+
+    for citation_id, p in enumerate(new_papers, start=next_citation_id):
+        result.append(p.copy(update={"citation_id": citation_id}))
+
+    logger.info(
+        f"Number of papers: {len(result)}, new: {len(new_papers)}, "
+        f"no longer found: {len([p for p in previous_papers if p.arxiv_id not in papers_map])}"
+    )
+
+    return result
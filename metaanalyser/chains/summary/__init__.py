@@ -0,0 +1,8 @@
+from .summary import SRSummaryChain, get_abstracts, summarize_abstracts
+
+
+__all__ = [
+    "SRSummaryChain",
+    "get_abstracts",
+    "summarize_abstracts",
+]
@@ -0,0 +1,23 @@
+from langchain.prompts import (
+    ChatPromptTemplate,
+    SystemMessagePromptTemplate,
+    HumanMessagePromptTemplate,
+)
+
+
+system_template = "You are a research scientist and intereseted in {categories}. You are working on writing a systematic review regarding \"{query}\"."
+system_prompt = SystemMessagePromptTemplate.from_template(system_template)
+
+human_template = """Summarize the following list of paper abstracts (or summaries of them) so that the summary can be used to write the systematic review regarding "{query}".
+
+-----
+{abstracts}
+-----
+
+Group papers that address the same topic or approach together, and write a brief summary (approximately {nb_words} words maximum in total) of what they contribute. Every statement of the summary should be followed by the citation_ids of the papers it is based on. Use the following format for each group:
+
+citation_ids: <comma separated citation_ids>
+Summary: <summary of the papers>"""
+human_prompt = HumanMessagePromptTemplate.from_template(human_template)
+
+SUMMARY_PROMPT = ChatPromptTemplate.from_messages([system_prompt, human_prompt])
@@ -0,0 +1,160 @@
+import logging
+from langchain.base_language import BaseLanguageModel
+from langchain.callbacks.manager import CallbackManagerForChainRun
+from langchain.prompts.base import BasePromptTemplate
+from typing import Any, Dict, List, Optional
+
+from ...paper import (
+    Paper,
+    get_abstract,
+    get_abstract_with_token_limit,
+    get_categories_string,
+)
+from ..base import SRBaseChain, run_concurrently
+from .prompt import SUMMARY_PROMPT
+
+logger = logging.getLogger(__name__)
+
+
+class SRSummaryChain(SRBaseChain):
+    """論文の要約のまとまりを、citation_id を保ったまま一つの要約にまとめる
+
+    map-reduce の map と reduce のどちらにも使う。
+    """
+
+    prompt: BasePromptTemplate = SUMMARY_PROMPT
+    nb_words: int = 200
+
+    @property
+    def input_keys(self) -> List[str]:
+        return ["query", "categories", "abstracts"]
+
+    def _call(
+        self,
+        inputs: Dict[str, Any],
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> Dict[str, str]:
+        input_list = [{
+            "query": inputs["query"],
+            "categories": inputs["categories"],
+            "abstracts": inputs["abstracts"],
+            "nb_words": self.nb_words,
+        }]
+        return super()._call(input_list, run_manager=run_manager)
+
+
+def get_abstracts(
+        llm: BaseLanguageModel,
+        query: str,
+        papers: List[Paper],
+        nb_categories: int,
+        nb_token_limit: int,
+        mode: str = "stuff",
+        nb_map_batch_token_limit: int = 2_000,
+        nb_max_concurrency: int = 4,
+        verbose: bool = False,
+) -> str:
+    """プロンプトに含める論文の要約を返す
+
+    mode が "stuff" なら nb_token_limit に収まる分だけ要約を並べ、残りは捨てる。
+    "map_reduce" なら summarize_abstracts で全ての論文の要約をまとめる。
+    """
+    if mode == "map_reduce":
+        return summarize_abstracts(
+            llm,
+            query,
+            papers,
+            nb_categories,
+            nb_token_limit,
+            nb_batch_token_limit=nb_map_batch_token_limit,
+            nb_max_concurrency=nb_max_concurrency,
+            verbose=verbose,
+        )
+
+    return get_abstract_with_token_limit(llm, papers, nb_token_limit)
+
+
+def summarize_abstracts(
+        llm: BaseLanguageModel,
+        query: str,
+        papers: List[Paper],
+        nb_categories: int,
+        nb_token_limit: int,
+        nb_batch_token_limit: int = 2_000,
+        nb_max_concurrency: int = 4,
+        nb_max_depth: int = 3,
+        verbose: bool = False,
+) -> str:
+    """論文の要約を階層的に map-reduce して、nb_token_limit に収まる一つのテキストにまとめる
+
+    要約を nb_batch_token_limit 毎のバッチに分けて並列に要約し (map)、その結果がまだ
+    nb_token_limit に収まらなければ、それらをさらにバッチに分けて要約する (reduce) ことを繰り返す。
+    nb_max_depth 回繰り返しても収まらない場合は、収まる分だけを返す。
+    """
+    chain = SRSummaryChain(llm=llm, verbose=verbose)
+    categories = get_categories_string(papers, nb_categories)
+    texts = [get_abstract(p).strip() for p in papers]
+
+    def summarize(batch: List[str]) -> str:
+        return chain.run({
+            "query": query,
+            "categories": categories,
+            "abstracts": "\n\n".join(batch),
+        }).strip()
+
+    for depth in range(nb_max_depth):
+        num_tokens = [llm.get_num_tokens(t) for t in texts]
+
+        if sum(num_tokens) <= nb_token_limit:
+            break
+
+        batches = split_into_batches(texts, num_tokens, nb_batch_token_limit)
+
+        logger.info(
+            f"Summarizing {len(texts)} texts ({sum(num_tokens)} tokens)"
+            f" in {len(batches)} batches, depth: {depth}"
+        )
+
+        texts = run_concurrently(summarize, batches, nb_max_concurrency)
+
+    summaries = []
+    total_num_tokens = 0
+
+    for text in texts:
+        num_tokens = llm.get_num_tokens(text)
+
+        if total_num_tokens + num_tokens > nb_token_limit:
+            logger.warning(
+                f"Summaries exceed the token limit after {nb_max_depth} reductions,"
+                f" dropping {len(texts) - len(summaries)} of them"
+            )
+            break
+
+        summaries.append(text)
+        total_num_tokens += num_tokens
+
+    logger.info(
+        f"Number of papers: {len(papers)}, "
+        f"number of tokens: {total_num_tokens}"
+    )
+
+    return "\n\n".join(summaries)
+
+
+def split_into_batches(
+        texts: List[str],
+        num_tokens: List[int],
+        nb_batch_token_limit: int,
+) -> List[List[str]]:
+    batches = [[]]
+    batch_num_tokens = 0
+
+    for text, n in zip(texts, num_tokens):
+        if batches[-1] and batch_num_tokens + n > nb_batch_token_limit:
+            batches.append([])
+            batch_num_tokens = 0
+
+        batches[-1].append(text)
+        batch_num_tokens += n
+
+    return batches
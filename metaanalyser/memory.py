@@ -1,10 +1,262 @@
+import argparse
+import atexit
+import functools
+import logging
 import os
+import threading
+from collections import OrderedDict, defaultdict
 from joblib import Memory
+from joblib.disk import memstr_to_bytes
+from typing import Any, Callable, Dict, Hashable, Optional
 
 
+logger = logging.getLogger(__name__)
+
 CACHE_DIR = os.environ.get(
     "METAANALYSER_CACHE_DIR",
     os.path.join(os.path.relpath(os.path.dirname(__file__)), "..", ".cache")
 )
 
-memory = Memory(CACHE_DIR, verbose=0)
+# キャッシュの容量の上限 (e.g. "10G")、超えたら最後に使われたのが古いものから削除する
+CACHE_BYTES_LIMIT = os.environ.get("METAANALYSER_CACHE_BYTES_LIMIT")
+
+
+class CachedFunction:
+    """joblib の MemorizedFunc を包み、ヒット数とミス数、読み書きしたバイト数を記録する
+
+    ヒットした場合は最終アクセス時刻を更新して、容量制限を超えた時に最近使われたものが残るようにする。
+    """
+
+    def __init__(self, memorized_func, memory: "LRUMemory"):
+        self.memorized_func = memorized_func
+        self.memory = memory
+        functools.update_wrapper(self, memorized_func.func)
+
+    def __call__(self, *args, **kwargs) -> Any:
+        func_id, args_id = self.memorized_func._get_output_identifiers(*args, **kwargs)
+        is_hit = self.memory.store_backend.contains_item([func_id, args_id])
+
+        result = self.memorized_func(*args, **kwargs)
+
+        item_dir = os.path.join(self.memory.store_backend.location, func_id, args_id)
+        nb_bytes = get_dir_size(item_dir)
+
+        if is_hit:
+            output_path = os.path.join(item_dir, "output.pkl")
+
+            if os.path.exists(output_path):
+                os.utime(output_path)
+
+        self.memory.record(func_id, is_hit, nb_bytes)
+
+        if not is_hit:
+            self.memory.maybe_reduce_size(nb_bytes)
+
+        return result
+
+    def __getattr__(self, name: str) -> Any:
+        if name == "memorized_func":
+            raise AttributeError(name)
+
+        return getattr(self.memorized_func, name)
+
+
+class LRUMemory(Memory):
+    """容量の上限と関数毎の統計を持つ joblib の Memory
+
+    容量を確かめるには全てのエントリを列挙する必要があるので、書き込む度には確かめない。
+    前回確かめた容量に書き込んだ分を足していき、それが上限を超えたか、reduce_size_interval 回書き込んだ
+    (他のプロセスも書き込むので) 場合のみ確かめる。全体を上限に収めるのは python -m metaanalyser.memory prune で行う。
+    """
+
+    def __init__(self, *args, reduce_size_interval: int = 100, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reduce_size_interval = reduce_size_interval
+        self.stats: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self._stats_lock = threading.Lock()
+        # 前回確かめた容量に、それ以降に書き込んだバイト数を足したもの、まだ確かめていなければ None
+        self._tracked_bytes: Optional[int] = None
+        self._nb_writes_since_check = 0
+
+    def cache(self, func: Optional[Callable] = None, **kwargs) -> Any:
+        if func is None:
+            return functools.partial(self.cache, **kwargs)
+
+        return CachedFunction(super().cache(func, **kwargs), self)
+
+    def record(self, func_id: str, is_hit: bool, nb_bytes: int):
+        with self._stats_lock:
+            stats = self.stats[func_id]
+
+            if is_hit:
+                stats["hits"] += 1
+                stats["bytes_read"] += nb_bytes
+            else:
+                stats["misses"] += 1
+                stats["bytes_written"] += nb_bytes
+
+    def maybe_reduce_size(self, nb_bytes: int):
+        """nb_bytes を書き込んだ後に呼び、必要な場合のみ reduce_size で容量を上限に収める
+        """
+        if self.bytes_limit is None:
+            return
+
+        with self._stats_lock:
+            self._nb_writes_since_check += 1
+
+            if self._tracked_bytes is not None:
+                self._tracked_bytes += nb_bytes
+
+            needs_check = (
+                self._tracked_bytes is None
+                or self._tracked_bytes > self._get_bytes_limit()
+                or self._nb_writes_since_check >= self.reduce_size_interval
+            )
+
+        if needs_check:
+            self.reduce_size()
+
+    def reduce_size(self):
+        """最後に使われたのが古いものから削除して容量を上限に収め、残った容量を記録する
+        """
+        if self.bytes_limit is None or self.store_backend is None:
+            return
+
+        bytes_limit = self._get_bytes_limit()
+        items = sorted(self.store_backend.get_items(), key=lambda i: i.last_access)
+        nb_bytes = sum(item.size for item in items)
+
+        for item in items:
+            if nb_bytes <= bytes_limit:
+                break
+
+            try:
+                self.store_backend.clear_location(item.path)
+            except OSError:
+                # 他のプロセスが既に削除した
+                pass
+
+            nb_bytes -= item.size
+
+        with self._stats_lock:
+            self._tracked_bytes = nb_bytes
+            self._nb_writes_since_check = 0
+
+    def _get_bytes_limit(self) -> int:
+        if isinstance(self.bytes_limit, str):
+            return memstr_to_bytes(self.bytes_limit)
+
+        return self.bytes_limit
+
+    def log_stats(self):
+        for func_id, stats in self.stats.items():
+            logger.info(
+                f"Cache stats of {func_id}: "
+                + ", ".join(f"{k}={v}" for k, v in stats.items())
+            )
+
+
+class LRUCache:
+    """プロセス内のメモリに値を保持し、最近使われた maxsize 個のみを残すキャッシュ、複数のスレッドから使える
+    """
+
+    def __init__(self, maxsize: int = 8):
+        self.maxsize = maxsize
+        self._items: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._items:
+                return default
+
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items)
+
+
+def get_dir_size(path: str) -> int:
+    try:
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+    except OSError:
+        return 0
+
+
+def get_disk_usage(memory: Memory) -> Dict[str, Dict[str, Any]]:
+    """キャッシュされている関数毎に、エントリ数とバイト数、最終アクセス時刻の範囲を返す
+    """
+    usage = {}
+
+    for item in memory.store_backend.get_items():
+        func_id = os.path.relpath(os.path.dirname(item.path), memory.store_backend.location)
+        func_usage = usage.setdefault(func_id, {
+            "entries": 0,
+            "bytes": 0,
+            "oldest_access": item.last_access,
+            "newest_access": item.last_access,
+        })
+        func_usage["entries"] += 1
+        func_usage["bytes"] += item.size
+        func_usage["oldest_access"] = min(func_usage["oldest_access"], item.last_access)
+        func_usage["newest_access"] = max(func_usage["newest_access"], item.last_access)
+
+    return usage
+
+
+memory = LRUMemory(CACHE_DIR, verbose=0, bytes_limit=CACHE_BYTES_LIMIT)
+atexit.register(memory.log_stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=f"Inspect and prune the cache directory ({CACHE_DIR})."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats", help="show the disk usage of each cached function")
+    prune_parser = subparsers.add_parser(
+        "prune",
+        help="remove least recently used entries until the cache fits the size limit",
+    )
+    prune_parser.add_argument(
+        "--bytes-limit",
+        default=CACHE_BYTES_LIMIT,
+        help="size limit such as 500M or 10G (default: METAANALYSER_CACHE_BYTES_LIMIT)",
+    )
+    subparsers.add_parser("clear", help="remove every entry")
+    args = parser.parse_args()
+
+    if args.command == "prune":
+        if args.bytes_limit is None:
+            parser.error("--bytes-limit or METAANALYSER_CACHE_BYTES_LIMIT is required")
+
+        before = sum(u["bytes"] for u in get_disk_usage(memory).values())
+        memory.store_backend.reduce_store_size(args.bytes_limit)
+        after = sum(u["bytes"] for u in get_disk_usage(memory).values())
+        print(f"Pruned {before - after} bytes, {after} bytes left")
+    elif args.command == "clear":
+        memory.clear(warn=False)
+    else:
+        usage = get_disk_usage(memory)
+
+        for func_id, u in sorted(usage.items(), key=lambda i: -i[1]["bytes"]):
+            print(
+                f"{func_id}: {u['entries']} entries, {u['bytes']} bytes,"
+                f" last access {u['oldest_access']:%Y-%m-%d %H:%M} - {u['newest_access']:%Y-%m-%d %H:%M}"
+            )
+
+        print(f"Total: {sum(u['bytes'] for u in usage.values())} bytes")
+
+
+if __name__ == "__main__":
+    main()
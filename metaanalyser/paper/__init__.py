@@ -1,16 +1,21 @@
 from .paper import (
     Paper,
+    get_abstract,
     get_abstract_with_token_limit,
     get_categories_string,
     search_on_google_scholar,
 )
-from .vectorstore import create_papers_vectorstor
+from .ingest import stream_papers_vectorstor
+from .vectorstore import PaperVectorStore, create_papers_vectorstor
 
 
 __all__ = [
     "Paper",
+    "PaperVectorStore",
     "create_papers_vectorstor",
+    "get_abstract",
     "get_abstract_with_token_limit",
     "get_categories_string",
     "search_on_google_scholar",
+    "stream_papers_vectorstor",
 ]
@@ -0,0 +1,78 @@
+import arxiv
+import re
+from typing import Dict, List, Optional, Tuple
+
+
+def create_local_citations(arxiv_result: arxiv.Result) -> Optional[Dict[str, str]]:
+    """arXiv のメタデータ (著者、タイトル、年、id) から Google Scholar と同じ形式の引用を作る
+
+    SerpApi の google_scholar_cite と同じく、引用の形式名 (MLA, APA, Chicago) から引用への dict を返す。
+    著者かタイトルが取れない場合は None を返すので、呼び出し側で SerpApi にフォールバックする。
+    """
+    authors = [split_name(a.name) for a in arxiv_result.authors if a.name.strip()]
+    title = re.sub(r"\s+", " ", arxiv_result.title or "").strip()
+
+    if not authors or not title:
+        return None
+
+    arxiv_id = re.sub(r"v\d+$", "", arxiv_result.get_short_id())
+    year = arxiv_result.published.year
+    venue = f"arXiv preprint arXiv:{arxiv_id}"
+
+    return {
+        "MLA": format_mla(authors, title, venue, year),
+        "APA": format_apa(authors, title, venue, year),
+        "Chicago": format_chicago(authors, title, venue, year),
+    }
+
+
+def split_name(name: str) -> Tuple[str, str]:
+    """"Timo Schick" を ("Timo", "Schick") に分ける
+    """
+    *first, last = name.strip().split()
+    return " ".join(first), last
+
+
+def format_mla(authors: List[Tuple[str, str]], title: str, venue: str, year: int) -> str:
+    first, last = authors[0]
+    names = f"{last}, {first}" if first else last
+
+    if len(authors) == 2:
+        names += f", and {' '.join(authors[1]).strip()}"
+    elif len(authors) > 2:
+        names += ", et al"
+
+    return f"{names}. \"{title}.\" {venue} ({year})."
+
+
+def format_apa(authors: List[Tuple[str, str]], title: str, venue: str, year: int) -> str:
+    def name(first: str, last: str) -> str:
+        initials = " ".join(f"{n[0]}." for n in re.split(r"[\s]+", first) if n)
+        return f"{last}, {initials}" if initials else last
+
+    names = [name(*a) for a in authors]
+
+    if len(names) == 1:
+        names_str = names[0]
+    elif len(names) <= 7:
+        names_str = ", ".join(names[:-1]) + f", & {names[-1]}"
+    else:
+        names_str = ", ".join(names[:6]) + f", ... & {names[-1]}"
+
+    return f"{names_str} ({year}). {title}. {venue}."
+
+
+def format_chicago(authors: List[Tuple[str, str]], title: str, venue: str, year: int) -> str:
+    first, last = authors[0]
+    names = [f"{last}, {first}" if first else last] + [
+        " ".join(a).strip() for a in authors[1:]
+    ]
+
+    if len(names) > 10:
+        names_str = ", ".join(names[:7]) + ", et al"
+    elif len(names) == 1:
+        names_str = names[0]
+    else:
+        names_str = ", ".join(names[:-1]) + f", and {names[-1]}"
+
+    return f"{names_str}. \"{title}.\" {venue} ({year})."
@@ -0,0 +1,61 @@
+import math
+import re
+from typing import List
+
+from .ranking import bm25_scores, tokenize
+
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9\[(])")
+# 図表への言及や引用だけの文など、セクションの根拠にならない文
+BOILERPLATE_PATTERNS = [
+    re.compile(r"^\s*(fig\.?|figure|table|algorithm)\s*\d+", re.IGNORECASE),
+    re.compile(r"^[\s\d\[\](),;.\-–]*$"),
+    re.compile(r"arxiv:\d{4}\.\d{4,5}", re.IGNORECASE),
+    re.compile(r"https?://"),
+]
+MIN_SENTENCE_TOKENS = 4
+
+
+def split_sentences(text: str) -> List[str]:
+    return [s.strip() for s in SENTENCE_PATTERN.split(text.replace("\n", " ")) if s.strip()]
+
+
+def is_boilerplate(sentence: str) -> bool:
+    return (
+        len(tokenize(sentence)) < MIN_SENTENCE_TOKENS
+        or any(p.search(sentence) for p in BOILERPLATE_PATTERNS)
+    )
+
+
+def compress_texts(query: str, texts: List[str], keep_ratio: float = 0.5) -> List[str]:
+    """texts のそれぞれから query に関連の強い文を残し、元の順に繋げて返す
+
+    LLM は使わず、全ての文を文書とした BM25 で文を採点する。図表への言及などの文を除いてから、
+    各テキストで上位 ceil(文の数 * keep_ratio) 文まで残す (少なくとも一文は残す)。
+    """
+    if keep_ratio >= 1.0:
+        return texts
+
+    texts_sentences = [split_sentences(text) for text in texts]
+    scores = bm25_scores(
+        tokenize(query),
+        [tokenize(s) for sentences in texts_sentences for s in sentences],
+    )
+    results = []
+    offset = 0
+
+    for text, sentences in zip(texts, texts_sentences):
+        sentence_scores = scores[offset:offset + len(sentences)]
+        offset += len(sentences)
+        candidates = [i for i, s in enumerate(sentences) if not is_boilerplate(s)]
+
+        if not candidates:
+            results.append(text)
+            continue
+
+        nb_keep = max(1, math.ceil(len(sentences) * keep_ratio))
+        ranked = sorted(candidates, key=lambda i: -sentence_scores[i])
+        # query の語を一つも含まない文は、他に残す文があれば残さない
+        kept = sorted([i for i in ranked[:nb_keep] if sentence_scores[i] > 0] or ranked[:1])
+        results.append(" ".join(sentences[i] for i in kept))
+
+    return results
@@ -0,0 +1,121 @@
+import glob
+import logging
+import os
+import pickle
+import tempfile
+import numpy as np
+from pydantic import BaseModel
+from typing import TYPE_CHECKING, List, Optional
+
+from ..memory import CACHE_DIR
+
+if TYPE_CHECKING:
+    from .paper import Paper
+
+
+logger = logging.getLogger(__name__)
+
+CORPUS_DIR = os.environ.get(
+    "METAANALYSER_CORPUS_DIR",
+    os.path.join(CACHE_DIR, "corpus")
+)
+
+
+class PaperChunks(BaseModel):
+    """論文本文をチャンクに分割した結果とその埋め込み
+
+    embeddings は行がチャンクに対応する float32 の配列で、まだ埋め込んでいないチャンクの行は NaN となる。
+    """
+
+    texts: List[str]
+    embeddings: Optional[np.ndarray] = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def has_embedding(self, idx: int) -> bool:
+        return self.embeddings is not None and not np.isnan(self.embeddings[idx, 0])
+
+    def set_embeddings(self, indices: List[int], embeddings: np.ndarray):
+        if self.embeddings is None:
+            self.embeddings = np.full(
+                (len(self.texts), embeddings.shape[1]),
+                np.nan,
+                dtype=np.float32,
+            )
+
+        self.embeddings[indices] = embeddings
+
+
+class PaperCorpus:
+    """クエリをまたいで共有する論文のコーパス
+
+    arXiv の id をキーとして、論文のメタデータと本文、チャンク、埋め込みをローカルディスクに一度だけ保存する。
+    citation_id はクエリ毎に振られるものなので、取り出す側で上書きする。
+    """
+
+    def __init__(self, location: str):
+        self.location = location
+
+    def get_paper(self, arxiv_id: str, citation_id: int) -> Optional["Paper"]:
+        from .paper import Paper
+
+        path = os.path.join(self._paper_dir(arxiv_id), "paper.json")
+
+        if not os.path.exists(path):
+            return None
+
+        paper = Paper.parse_file(path)
+        logger.debug(f"Paper {arxiv_id} is found in the corpus")
+
+        return paper.copy(update={"citation_id": citation_id})
+
+    def put_paper(self, arxiv_id: str, paper: "Paper"):
+        # 本文が変わるとチャンクも変わるので、保存済みのチャンクは捨てる
+        for chunks_path in glob.glob(self._chunks_path(arxiv_id, "*")):
+            os.unlink(chunks_path)
+
+        self._write(
+            os.path.join(self._paper_dir(arxiv_id), "paper.json"),
+            paper.json(ensure_ascii=False).encode("utf-8"),
+        )
+
+    def get_chunks(self, arxiv_id: str, chunks_key: str) -> Optional[PaperChunks]:
+        path = self._chunks_path(arxiv_id, chunks_key)
+
+        if not os.path.exists(path):
+            return None
+
+        with open(path, "rb") as f:
+            texts, embeddings = pickle.load(f)
+
+        return PaperChunks(texts=texts, embeddings=embeddings)
+
+    def put_chunks(self, arxiv_id: str, chunks_key: str, chunks: PaperChunks):
+        self._write(
+            self._chunks_path(arxiv_id, chunks_key),
+            pickle.dumps((chunks.texts, chunks.embeddings)),
+        )
+
+    def _paper_dir(self, arxiv_id: str) -> str:
+        # 旧形式の id (e.g. cs/0101001) はスラッシュを含む
+        return os.path.join(self.location, arxiv_id.replace("/", "_"))
+
+    def _chunks_path(self, arxiv_id: str, chunks_key: str) -> str:
+        return os.path.join(self._paper_dir(arxiv_id), f"chunks-{chunks_key}.pkl")
+
+    def _write(self, path: str, content: bytes):
+        # 複数のプロセスから同時に書き込まれても壊れたファイルが見えないようにする
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+corpus = PaperCorpus(CORPUS_DIR)
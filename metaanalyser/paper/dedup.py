@@ -0,0 +1,98 @@
+import re
+import zlib
+import numpy as np
+from collections import defaultdict
+from typing import Dict, List, Set, Tuple
+
+# ハッシュ関数族 (a * x + b) mod p に用いるメルセンヌ素数、積が uint64 に収まるように 31 bit にする
+_MERSENNE_PRIME = np.uint64((1 << 31) - 1)
+
+
+class MinHashDeduplicator:
+    """MinHash と LSH で、それまでに追加したテキストとほぼ重複するテキストを検出する
+
+    テキストは単語の shingle_size-gram の集合として扱い、推定 Jaccard 係数が threshold
+    以上のテキストが既にあれば重複とみなす。
+    """
+
+    def __init__(
+            self,
+            threshold: float = 0.8,
+            num_perm: int = 128,
+            shingle_size: int = 5,
+            seed: int = 1,
+    ):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.nb_bands, self.nb_rows = get_optimal_bands(threshold, num_perm)
+
+        random_state = np.random.RandomState(seed)
+        self._a = random_state.randint(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self._b = random_state.randint(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+
+        self._signatures: List[np.ndarray] = []
+        self._buckets: Dict[Tuple[int, bytes], List[int]] = defaultdict(list)
+
+    def add(self, text: str) -> bool:
+        """text を追加する、既に追加したテキストとほぼ重複していれば追加せずに False を返す
+        """
+        shingles = get_shingles(text, self.shingle_size)
+
+        if not shingles:
+            return True
+
+        signature = self._get_signature(shingles)
+        band_keys = [
+            (band_idx, signature[band_idx * self.nb_rows:(band_idx + 1) * self.nb_rows].tobytes())
+            for band_idx in range(self.nb_bands)
+        ]
+        candidates = {idx for key in band_keys for idx in self._buckets.get(key, [])}
+
+        for idx in candidates:
+            if np.mean(self._signatures[idx] == signature) >= self.threshold:
+                return False
+
+        for key in band_keys:
+            self._buckets[key].append(len(self._signatures))
+
+        self._signatures.append(signature)
+
+        return True
+
+    def _get_signature(self, shingles: Set[str]) -> np.ndarray:
+        hashes = np.array(
+            [zlib.crc32(s.encode("utf-8")) for s in shingles],
+            dtype=np.uint64,
+        ) % _MERSENNE_PRIME
+
+        return (
+            (self._a[:, None] * hashes[None, :] + self._b[:, None]) % _MERSENNE_PRIME
+        ).min(axis=1)
+
+
+def get_shingles(text: str, shingle_size: int) -> Set[str]:
+    words = re.findall(r"\w+", text.lower())
+
+    if len(words) <= shingle_size:
+        return {" ".join(words)} if words else set()
+
+    return {
+        " ".join(words[idx:idx + shingle_size])
+        for idx in range(len(words) - shingle_size + 1)
+    }
+
+
+def get_optimal_bands(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """LSH で候補となる確率が threshold 付近で立ち上がるような、バンド数と各バンドの行数を返す
+    """
+    candidates = [
+        (nb_bands, num_perm // nb_bands)
+        for nb_bands in range(1, num_perm + 1)
+        if num_perm % nb_bands == 0
+    ]
+
+    return min(
+        candidates,
+        key=lambda c: abs((1 / c[0]) ** (1 / c[1]) - threshold)
+    )
@@ -0,0 +1,167 @@
+import arxiv
+import contextlib
+import functools
+import logging
+import os
+import requests
+import tempfile
+import time
+import uuid
+from requests.adapters import HTTPAdapter
+from typing import Iterator, Optional
+from urllib3.util.retry import Retry
+
+
+logger = logging.getLogger(__name__)
+
+# 指定されていれば、ダウンロードした PDF を arXiv の id とバージョンをキーとして保存しておく
+PDF_CACHE_DIR = os.environ.get("METAANALYSER_PDF_CACHE_DIR")
+
+
+@functools.lru_cache(maxsize=None)
+def get_http_session(
+        pool_maxsize: int = 16,
+        nb_max_retry: int = 5,
+        backoff_factor: float = 1.0,
+) -> requests.Session:
+    """keep-alive で接続を使い回す、プロセス内で共有の HTTP セッションを返す
+
+    接続エラーや 429, 5xx のレスポンスは指数的なバックオフを挟んでリトライする。
+    """
+    retry = Retry(
+        total=nb_max_retry,
+        backoff_factor=backoff_factor,
+        status_forcelist=[429, 500, 502, 503, 504],
+    )
+    adapter = HTTPAdapter(pool_maxsize=pool_maxsize, max_retries=retry)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+class IncompleteDownload(IOError):
+    """サーバーがエラーを返さずに、全ての内容を送る前に接続を閉じた
+    """
+
+
+def download_file(
+        url: str,
+        file_path: str,
+        nb_max_resume: int = 5,
+        backoff_factor: float = 1.0,
+        timeout: float = 60.0,
+        chunk_size: int = 1 << 16,
+):
+    """url の内容を file_path にダウンロードする
+
+    途中で接続が切れた場合や、受け取った量が Content-Length (か Content-Range) に満たない場合は、
+    それまでに受け取った分を残して Range リクエストで続きから再開する。
+    途中のファイルは呼び出し毎の名前にするので、同じ file_path に複数のプロセスが同時にダウンロードしても壊れない。
+    """
+    session = get_http_session()
+    part_path = f"{file_path}.{os.getpid()}.{uuid.uuid4().hex[:8]}.part"
+    total_size = None
+
+    try:
+        for nb_resume in range(nb_max_resume + 1):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+            try:
+                with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                    if offset and response.status_code == 416:
+                        if offset == total_size:
+                            # 既に全て受け取っている
+                            break
+
+                        # 受け取った分が全体の大きさと合わないので、最初から受け取り直す
+                        os.remove(part_path)
+                        raise IncompleteDownload(f"Range of {offset} bytes is not satisfiable")
+
+                    response.raise_for_status()
+
+                    # サーバーが Range に対応していなければ最初から受け取り直す
+                    mode = "ab" if offset and response.status_code == 206 else "wb"
+                    total_size = get_total_size(response) or total_size
+
+                    with open(part_path, mode) as f:
+                        for chunk in response.iter_content(chunk_size=chunk_size):
+                            f.write(chunk)
+
+                # urllib3 1.x は Content-Length に満たないまま閉じられても例外を送出しない
+                size = os.path.getsize(part_path)
+
+                if total_size is not None and size != total_size:
+                    raise IncompleteDownload(f"Received {size} of {total_size} bytes")
+
+                break
+            except (
+                    requests.ConnectionError,
+                    requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError,
+                    IncompleteDownload,
+            ) as e:
+                if nb_resume == nb_max_resume:
+                    raise
+
+                wait = backoff_factor * (2 ** nb_resume)
+                received = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+                logger.warning(
+                    f"Download of {url} is interrupted at {received} bytes, "
+                    f"resuming in {wait} seconds, {e}"
+                )
+                time.sleep(wait)
+
+        os.replace(part_path, file_path)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+
+def get_total_size(response: requests.Response) -> Optional[int]:
+    """レスポンスから全体のバイト数を返す、分からなければ None を返す
+    """
+    if response.headers.get("Content-Encoding", "identity") != "identity":
+        # 展開した後の大きさは Content-Length と一致しない
+        return None
+
+    if response.status_code == 206:
+        total = response.headers.get("Content-Range", "").rpartition("/")[2]
+    else:
+        total = response.headers.get("Content-Length", "")
+
+    return int(total) if total.isdigit() else None
+
+
+@contextlib.contextmanager
+def download_arxiv_pdf(
+        arxiv_search_result: arxiv.Result,
+        cache_dir: Optional[str] = PDF_CACHE_DIR,
+) -> Iterator[str]:
+    """arxiv_search_result の PDF をダウンロードしてそのパスを返す
+
+    cache_dir が指定されていればそこに保存し、既に保存されていればダウンロードしない。
+    指定されていなければ一時ディレクトリに保存し、抜ける時に削除する。
+    """
+    # 旧形式の id (e.g. cs/0101001v1) はスラッシュを含む
+    file_name = arxiv_search_result.get_short_id().replace("/", "_") + ".pdf"
+
+    if cache_dir is None:
+        with tempfile.TemporaryDirectory() as d:
+            file_path = os.path.join(d, file_name)
+            download_file(arxiv_search_result.pdf_url, file_path)
+            yield file_path
+        return
+
+    file_path = os.path.join(cache_dir, file_name)
+
+    if not os.path.exists(file_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        download_file(arxiv_search_result.pdf_url, file_path)
+    else:
+        logger.debug(f"{file_name} is found in {cache_dir}")
+
+    yield file_path
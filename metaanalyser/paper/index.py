@@ -0,0 +1,101 @@
+import logging
+import math
+import numpy as np
+from langchain.vectorstores.faiss import dependable_faiss_import
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+INDEX_TYPES = ["flat", "ivf", "hnsw", "ivfpq"]
+
+
+def build_faiss_index(
+        embeddings: np.ndarray,
+        index_type: str = "flat",
+        nlist: Optional[int] = None,
+        nprobe: int = 8,
+        hnsw_m: int = 32,
+        ef_construction: int = 40,
+        ef_search: int = 64,
+        pq_m: int = 16,
+        pq_nbits: int = 8,
+        nb_max_train_samples: int = 50_000,
+        seed: int = 1,
+) -> Any:
+    """embeddings を追加した FAISS のインデックスを作成する
+
+    index_type は以下のいずれか:
+
+    - flat: 全件と距離を計算する厳密なインデックス、小さなコーパス向け
+    - ivf: nlist 個のクラスタに分けて、検索時は nprobe 個のクラスタのみを調べる
+    - hnsw: グラフベースの近似インデックス、検索時は ef_search 個の候補を調べる
+    - ivfpq: ivf に加えてベクトルを pq_m 個の pq_nbits bit の符号に量子化し、メモリを大幅に削減する
+
+    学習が必要なインデックスは、最大 nb_max_train_samples 件をサンプリングして学習する。
+    学習に必要な件数に満たない場合は flat にフォールバックする。
+    """
+    faiss = dependable_faiss_import()
+    nb_vectors, dim = embeddings.shape
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"index_type should be one of {INDEX_TYPES}, got {index_type}")
+
+    if index_type in ("ivf", "ivfpq"):
+        # クラスタ数は件数の平方根程度にし、各クラスタに 39 件以上の学習データが入るようにする
+        nlist = nlist or max(1, min(int(4 * math.sqrt(nb_vectors)), nb_vectors // 39))
+        nb_min_train_samples = nlist if index_type == "ivf" else max(nlist, 2 ** pq_nbits)
+
+        if nb_vectors < nb_min_train_samples or (index_type == "ivfpq" and dim % pq_m != 0):
+            logger.warning(
+                f"Could not build {index_type} index from {nb_vectors} vectors"
+                f" of dimension {dim}, falling back to flat index"
+            )
+            index_type = "flat"
+
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(dim)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, hnsw_m)
+        index.hnsw.efConstruction = ef_construction
+    else:
+        quantizer = faiss.IndexFlatL2(dim)
+
+        if index_type == "ivf":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, pq_nbits)
+
+        random_state = np.random.RandomState(seed)
+        train_indices = random_state.choice(
+            nb_vectors,
+            size=min(nb_vectors, nb_max_train_samples),
+            replace=False,
+        )
+        index.train(embeddings[np.sort(train_indices)])
+
+    index.add(embeddings)
+
+    if index_type in ("ivf", "ivfpq"):
+        # reconstruct (MMR などで使う) のために id からの直接の対応を持たせておく
+        index.make_direct_map()
+
+    set_search_params(index, nprobe=nprobe, ef_search=ef_search)
+
+    logger.info(
+        f"FAISS index is created, {index_type=}, {nb_vectors=}, {dim=}"
+        + (f", {nlist=}" if index_type in ("ivf", "ivfpq") else "")
+    )
+
+    return index
+
+
+def set_search_params(index: Any, nprobe: int = 8, ef_search: int = 64):
+    """検索時の精度と速度のトレードオフを調整する、インデックスの種類に関係のないパラメータは無視する
+    """
+    faiss = dependable_faiss_import()
+
+    if isinstance(index, faiss.IndexIVF):
+        index.nprobe = nprobe
+    elif isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = ef_search
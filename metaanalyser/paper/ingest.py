@@ -0,0 +1,313 @@
+import logging
+import numpy as np
+import queue
+import threading
+import time
+from langchain.embeddings.base import Embeddings
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from ..cancellation import CancellationToken, raise_if_cancelled
+from ..profiling import in_current_stage
+from .corpus import PaperChunks, PaperCorpus, corpus as default_corpus
+from .dedup import MinHashDeduplicator
+from .index import build_faiss_index
+from .paper import Paper, get_paper_with_text, select_full_text_papers
+from .vectorstore import (
+    PaperVectorStore,
+    get_chunks_key,
+    get_embeddings,
+    get_paper_splitter,
+    get_paper_store_metadata,
+    new_paper_store,
+)
+
+logger = logging.getLogger(__name__)
+
+# 学習が必要なので、全てのベクトルが揃うまでインデックスを作れない種類
+TRAINED_INDEX_TYPES = ["ivf", "ivfpq"]
+
+_END = object()
+_STOPPED = object()
+
+
+def run_pipeline(
+        items: Iterable[Any],
+        stages: List[Tuple[str, Callable[[Any], Any]]],
+        nb_queue_size: int = 2,
+        cancellation_token: Optional[CancellationToken] = None,
+) -> Iterator[Any]:
+    """items を stages の関数に順に通し、最後の段階の結果を items の順に返す
+
+    段階毎にスレッドを一つ立て、段階の間は最大 nb_queue_size 件のキューで繋ぐ。後ろの段階が詰まっていれば
+    前の段階はキューが空くまで待つので、先読みする件数は高々 nb_queue_size 件となる。
+    いずれかの段階で例外が起きるか cancellation_token が取り消されると、全ての段階を止めて例外を送出する。
+    """
+    queues = [queue.Queue(maxsize=max(nb_queue_size, 1)) for _ in range(len(stages) + 1)]
+    stop = threading.Event()
+    errors: List[BaseException] = []
+    elapsed: Dict[str, float] = {name: 0.0 for name, _ in stages}
+    start = time.perf_counter()
+
+    def put(q: queue.Queue, item: Any) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def get(q: queue.Queue) -> Any:
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+        return _STOPPED
+
+    def fail(e: BaseException):
+        errors.append(e)
+        stop.set()
+
+    def feed():
+        try:
+            for item in items:
+                raise_if_cancelled(cancellation_token)
+
+                if not put(queues[0], item):
+                    return
+
+            put(queues[0], _END)
+        except BaseException as e:
+            fail(e)
+
+    def work(name: str, fn: Callable[[Any], Any], q_in: queue.Queue, q_out: queue.Queue):
+        try:
+            while True:
+                item = get(q_in)
+
+                if item is _STOPPED:
+                    return
+
+                if item is _END:
+                    put(q_out, _END)
+                    return
+
+                raise_if_cancelled(cancellation_token)
+                stage_start = time.perf_counter()
+                result = fn(item)
+                elapsed[name] += time.perf_counter() - stage_start
+
+                if not put(q_out, result):
+                    return
+        except BaseException as e:
+            fail(e)
+
+    threads = [threading.Thread(target=feed, daemon=True)] + [
+        threading.Thread(
+            target=work,
+            args=(name, in_current_stage(fn), queues[i], queues[i + 1]),
+            daemon=True,
+        )
+        for i, (name, fn) in enumerate(stages)
+    ]
+
+    for t in threads:
+        t.start()
+
+    try:
+        while True:
+            item = get(queues[-1])
+
+            if item is _END or item is _STOPPED:
+                break
+
+            yield item
+    finally:
+        # 途中で読むのを止められた場合も、残りの段階を止める
+        stop.set()
+
+        for t in threads:
+            t.join()
+
+    if errors:
+        raise errors[0]
+
+    logger.info(
+        f"Pipeline finished in {time.perf_counter() - start:.2f}s "
+        f"(sum of stages: {sum(elapsed.values()):.2f}s), "
+        + ", ".join(f"{n}={t:.2f}s" for n, t in elapsed.items())
+    )
+
+
+class PaperStoreBuilder:
+    """論文毎にチャンクと埋め込みを受け取り、ベクトルストアを少しずつ作る
+
+    flat と hnsw のインデックスには届いた順にベクトルを追加する。ivf と ivfpq は学習に全体のベクトルが
+    必要なので build まで溜めておき、まとめて build_faiss_index で作る。
+    """
+
+    def __init__(
+            self,
+            embeddings: Embeddings,
+            index_type: str = "flat",
+            index_params: Optional[Dict[str, Any]] = None,
+    ):
+        self.embeddings = embeddings
+        self.index_type = index_type
+        self.index_params = index_params or {}
+        self.index = None
+        self.texts: List[str] = []
+        self.metadatas: List[Dict[str, Any]] = []
+        self.papers_metadata: Dict[str, Dict[str, Any]] = {}
+        self._buffer: List[np.ndarray] = []
+
+    def add(self, paper: Paper, chunks: PaperChunks, indices: List[int]):
+        self.papers_metadata[paper.arxiv_id] = get_paper_store_metadata(paper)
+
+        if not indices:
+            return
+
+        vectors = np.ascontiguousarray(chunks.embeddings[indices], dtype=np.float32)
+        self.texts += [chunks.texts[idx] for idx in indices]
+        self.metadatas += [{"paper_key": paper.arxiv_id, "offset": idx} for idx in indices]
+
+        if self.index_type in TRAINED_INDEX_TYPES:
+            self._buffer.append(vectors)
+        elif self.index is None:
+            self.index = build_faiss_index(vectors, index_type=self.index_type, **self.index_params)
+        else:
+            self.index.add(vectors)
+
+    def build(self) -> PaperVectorStore:
+        if not self.texts:
+            raise ValueError("No chunks to index")
+
+        if self.index_type in TRAINED_INDEX_TYPES:
+            self.index = build_faiss_index(
+                np.concatenate(self._buffer),
+                index_type=self.index_type,
+                **self.index_params,
+            )
+            self._buffer = []
+
+        return new_paper_store(
+            self.embeddings,
+            self.index,
+            self.texts,
+            self.metadatas,
+            self.papers_metadata,
+        )
+
+
+def stream_papers_vectorstor(
+        query: str,
+        papers: List[Paper],
+        extraction_mode: str = "full",
+        max_pages: int = 0,
+        nb_full_text: Optional[int] = None,
+        citation_weight: float = 0.3,
+        tiktoken_encoder_model_name: str = "gpt-3.5-turbo",
+        chunk_size: int = 150,
+        chunk_overlap: int = 10,
+        corpus: Optional[PaperCorpus] = default_corpus,
+        deduplicate: bool = True,
+        dedup_threshold: float = 0.8,
+        index_type: str = "flat",
+        index_params: Optional[Dict[str, Any]] = None,
+        nb_queue_size: int = 2,
+        cancellation_token: Optional[CancellationToken] = None,
+        openai_api_key: Optional[str] = None,
+) -> Tuple[List[Paper], PaperVectorStore]:
+    """search_on_google_scholar(..., fetch_text=False) で集めた papers の本文の取得と分割、埋め込み、
+    インデックスへの追加を論文毎に流れ作業で行い、本文を持った papers とベクトルストアを返す
+
+    ある論文の PDF をダウンロードしている間に前の論文を埋め込むので、全体の時間は各段階の和ではなく
+    最も遅い段階の時間に近づく。本文を取得する論文の選び方とチャンクの重複除去、コーパスの再利用は
+    search_on_google_scholar と create_papers_vectorstor と同じ。埋め込みの API は論文毎に呼ぶ。
+
+    論文毎にインデックスへ追加するのは index_type が flat か hnsw の場合のみで、ivf と ivfpq は学習に全ての
+    ベクトルが必要なので、最後の論文が届くまで全ての埋め込みをメモリに溜めてからインデックスを作る。
+    """
+    split_paper = get_paper_splitter(tiktoken_encoder_model_name, chunk_size, chunk_overlap)
+    embeddings = get_embeddings(openai_api_key)
+    chunks_key = get_chunks_key(embeddings, tiktoken_encoder_model_name, chunk_size, chunk_overlap)
+    deduplicator = MinHashDeduplicator(threshold=dedup_threshold) if deduplicate else None
+    full_text_indices = select_full_text_papers(query, papers, nb_full_text, citation_weight)
+    stats = {"nb_from_corpus": 0, "nb_chunks": 0, "nb_kept_chunks": 0, "nb_embedded": 0}
+
+    logger.info(
+        f"Streaming {len(papers)} papers into vector store,"
+        f" {tiktoken_encoder_model_name=}"
+        f", {chunk_size=}, {chunk_overlap=}, {index_type=}, {nb_queue_size=}"
+    )
+
+    def fetch(item: Tuple[int, Paper]) -> Paper:
+        idx, paper = item
+
+        if idx in full_text_indices:
+            return get_paper_with_text(paper, extraction_mode, max_pages, corpus)
+
+        return paper
+
+    def chunk(paper: Paper) -> Tuple[Paper, PaperChunks, List[int]]:
+        chunks = corpus.get_chunks(paper.arxiv_id, chunks_key) if corpus is not None else None
+
+        if chunks is None:
+            chunks = split_paper(paper)
+        else:
+            stats["nb_from_corpus"] += 1
+
+        if deduplicator is not None:
+            # 論文は検索順に流れてくるので、先に現れた (検索順位の高い論文の) チャンクを残す
+            indices = [idx for idx, text in enumerate(chunks.texts) if deduplicator.add(text)]
+        else:
+            indices = list(range(len(chunks.texts)))
+
+        stats["nb_chunks"] += len(chunks.texts)
+        stats["nb_kept_chunks"] += len(indices)
+
+        return paper, chunks, indices
+
+    def embed(item: Tuple[Paper, PaperChunks, List[int]]) -> Tuple[Paper, PaperChunks, List[int]]:
+        paper, chunks, indices = item
+        targets = [idx for idx in indices if not chunks.has_embedding(idx)]
+
+        if targets:
+            chunks.set_embeddings(
+                targets,
+                np.array(embeddings.embed_documents([chunks.texts[idx] for idx in targets]), dtype=np.float32),
+            )
+            stats["nb_embedded"] += len(targets)
+
+            if corpus is not None:
+                corpus.put_chunks(paper.arxiv_id, chunks_key, chunks)
+
+        return paper, chunks, indices
+
+    builder = PaperStoreBuilder(embeddings, index_type, index_params)
+    papers_with_text = []
+
+    for paper, chunks, indices in run_pipeline(
+            enumerate(papers),
+            [("fetch", fetch), ("chunk", chunk), ("embed", embed)],
+            nb_queue_size,
+            cancellation_token,
+    ):
+        builder.add(paper, chunks, indices)
+        papers_with_text.append(paper)
+
+    raise_if_cancelled(cancellation_token)
+    db = builder.build()
+
+    logger.info(
+        f"Vector store is created from {len(papers)} papers"
+        f" ({stats['nb_from_corpus']} chunked papers found in the corpus),"
+        f" removed {stats['nb_chunks'] - stats['nb_kept_chunks']} near-duplicate chunks"
+        f" out of {stats['nb_chunks']}, embedded {stats['nb_embedded']} chunks,"
+        f" document size={len(builder.texts)}"
+    )
+
+    return papers_with_text, db
@@ -0,0 +1,100 @@
+import logging
+import numpy as np
+from pydantic import BaseModel
+from typing import Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class PackItem(BaseModel):
+    """プロンプトに詰めるテキスト
+
+    relevance はクエリとの関連度 (大きいほど関連する)、vector はテキストの埋め込みで冗長性の判定に使う。
+    group が同じテキスト同士 (e.g. 同じ論文のチャンク) は、vector がなくても same_group_similarity だけ似ているとみなす。
+    """
+
+    text: str
+    num_tokens: int
+    relevance: float = 1.0
+    vector: Optional[np.ndarray] = None
+    group: Optional[Any] = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+
+def pack_with_token_limit(
+        items: List[PackItem],
+        limit: int,
+        mmr_lambda: float = 1.0,
+        same_group_similarity: float = 0.5,
+) -> List[int]:
+    """合計トークン数が limit に収まるよう items を選び、選んだ順に items の添字を返す
+
+    Maximal Marginal Relevance で、各段階で残りの予算に収まるテキストのうち
+    mmr_lambda * 関連度 - (1 - mmr_lambda) * 選択済みのテキストとの最大の類似度 が最大のものを選ぶ。
+    予算を超えるテキストは飛ばして次を試すので、予算を最後まで使い切れる。
+    mmr_lambda が 1 なら関連度の順 (同じなら items の順) に詰める。
+    """
+    if not items:
+        return []
+
+    num_tokens = np.array([i.num_tokens for i in items])
+    relevance = np.array([i.relevance for i in items], dtype=np.float32)
+    similarities = get_similarity_matrix(items, same_group_similarity)
+    max_similarity = np.zeros(len(items), dtype=np.float32)
+    is_candidate = np.ones(len(items), dtype=bool)
+    selected = []
+    remaining = limit
+
+    while True:
+        fits = is_candidate & (num_tokens <= remaining)
+
+        if not fits.any():
+            break
+
+        scores = mmr_lambda * relevance - (1 - mmr_lambda) * max_similarity
+        scores[~fits] = -np.inf
+        idx = int(np.argmax(scores))
+
+        selected.append(idx)
+        is_candidate[idx] = False
+        remaining -= num_tokens[idx]
+        max_similarity = np.maximum(max_similarity, similarities[idx])
+
+    nb_tokens = limit - remaining
+
+    logger.info(
+        f"Packed {len(selected)} / {len(items)} texts, "
+        f"{nb_tokens} / {limit} tokens (packing ratio: {nb_tokens / max(limit, 1):.1%})"
+    )
+
+    return selected
+
+
+def get_similarity_matrix(items: List[PackItem], same_group_similarity: float) -> np.ndarray:
+    dims = {i.vector.shape[-1] for i in items if i.vector is not None}
+    similarities = np.zeros((len(items), len(items)), dtype=np.float32)
+
+    if len(dims) == 1:
+        vectors = np.zeros((len(items), dims.pop()), dtype=np.float32)
+
+        for idx, item in enumerate(items):
+            if item.vector is not None:
+                norm = np.linalg.norm(item.vector)
+                vectors[idx] = item.vector / norm if norm > 0 else 0
+
+        similarities = vectors @ vectors.T
+
+    if any(i.group is not None for i in items):
+        same_group = np.array([
+            [a.group is not None and a.group == b.group for b in items]
+            for a in items
+        ])
+        similarities = np.where(
+            same_group,
+            np.maximum(similarities, same_group_similarity),
+            similarities,
+        )
+
+    return similarities
@@ -2,17 +2,25 @@ import arxiv
 import datetime
 import logging
 import re
-import tempfile
 from collections import Counter
 from langchain.base_language import BaseLanguageModel
 from langchain.utilities import SerpAPIWrapper
-from pdfminer.high_level import extract_text
+from pdfminer.high_level import extract_pages, extract_text
+from pdfminer.layout import LTTextContainer
+from pdfminer.pdfpage import PDFPage
 from pydantic import BaseModel
 from tqdm.auto import tqdm
-from typing import List, Optional
+from typing import List, Optional, Set, Tuple
 
+from ..cancellation import CancellationToken, raise_if_cancelled
 from ..memory import memory
+from ..profiling import get_profiler
 from .arxiv_categories import CATEGORY_NAME_ID_MAP
+from .citation import create_local_citations
+from .corpus import PaperCorpus, corpus as default_corpus
+from .download import download_arxiv_pdf
+from .packing import PackItem, pack_with_token_limit
+from .ranking import rank_papers
 
 
 logger = logging.getLogger(__name__)
@@ -40,17 +48,26 @@ class GoogleScholarItem(BaseModel):
             return mla[0]
 
     @classmethod
-    def from_google_scholar_result(cls, result):
+    def from_google_scholar_result(
+            cls,
+            result,
+            citations: Optional[List[Citation]] = None,
+            serpapi_api_key: Optional[str] = None,
+    ):
+        """citations が指定されていなければ SerpApi の google_scholar_cite で引用を取得する
+        """
         result_id = result["result_id"]
         link = result["link"] if "link" in result else ""
         nb_cited = (
             result["inline_links"]["cited_by"]["total"]
             if "cited_by" in result["inline_links"] else 0
         )
-        citations = [
-            Citation(title=c["title"], snippet=c["snippet"]) for c in
-            fetch_google_scholar_cite(result_id)["citations"]
-        ]
+
+        if citations is None:
+            citations = [
+                Citation(title=c["title"], snippet=c["snippet"]) for c in
+                fetch_google_scholar_cite(result_id, serpapi_api_key)["citations"]
+            ]
 
         return cls(
             result_id=result_id,
@@ -61,6 +78,18 @@ class GoogleScholarItem(BaseModel):
         )
 
 
+class TextExtraction(BaseModel):
+    """本文を部分的に抽出した場合の、抽出した範囲
+
+    stopped_at は抽出を打ち切った理由で、"references" (References や Bibliography の見出し)
+    か "page_limit" (max_pages より後のページを読み飛ばした)、最後のページまで抽出した場合は None となる。
+    """
+
+    max_pages: int
+    nb_pages: int
+    stopped_at: Optional[str]
+
+
 class Paper(BaseModel):
     """論文を表す、Google Scholar で得られる情報に追加して doi や要約などのフィールドを持つ
 
@@ -74,8 +103,11 @@ class Paper(BaseModel):
     published: datetime.datetime
     primary_category: str
     categories: List[str]
-    text: str
+    # search_on_google_scholar で本文を取得しなかった論文は None で、本文の代わりに要約を使う
+    text: Optional[str]
     doi: Optional[str]
+    # 本文を部分的に抽出した場合のみ記録する
+    extraction: Optional[TextExtraction] = None
 
     @property
     def google_scholar_result_id(self):
@@ -101,10 +133,47 @@ class Paper(BaseModel):
     def mla_citiation(self) -> str:
         return self.google_scholar_item.mla_citiation
 
+    @property
+    def arxiv_id(self) -> str:
+        return get_arxiv_id(self.link)
+
     @classmethod
-    def from_google_scholar_result(cls, citation_id, result):
-        google_scholar_item = GoogleScholarItem.from_google_scholar_result(result)
-        arxiv_result = fetch_arxiv_result(google_scholar_item.link)
+    def from_google_scholar_result(
+            cls,
+            citation_id,
+            result,
+            extraction_mode: str = "full",
+            max_pages: int = 0,
+            citation_source: str = "serpapi",
+            fetch_text: bool = True,
+            serpapi_api_key: Optional[str] = None,
+    ):
+        """citation_source に "local" を指定すると、引用は SerpApi に問合せずに arXiv のメタデータから作る
+        fetch_text が偽なら PDF はダウンロードせず、本文は None とする
+        serpapi_api_key が None なら環境変数 SERPAPI_API_KEY のキーを使う
+        """
+        arxiv_result = fetch_arxiv_result(result["link"])
+        citations = None
+
+        if citation_source == "local":
+            local_citations = create_local_citations(arxiv_result)
+
+            if local_citations is not None:
+                citations = [
+                    Citation(title=title, snippet=snippet)
+                    for title, snippet in local_citations.items()
+                ]
+            else:
+                logger.warning(
+                    f"Could not create citations of {arxiv_result.entry_id} locally, "
+                    "falling back to SerpApi."
+                )
+
+        google_scholar_item = GoogleScholarItem.from_google_scholar_result(
+            result,
+            citations=citations,
+            serpapi_api_key=serpapi_api_key,
+        )
 
         def get_category(c):
             if c not in CATEGORY_NAME_ID_MAP:
@@ -118,6 +187,11 @@ class Paper(BaseModel):
             if c
         ]
 
+        if fetch_text:
+            text, extraction = get_text(arxiv_result, extraction_mode, max_pages)
+        else:
+            text, extraction = None, None
+
         return cls(
             citation_id=citation_id,
             google_scholar_item=google_scholar_item,
@@ -127,9 +201,16 @@ class Paper(BaseModel):
             primary_category=primary_category,
             categories=categories,
             doi=arxiv_result.doi,
-            text=get_text_from_arxiv_search_result(arxiv_result),
+            text=text,
+            extraction=extraction,
         )
 
+    def with_text(self, extraction_mode: str = "full", max_pages: int = 0) -> "Paper":
+        """PDF から本文を抽出した Paper を返す
+        """
+        text, extraction = get_text(fetch_arxiv_result(self.link), extraction_mode, max_pages)
+        return self.copy(update={"text": text, "extraction": extraction})
+
     def _repr_html_(self):
         def get_category_string():
             # 基本的に categories の先頭が primary_category らしい
@@ -159,10 +240,40 @@ def search_on_google_scholar(
         query: str,
         approved_domains: List[str] = ["arxiv.org"],
         n: int = 10,
+        corpus: Optional[PaperCorpus] = default_corpus,
+        extraction_mode: str = "full",
+        max_pages: int = 0,
+        profile_dir: Optional[str] = None,
+        citation_source: str = "serpapi",
+        cancellation_token: Optional[CancellationToken] = None,
+        nb_full_text: Optional[int] = None,
+        citation_weight: float = 0.3,
+        fetch_text: bool = True,
+        serpapi_api_key: Optional[str] = None,
 ) -> List[Paper]:
     """query で SerpApi の Google Scholar API に問合せた結果を返す。
     approved_domains に指定されたドメインの論文のみを対象とする。
     最大 n に指定された件数を返却する。
+    corpus に既に取り込まれている論文はそちらから取り出し、取り込まれていない論文のみを取得する。
+
+    extraction_mode に "partial" を指定すると、本文は References の見出しか max_pages ページ目
+    (0 なら制限なし) までしか抽出しない。
+
+    profile_dir (か環境変数 METAANALYSER_PROFILE_DIR) が指定されていれば、検索と論文の詳細の取得の
+    それぞれのプロファイルをそこに書き出す。
+
+    citation_source に "local" を指定すると、引用 (MLA など) を arXiv のメタデータから作り、
+    作れなかった論文のみ SerpApi に問合せる。
+
+    cancellation_token が取り消されると、検索や論文の取得の区切りで RunCancelled を送出する。
+
+    nb_full_text が指定されていれば、まず全ての論文をタイトルと要約、被引用数で順位付けし (rank_papers を参照)、
+    上位 nb_full_text 件の論文のみ PDF をダウンロードして本文を抽出する。それ以外の論文の本文は None とする。
+
+    fetch_text が偽なら本文は取得せず (コーパスにあればその本文を返す)、後で select_full_text_papers と
+    get_paper_with_text で取得する。
+
+    serpapi_api_key が None なら環境変数 SERPAPI_API_KEY のキーを使う。
     """
 
     def fetch(start=0):
@@ -179,24 +290,146 @@ def search_on_google_scholar(
 
         # FIXME: 検索結果に arxiv の文献をなるべく多く含めたいため検索クエリを弄っている
         actual_query = " ".join([query, "arxiv"]) if "arxiv" not in query.lower() else query
-        search_result = fetch_google_scholar(actual_query, start)
+        search_result = fetch_google_scholar(actual_query, start, serpapi_api_key)
 
         return [i for i in search_result if valid_item(i)]
 
-    result = []
-    start = 0
+    profiler = get_profiler(profile_dir)
+
+    try:
+        result = []
+        start = 0
+
+        with profiler.stage("google_scholar_search"):
+            while len(result) < n:
+                # FIXME: 今のままだとそもそも検索結果が全体で n 件以下の場合に無限ループになってしまう
+                raise_if_cancelled(cancellation_token)
+                result += fetch(start)
+                start += 10
+
+        logger.info("Collecting details...")
+
+        papers = []
+        nb_fetched = 0
+
+        # 一段階目: 本文以外の情報を集める
+        with profiler.stage("paper_details"):
+            for citation_id, item in tqdm(enumerate(result[:n], start=1)):
+                raise_if_cancelled(cancellation_token)
+                paper = None
+
+                if corpus is not None:
+                    paper = corpus.get_paper(get_arxiv_id(item["link"]), citation_id)
+
+                if paper is None:
+                    paper = Paper.from_google_scholar_result(
+                        citation_id,
+                        item,
+                        extraction_mode=extraction_mode,
+                        max_pages=max_pages,
+                        citation_source=citation_source,
+                        fetch_text=False,
+                        serpapi_api_key=serpapi_api_key,
+                    )
+                    nb_fetched += 1
+
+                    if corpus is not None:
+                        corpus.put_paper(paper.arxiv_id, paper)
+
+                papers.append(paper)
+
+        if not fetch_text:
+            logger.info(
+                f"Number of papers: {len(papers)}, "
+                f"newly fetched: {nb_fetched}, found in the corpus: {len(papers) - nb_fetched}"
+            )
+            return papers
+
+        full_text_indices = select_full_text_papers(query, papers, nb_full_text, citation_weight)
+        nb_extracted = 0
+
+        # 二段階目: 上位の論文のみ本文を取得する
+        with profiler.stage("paper_text"):
+            for idx in tqdm(sorted(full_text_indices)):
+                raise_if_cancelled(cancellation_token)
+                paper = get_paper_with_text(papers[idx], extraction_mode, max_pages, corpus)
+
+                if paper is not papers[idx]:
+                    papers[idx] = paper
+                    nb_extracted += 1
+    finally:
+        profiler.dump()
+
+    logger.info(
+        f"Number of papers: {len(papers)}, "
+        f"newly fetched: {nb_fetched}, found in the corpus: {len(papers) - nb_fetched}, "
+        f"full text extracted: {nb_extracted}, without full text: {len(papers) - len(full_text_indices)}"
+    )
 
-    while len(result) < n:
-        # FIXME: 今のままだとそもそも検索結果が全体で n 件以下の場合に無限ループになってしまう
-        result += fetch(start)
-        start += 10
+    return papers
 
-    logger.info("Collecting details...")
 
-    return [
-        Paper.from_google_scholar_result(id, i)
-        for id, i in tqdm(enumerate(result[:n], start=1))
-    ]
+def select_full_text_papers(
+        query: str,
+        papers: List[Paper],
+        nb_full_text: Optional[int] = None,
+        citation_weight: float = 0.3,
+) -> Set[int]:
+    """本文を取得する論文の papers 中の位置を返す、nb_full_text が None なら全ての論文とする
+    """
+    if nb_full_text is None or nb_full_text >= len(papers):
+        return set(range(len(papers)))
+
+    scores = rank_papers(
+        query,
+        [p.title for p in papers],
+        [p.summary for p in papers],
+        [p.nb_cited for p in papers],
+        citation_weight=citation_weight,
+    )
+    full_text_indices = set(sorted(range(len(papers)), key=lambda i: -scores[i])[:nb_full_text])
+
+    logger.info(
+        "Papers without full text: "
+        + ", ".join(
+            f"[{papers[i].citation_id}] {papers[i].title} ({scores[i]:.2f})"
+            for i in range(len(papers)) if i not in full_text_indices
+        )
+    )
+
+    return full_text_indices
+
+
+def get_paper_with_text(
+        paper: Paper,
+        extraction_mode: str = "full",
+        max_pages: int = 0,
+        corpus: Optional[PaperCorpus] = default_corpus,
+) -> Paper:
+    """paper が既に同じ抽出方法の本文を持っていればそのまま返し、持っていなければ本文を抽出してコーパスに保存する
+    """
+    if has_text(paper, extraction_mode, max_pages):
+        return paper
+
+    paper = paper.with_text(extraction_mode, max_pages)
+
+    if corpus is not None:
+        corpus.put_paper(paper.arxiv_id, paper)
+
+    return paper
+
+
+def has_text(paper: Paper, extraction_mode: str = "full", max_pages: int = 0) -> bool:
+    if paper.text is None:
+        return False
+
+    if extraction_mode != "partial":
+        return paper.extraction is None
+
+    return (
+        paper.extraction is not None
+        and paper.extraction.max_pages == max_pages
+    )
 
 
 def get_categories_string(papers: List[Paper], n: int = 3) -> str:
@@ -217,60 +450,68 @@ def get_categories_string(papers: List[Paper], n: int = 3) -> str:
     return ", ".join([c[0] for c in lst]) + f" and {last[0]}"
 
 
-def get_abstract_with_token_limit(
-        model: BaseLanguageModel,
-        papers: List[Paper],
-        limit: int,
-        separator: str = "\n",
-) -> str:
-    def get_summary(paper: Paper):
-        summary = paper.summary.replace("\n", " ")
-        return f"""
+def get_abstract(paper: Paper) -> str:
+    summary = paper.summary.replace("\n", " ")
+    return f"""
 Title: {paper.title}
 citation_id: {paper.citation_id}
 Summry: {summary}
 """
 
-    summaries = []
-    total_num_tokens = 0
-    idx = 0
-
-    while idx < len(papers):
-        summary = get_summary(papers[idx])
-        num_tokens = model.get_num_tokens(summary)
-
-        if total_num_tokens + num_tokens > limit:
-            break
-
-        summaries.append(summary)
-        total_num_tokens += num_tokens
-        idx += 1
 
-    result = separator.join(summaries).strip()
+def get_abstract_with_token_limit(
+        model: BaseLanguageModel,
+        papers: List[Paper],
+        limit: int,
+        separator: str = "\n",
+) -> str:
+    """limit に収まるだけ論文の要約を papers の順に詰める、収まらない要約は飛ばして後続の論文を試す
+    """
+    summaries = [get_abstract(p) for p in papers]
+    items = [
+        PackItem(text=summary, num_tokens=model.get_num_tokens(summary))
+        for summary in summaries
+    ]
+    indices = sorted(pack_with_token_limit(items, limit))
+    total_num_tokens = sum(items[idx].num_tokens for idx in indices)
+    result = separator.join(summaries[idx] for idx in indices).strip()
 
     logger.info(
-        f'Number of papers: {len(summaries)}, '
+        f'Number of papers: {len(indices)}, '
         f'number of tokens: {total_num_tokens}, text: {result[:100]}...'
     )
 
     return result
 
 
-@memory.cache
-def fetch_google_scholar(query: str, start: int) -> dict:
+def get_arxiv_id(arxiv_abs_link: str) -> str:
+    m = re.match(r"https?://arxiv\.org/abs/(.+)", arxiv_abs_link)
+    assert m is not None, f"{arxiv_abs_link} should be a arxiv link"
+    return m.group(1)
+
+
+# API キーは結果に影響しないので、キャッシュのキーに含めない (キャッシュのディレクトリにも書き出されない)
+@memory.cache(ignore=["serpapi_api_key"])
+def fetch_google_scholar(query: str, start: int, serpapi_api_key: Optional[str] = None) -> dict:
     logger.info(f"Looking for `{query}` on Google Scholar, offset: {start}...")
-    serpapi = SerpAPIWrapper(params={
-        "engine": "google_scholar",
-        "gl": "us",
-        "hl": "en",
-        "start": start,
-    })
+    serpapi = SerpAPIWrapper(
+        params={
+            "engine": "google_scholar",
+            "gl": "us",
+            "hl": "en",
+            "start": start,
+        },
+        serpapi_api_key=serpapi_api_key,
+    )
     return serpapi.results(query)["organic_results"]
 
 
-@memory.cache
-def fetch_google_scholar_cite(google_scholar_id: str) -> dict:
-    serpapi = SerpAPIWrapper(params={"engine": "google_scholar_cite"})
+@memory.cache(ignore=["serpapi_api_key"])
+def fetch_google_scholar_cite(google_scholar_id: str, serpapi_api_key: Optional[str] = None) -> dict:
+    serpapi = SerpAPIWrapper(
+        params={"engine": "google_scholar_cite"},
+        serpapi_api_key=serpapi_api_key,
+    )
     return serpapi.results(google_scholar_id)
 
 
@@ -282,10 +523,73 @@ def fetch_arxiv_result(arxiv_abs_link: str) -> arxiv.Result:
     return next(arxiv.Search(id_list=[arxiv_id]).results())
 
 
+def get_text(
+        arxiv_result: arxiv.Result,
+        extraction_mode: str = "full",
+        max_pages: int = 0,
+) -> Tuple[str, Optional[TextExtraction]]:
+    if extraction_mode == "partial":
+        return get_partial_text_from_arxiv_search_result(arxiv_result, max_pages)
+
+    return get_text_from_arxiv_search_result(arxiv_result), None
+
+
 @memory.cache
 def get_text_from_arxiv_search_result(
         arxiv_search_result: arxiv.Result
 ) -> str:
-    with tempfile.TemporaryDirectory() as d:
-        file_path = arxiv_search_result.download_pdf(dirpath=d)
+    with download_arxiv_pdf(arxiv_search_result) as file_path:
         return extract_text(file_path)
+
+
+REFERENCES_HEADING_PATTERN = re.compile(
+    r"^\s*(?:[0-9IVX]+\.?\s+)?(?:references|bibliography)\s*$",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+
+@memory.cache
+def get_partial_text_from_arxiv_search_result(
+        arxiv_search_result: arxiv.Result,
+        max_pages: int = 0,
+) -> Tuple[str, TextExtraction]:
+    """References (Bibliography) の見出しか max_pages ページ目までの本文を抽出する
+
+    参考文献リストとそれに続く付録は検索の役に立たない割にチャンク数が多いので抽出しない。
+    """
+    texts = []
+    stopped_at = None
+
+    with download_arxiv_pdf(arxiv_search_result) as file_path:
+        for page in extract_pages(file_path, maxpages=max_pages):
+            page_text = "".join(
+                element.get_text() for element in page
+                if isinstance(element, LTTextContainer)
+            )
+            m = REFERENCES_HEADING_PATTERN.search(page_text)
+
+            if m is not None:
+                texts.append(page_text[:m.start()])
+                stopped_at = "references"
+                break
+
+            texts.append(page_text)
+
+        # ちょうど max_pages ページの論文は最後まで抽出しているので、残りのページがある場合のみとする
+        if stopped_at is None and max_pages and len(texts) == max_pages:
+            with open(file_path, "rb") as f:
+                if sum(1 for _ in PDFPage.get_pages(f)) > max_pages:
+                    stopped_at = "page_limit"
+
+    extraction = TextExtraction(
+        max_pages=max_pages,
+        nb_pages=len(texts),
+        stopped_at=stopped_at,
+    )
+
+    logger.info(
+        f"Extracted {extraction.nb_pages} pages from {arxiv_search_result.entry_id}, "
+        f"stopped at: {extraction.stopped_at}"
+    )
+
+    return "\f".join(texts), extraction
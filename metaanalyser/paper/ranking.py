@@ -0,0 +1,121 @@
+import heapq
+import math
+import re
+from collections import Counter, defaultdict
+from typing import Dict, List, Tuple
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def bm25_scores(
+        query_tokens: List[str],
+        docs_tokens: List[List[str]],
+        k1: float = 1.2,
+        b: float = 0.75,
+) -> List[float]:
+    """docs_tokens のそれぞれの文書の、query_tokens に対する BM25 のスコアを返す
+    """
+    if not docs_tokens:
+        return []
+
+    nb_docs = len(docs_tokens)
+    avg_doc_len = sum(len(d) for d in docs_tokens) / nb_docs or 1.0
+    doc_freqs = Counter(t for d in docs_tokens for t in set(d))
+    query_terms = set(query_tokens)
+    scores = []
+
+    for doc_tokens in docs_tokens:
+        term_freqs = Counter(doc_tokens)
+        score = 0.0
+
+        for term in query_terms:
+            tf = term_freqs.get(term, 0)
+
+            if tf == 0:
+                continue
+
+            idf = math.log(1 + (nb_docs - doc_freqs[term] + 0.5) / (doc_freqs[term] + 0.5))
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(doc_tokens) / avg_doc_len))
+
+        scores.append(score)
+
+    return scores
+
+
+def rank_papers(
+        query: str,
+        titles: List[str],
+        abstracts: List[str],
+        nb_cited: List[int],
+        citation_weight: float = 0.3,
+) -> List[float]:
+    """タイトルと要約の BM25 のスコアと被引用数から、本文を読む価値のありそうな論文ほど大きいスコアを返す
+
+    タイトルの語は要約の語の二倍に数える。BM25 と log(1 + 被引用数) はそれぞれ最大値で正規化し、
+    (1 - citation_weight) : citation_weight で足し合わせる。
+    """
+    docs_tokens = [
+        tokenize(title) * 2 + tokenize(abstract)
+        for title, abstract in zip(titles, abstracts)
+    ]
+    relevance = bm25_scores(tokenize(query), docs_tokens)
+    citations = [math.log1p(max(n, 0)) for n in nb_cited]
+    max_relevance = max(relevance, default=0) or 1.0
+    max_citations = max(citations, default=0) or 1.0
+
+    return [
+        (1 - citation_weight) * r / max_relevance + citation_weight * c / max_citations
+        for r, c in zip(relevance, citations)
+    ]
+
+
+class BM25Index:
+    """チャンクの BM25 の転置インデックス、クエリの埋め込みを使わずにローカルで検索できる
+
+    文書の番号は追加した順で、FAISS のインデックスの番号と揃える。
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        self.doc_lens: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self.doc_lens)
+
+    def add(self, text: str) -> int:
+        doc_idx = len(self.doc_lens)
+        tokens = tokenize(text)
+
+        for term, tf in Counter(tokens).items():
+            self.postings[term].append((doc_idx, tf))
+
+        self.doc_lens.append(len(tokens))
+
+        return doc_idx
+
+    def search(self, query: str, k: int = 4) -> List[Tuple[int, float]]:
+        """スコアの高い順に、最大 k 件の (文書の番号, BM25 のスコア) を返す、クエリの語を含まない文書は返さない
+        """
+        nb_docs = len(self.doc_lens)
+
+        if nb_docs == 0:
+            return []
+
+        avg_doc_len = sum(self.doc_lens) / nb_docs or 1.0
+        scores: Dict[int, float] = defaultdict(float)
+
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term, [])
+            idf = math.log(1 + (nb_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+
+            for doc_idx, tf in postings:
+                norm = 1 - self.b + self.b * self.doc_lens[doc_idx] / avg_doc_len
+                scores[doc_idx] += idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+
+        return heapq.nlargest(k, scores.items(), key=lambda x: x[1])
@@ -1,68 +1,465 @@
 import functools
+import hashlib
+import json
 import logging
+import numpy as np
+import os
+import pickle
 import tiktoken
+import uuid
+from collections import defaultdict
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
 from langchain.embeddings import OpenAIEmbeddings
+from langchain.embeddings.base import Embeddings
 from langchain.text_splitter import SpacyTextSplitter
 from langchain.vectorstores import FAISS
 from tqdm.auto import tqdm
-from typing import List
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
+from ..api_keys import resolve_openai_api_key, with_openai_api_key
+from ..cancellation import CancellationToken, raise_if_cancelled
+from .corpus import PaperChunks, PaperCorpus, corpus as default_corpus
+from .dedup import MinHashDeduplicator
+from .index import build_faiss_index
 from .paper import Paper
+from .ranking import BM25Index
 
 logger = logging.getLogger(__name__)
 
+RETRIEVAL_MODES = ["vector", "hybrid", "lexical"]
+# Reciprocal Rank Fusion の定数、順位の低い結果の重みを緩める
+RRF_K = 60
+
+
+class PaperVectorStore(FAISS):
+    """論文のチャンクの FAISS のベクトルストア
+
+    チャンクの metadata には論文のキー (arXiv id) とチャンクの位置のみを持たせ、
+    論文のメタデータ (タイトルや引用など) は papers に論文毎に一つだけ持つ。
+    lexical_index は FAISS のインデックスと同じ番号のチャンクの BM25 のインデックスで、
+    add_texts などでチャンクを追加した場合はそれにも追加する。
+    """
+
+    def __init__(
+            self,
+            *args,
+            papers: Optional[Dict[str, Dict[str, Any]]] = None,
+            lexical_index: Optional[BM25Index] = None,
+            **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.papers = papers or {}
+        self.lexical_index = lexical_index
+
+    def get_lexical_index(self) -> BM25Index:
+        if self.lexical_index is None or len(self.lexical_index) != len(self.index_to_docstore_id):
+            # BM25 のインデックスを持たずに保存したベクトルストアか、FAISS のインデックスとずれている
+            self.lexical_index = build_lexical_index([
+                self.docstore.search(self.index_to_docstore_id[idx]).page_content
+                for idx in range(len(self.index_to_docstore_id))
+            ])
+
+        return self.lexical_index
+
+    def add_texts(
+            self,
+            texts: Iterable[str],
+            metadatas: Optional[List[dict]] = None,
+            **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        ids = super().add_texts(texts, metadatas, **kwargs)
+        self._add_to_lexical_index(texts)
+
+        return ids
+
+    def add_embeddings(
+            self,
+            text_embeddings: Iterable[Tuple[str, List[float]]],
+            metadatas: Optional[List[dict]] = None,
+            **kwargs: Any,
+    ) -> List[str]:
+        text_embeddings = list(text_embeddings)
+        ids = super().add_embeddings(text_embeddings, metadatas, **kwargs)
+        self._add_to_lexical_index([text for text, _ in text_embeddings])
+
+        return ids
+
+    def merge_from(self, target: FAISS):
+        super().merge_from(target)
+
+        if isinstance(target, PaperVectorStore):
+            self.papers.update(target.papers)
+
+        self._add_to_lexical_index([
+            target.docstore.search(target.index_to_docstore_id[idx]).page_content
+            for idx in range(len(target.index_to_docstore_id))
+        ])
+
+    def _add_to_lexical_index(self, texts: List[str]):
+        # まだ作っていなければ、get_lexical_index で全てのチャンクから作る
+        if self.lexical_index is not None:
+            for text in texts:
+                self.lexical_index.add(text)
+
+    def get_paper_metadata(self, doc: Document) -> Dict[str, Any]:
+        if "paper_key" not in doc.metadata:
+            # チャンク毎にメタデータを持っていた頃に保存したベクトルストア
+            return doc.metadata
+
+        return self.papers[doc.metadata["paper_key"]]
+
+    def save_local(self, folder_path: str, index_name: str = "index"):
+        super().save_local(folder_path, index_name)
+
+        with open(os.path.join(folder_path, f"{index_name}.papers.pkl"), "wb") as f:
+            pickle.dump(self.papers, f)
+
+        with open(os.path.join(folder_path, f"{index_name}.bm25.pkl"), "wb") as f:
+            pickle.dump(self.get_lexical_index(), f)
+
+    @classmethod
+    def load_local(
+            cls,
+            folder_path: str,
+            embeddings: Embeddings,
+            index_name: str = "index",
+    ) -> "PaperVectorStore":
+        db = super().load_local(folder_path, embeddings, index_name)
+        papers_path = os.path.join(folder_path, f"{index_name}.papers.pkl")
+
+        if os.path.exists(papers_path):
+            with open(papers_path, "rb") as f:
+                db.papers = pickle.load(f)
+
+        lexical_index_path = os.path.join(folder_path, f"{index_name}.bm25.pkl")
+
+        if os.path.exists(lexical_index_path):
+            with open(lexical_index_path, "rb") as f:
+                db.lexical_index = pickle.load(f)
+
+        return db
+
+
+def build_lexical_index(texts: List[str]) -> BM25Index:
+    lexical_index = BM25Index()
+
+    for text in texts:
+        lexical_index.add(text)
+
+    return lexical_index
+
 
 def create_papers_vectorstor(
         papers: List[Paper],
         tiktoken_encoder_model_name: str = "gpt-3.5-turbo",
         chunk_size: int = 150,
         chunk_overlap: int = 10,
-) -> FAISS:
-    splitter = SpacyTextSplitter.from_tiktoken_encoder(
-        model_name=tiktoken_encoder_model_name,
-        chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap,
-    )
-    enc = tiktoken.encoding_for_model(tiktoken_encoder_model_name)
-
-    def format_text(text):
-        return functools.reduce(
-            lambda text, special_token: text.replace(special_token, ""),
-            list(enc.special_tokens_set),
-            text
-        ).replace("\n", " ")
+        corpus: Optional[PaperCorpus] = default_corpus,
+        deduplicate: bool = True,
+        dedup_threshold: float = 0.8,
+        index_type: str = "flat",
+        index_params: Optional[Dict[str, Any]] = None,
+        cancellation_token: Optional[CancellationToken] = None,
+        openai_api_key: Optional[str] = None,
+) -> PaperVectorStore:
+    """papers の本文をチャンクに分割して埋め込み、FAISS のベクトルストアを作成する。
+    corpus に同じ設定のチャンクと埋め込みが保存されている論文はそれを再利用し、残りの論文のみ分割・埋め込みを行う。
+    deduplicate が真なら、推定 Jaccard 係数が dedup_threshold 以上のほぼ重複するチャンクは埋め込まずに取り除く。
+    index_type と index_params は build_faiss_index に渡す、大きなコーパスでは flat 以外の近似インデックスを使う。
+    FAISS のインデックスと並べて、チャンクの BM25 のインデックスも作る (similarity_search_with_vectors を参照)。
+    cancellation_token が取り消されると、論文の分割や埋め込みの区切りで RunCancelled を送出する。
+    openai_api_key が None なら環境変数 OPENAI_API_KEY のキーで埋め込む。
+    """
+    split_paper = get_paper_splitter(tiktoken_encoder_model_name, chunk_size, chunk_overlap)
 
     logger.info(
         f"Creating vector store,"
         f" {tiktoken_encoder_model_name=}"
-        f", {chunk_size=}, {chunk_overlap=}"
+        f", {chunk_size=}, {chunk_overlap=}, {index_type=}"
+    )
+
+    embeddings = get_embeddings(openai_api_key)
+    chunks_key = get_chunks_key(embeddings, tiktoken_encoder_model_name, chunk_size, chunk_overlap)
+    papers_chunks = [
+        corpus.get_chunks(p.arxiv_id, chunks_key) if corpus is not None else None
+        for p in papers
+    ]
+    nb_papers_in_corpus = len([c for c in papers_chunks if c is not None])
+
+    def split(p: Paper) -> PaperChunks:
+        raise_if_cancelled(cancellation_token)
+        return split_paper(p)
+
+    papers_chunks = [
+        chunks if chunks is not None else split(p)
+        for p, chunks in zip(tqdm(papers), papers_chunks)
+    ]
+
+    logger.info(
+        f"Number of papers to split: {len(papers) - nb_papers_in_corpus}, "
+        f"found in the corpus: {nb_papers_in_corpus}"
     )
 
-    docs = splitter.create_documents(
-        [format_text(p.text) for p in tqdm(papers)],
-        metadatas=[
-            {
-                'google_scholar_result_id': p.google_scholar_result_id,
-                'title': p.title,
-                'link': p.link,
-                'nb_cited': p.nb_cited,
-                'citation_id': p.citation_id,
-                'entry_id': p.entry_id,
-                'published': str(p.published),
-                'primary_category': p.primary_category,
-                'categories': ", ".join(p.categories),
-                'doi': p.doi,
-                'citiation': p.mla_citiation.snippet,
-            } for p in papers
+    if deduplicate:
+        # 重複するチャンクは埋め込む前に取り除く、先に現れた (検索順位の高い論文の) チャンクを残す
+        deduplicator = MinHashDeduplicator(threshold=dedup_threshold)
+        papers_chunk_indices = [
+            [idx for idx, text in enumerate(chunks.texts) if deduplicator.add(text)]
+            for chunks in papers_chunks
         ]
+    else:
+        papers_chunk_indices = [list(range(len(chunks.texts))) for chunks in papers_chunks]
+
+    nb_chunks = sum(len(chunks.texts) for chunks in papers_chunks)
+    nb_kept_chunks = sum(len(indices) for indices in papers_chunk_indices)
+
+    logger.info(
+        f"Removed {nb_chunks - nb_kept_chunks} near-duplicate chunks"
+        f" out of {nb_chunks} chunks"
     )
 
-    embeddings = OpenAIEmbeddings()
-    db = FAISS.from_documents(docs, embeddings)
+    # 埋め込みの API 呼び出しは、まだ埋め込んでいないチャンクをまとめて一度に行う
+    targets = [
+        (paper_idx, chunk_idx)
+        for paper_idx, (chunks, indices) in enumerate(zip(papers_chunks, papers_chunk_indices))
+        for chunk_idx in indices
+        if not chunks.has_embedding(chunk_idx)
+    ]
+
+    logger.info(f"Number of chunks to embed: {len(targets)}")
+
+    raise_if_cancelled(cancellation_token)
+
+    if targets:
+        new_embeddings = np.array(embeddings.embed_documents([
+            papers_chunks[paper_idx].texts[chunk_idx]
+            for paper_idx, chunk_idx in targets
+        ]), dtype=np.float32)
+
+        papers_offsets = defaultdict(list)
+
+        for offset, (paper_idx, _) in enumerate(targets):
+            papers_offsets[paper_idx].append(offset)
+
+        for paper_idx, offsets in papers_offsets.items():
+            papers_chunks[paper_idx].set_embeddings(
+                [targets[offset][1] for offset in offsets],
+                new_embeddings[offsets],
+            )
+
+            if corpus is not None:
+                corpus.put_chunks(papers[paper_idx].arxiv_id, chunks_key, papers_chunks[paper_idx])
+
+    text_embeddings = []
+    metadatas = []
+    papers_metadata = {}
+
+    for p, chunks, indices in zip(papers, papers_chunks, papers_chunk_indices):
+        text_embeddings += [(chunks.texts[idx], chunks.embeddings[idx]) for idx in indices]
+        metadatas += [{"paper_key": p.arxiv_id, "offset": idx} for idx in indices]
+        papers_metadata[p.arxiv_id] = get_paper_store_metadata(p)
+
+    raise_if_cancelled(cancellation_token)
+    index = build_faiss_index(
+        np.array([e for _, e in text_embeddings], dtype=np.float32),
+        index_type=index_type,
+        **(index_params or {}),
+    )
+    db = new_paper_store(
+        embeddings,
+        index,
+        [text for text, _ in text_embeddings],
+        metadatas,
+        papers_metadata,
+    )
 
     logger.info(
         f"Vector store is created from {len(papers)} papers,"
-        f" document size={len(docs)}"
+        f" document size={len(text_embeddings)}"
     )
 
     return db
+
+
+def new_paper_store(
+        embeddings: Embeddings,
+        index: Any,
+        texts: List[str],
+        metadatas: List[Dict[str, Any]],
+        papers_metadata: Dict[str, Dict[str, Any]],
+) -> PaperVectorStore:
+    """index の i 番目のベクトルが texts の i 番目のチャンクに対応するベクトルストアを作る
+    """
+    index_to_docstore_id = {idx: str(uuid.uuid4()) for idx in range(len(texts))}
+    docstore = InMemoryDocstore({
+        index_to_docstore_id[idx]: Document(page_content=text, metadata=metadata)
+        for idx, (text, metadata) in enumerate(zip(texts, metadatas))
+    })
+
+    return PaperVectorStore(
+        embeddings.embed_query,
+        index,
+        docstore,
+        index_to_docstore_id,
+        papers=papers_metadata,
+        lexical_index=build_lexical_index(texts),
+    )
+
+
+def get_paper_store_metadata(p: Paper) -> Dict[str, Any]:
+    return {
+        'google_scholar_result_id': p.google_scholar_result_id,
+        'title': p.title,
+        'link': p.link,
+        'nb_cited': p.nb_cited,
+        'citation_id': p.citation_id,
+        'entry_id': p.entry_id,
+        'published': str(p.published),
+        'primary_category': p.primary_category,
+        'categories': ", ".join(p.categories),
+        'doi': p.doi,
+        'citiation': p.mla_citiation.snippet,
+    }
+
+
+def get_embeddings(openai_api_key: Optional[str] = None) -> OpenAIEmbeddings:
+    """ベクトルストアを作る経路 (create_papers_vectorstor と stream_papers_vectorstor) は全てここで埋め込みを作る
+
+    openai_api_key が None なら環境変数 OPENAI_API_KEY のキーを、リクエスト毎に渡して使う。
+    """
+    openai_api_key = resolve_openai_api_key(openai_api_key)
+
+    return with_openai_api_key(OpenAIEmbeddings(openai_api_key=openai_api_key), openai_api_key)
+
+
+def get_chunks_key(
+        embeddings: OpenAIEmbeddings,
+        tiktoken_encoder_model_name: str,
+        chunk_size: int,
+        chunk_overlap: int,
+) -> str:
+    return f"{embeddings.model}-{tiktoken_encoder_model_name}-{chunk_size}-{chunk_overlap}"
+
+
+def get_paper_store_key(query: str, papers: List[Paper], **options) -> str:
+    """論文とベクトルストアの作り方 (本文の抽出方法やインデックスの種類など) から、ベクトルストアのキャッシュのキーを作る
+    """
+    return hashlib.sha1(json.dumps({
+        "query": query,
+        "papers": [(p.arxiv_id, p.citation_id) for p in papers],
+        **options,
+    }, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def get_paper_splitter(
+        tiktoken_encoder_model_name: str = "gpt-3.5-turbo",
+        chunk_size: int = 150,
+        chunk_overlap: int = 10,
+) -> Callable[[Paper], PaperChunks]:
+    splitter = get_text_splitter(
+        tiktoken_encoder_model_name,
+        chunk_size,
+        chunk_overlap,
+    )
+    enc = tiktoken.encoding_for_model(tiktoken_encoder_model_name)
+
+    def format_text(text):
+        return functools.reduce(
+            lambda text, special_token: text.replace(special_token, ""),
+            list(enc.special_tokens_set),
+            text
+        ).replace("\n", " ")
+
+    def split(p: Paper) -> PaperChunks:
+        # 本文を取得しなかった論文は要約をチャンクにする
+        text = p.text if p.text is not None else p.summary
+        return PaperChunks(texts=splitter.split_text(format_text(text)))
+
+    return split
+
+
+@functools.lru_cache(maxsize=None)
+def get_text_splitter(
+        tiktoken_encoder_model_name: str = "gpt-3.5-turbo",
+        chunk_size: int = 150,
+        chunk_overlap: int = 10,
+) -> SpacyTextSplitter:
+    """spaCy のモデルの読み込みは重いので、同じ設定の splitter はプロセス内で使い回す
+    """
+    return SpacyTextSplitter.from_tiktoken_encoder(
+        model_name=tiktoken_encoder_model_name,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+    )
+
+
+def similarity_search_with_vectors(
+        db: PaperVectorStore,
+        query: str,
+        k: int = 4,
+        retrieval_mode: str = "vector",
+) -> List[Tuple[Document, float, Optional[np.ndarray]]]:
+    """query に近い順に、チャンクとクエリとの関連度、チャンクの埋め込みの組を返す
+
+    retrieval_mode が "vector" なら関連度はコサイン類似度、"lexical" ならクエリの埋め込みを作らずに
+    BM25 のインデックスのみで検索し (最大値で正規化した BM25 のスコア)、"hybrid" なら両方の結果を
+    Reciprocal Rank Fusion で合わせる (最大値で正規化した RRF のスコア)。
+    インデックスからベクトルを復元できない場合 (direct map のない IVF など) は埋め込みを None とする。
+    """
+    if retrieval_mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unknown retrieval mode: {retrieval_mode}")
+
+    if retrieval_mode == "vector":
+        hits = vector_search(db, query, k)
+    elif retrieval_mode == "lexical":
+        hits = normalize_scores(db.get_lexical_index().search(query, k))
+    else:
+        hits = normalize_scores(reciprocal_rank_fusion([
+            vector_search(db, query, k),
+            db.get_lexical_index().search(query, k),
+        ])[:k])
+
+    result = []
+
+    for idx, relevance in hits:
+        doc = db.docstore.search(db.index_to_docstore_id[idx])
+
+        try:
+            vector = db.index.reconstruct(idx)
+        except RuntimeError:
+            vector = None
+
+        result.append((doc, relevance, vector))
+
+    return result
+
+
+def vector_search(db: PaperVectorStore, query: str, k: int) -> List[Tuple[int, float]]:
+    """OpenAI の埋め込みは正規化されているので、FAISS の二乗 L2 距離 d からコサイン類似度は 1 - d / 2 で求まる
+    """
+    query_vector = np.array([db.embedding_function(query)], dtype=np.float32)
+    distances, indices = db.index.search(query_vector, k)
+
+    # 近似インデックスで k 件見つからなかった分は -1 になる
+    return [
+        (int(idx), 1 - float(distance) / 2)
+        for distance, idx in zip(distances[0], indices[0])
+        if idx != -1
+    ]
+
+
+def reciprocal_rank_fusion(rankings: List[List[Tuple[int, float]]]) -> List[Tuple[int, float]]:
+    scores: Dict[int, float] = defaultdict(float)
+
+    for ranking in rankings:
+        for rank, (idx, _) in enumerate(ranking, start=1):
+            scores[idx] += 1 / (RRF_K + rank)
+
+    return sorted(scores.items(), key=lambda x: -x[1])
+
+
+def normalize_scores(hits: List[Tuple[int, float]]) -> List[Tuple[int, float]]:
+    max_score = max((score for _, score in hits), default=0) or 1.0
+    return [(idx, score / max_score) for idx, score in hits]
@@ -0,0 +1,182 @@
+import contextlib
+import cProfile
+import datetime
+import functools
+import io
+import logging
+import os
+import pstats
+import re
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Iterator, Optional, Tuple, TypeVar, Union
+
+logger = logging.getLogger(__name__)
+
+F = TypeVar("F", bound=Callable)
+
+# 指定されていれば、SRChain と search_on_google_scholar は段階毎のプロファイルをここに書き出す
+PROFILE_DIR = os.environ.get("METAANALYSER_PROFILE_DIR")
+
+# プロファイラが入れ子になった場合は外側のみが計測する、スレッド毎に管理する
+_active = threading.local()
+
+
+class StageProfiler:
+    """パイプラインの段階毎に cProfile で決定論的なプロファイルを取る
+
+    同じ名前の段階 (e.g. 各セクションの執筆) は一つのプロファイルにまとめる。
+    dump で output_dir に段階毎の <stage>.pstats と、ホットスポットをまとめた summary.txt を書き出す。
+
+    cProfile は呼び出したスレッドしか計測しないので、段階の中でスレッドプールなどに渡す関数は
+    in_current_stage で包み、その段階のプロファイルに含まれるようにする。
+    """
+
+    def __init__(self, output_dir: str, nb_hotspots: int = 15):
+        self.output_dir = output_dir
+        self.nb_hotspots = nb_hotspots
+        self._profiles: Dict[Tuple[str, int], cProfile.Profile] = {}
+        self._elapsed: Dict[str, float] = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def stage(self, name: str) -> contextlib.AbstractContextManager:
+        return self._profile(name, record_elapsed=True)
+
+    @contextlib.contextmanager
+    def _profile(self, name: str, record_elapsed: bool) -> Iterator[None]:
+        if getattr(_active, "stage", None) is not None:
+            yield
+            return
+
+        profile = cProfile.Profile()
+
+        try:
+            profile.enable()
+        except ValueError as e:
+            # 他のプロファイラが既に動いている (Python 3.12 以降で別スレッドの段階と重なった場合など)
+            logger.debug(f"Could not profile stage {name}, {e}")
+            profile = None
+
+        _active.stage = name
+        _active.profiler = self
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+
+            _active.stage = None
+            _active.profiler = None
+
+            with self._lock:
+                # 別スレッドでの計測は段階の経過時間に含まれているので、経過時間は段階を始めたスレッドのみが記録する
+                if record_elapsed:
+                    self._elapsed[name] += time.perf_counter() - start
+
+                if profile is not None:
+                    self._profiles[(name, len(self._profiles))] = profile
+
+    def dump(self):
+        if not self._elapsed:
+            return
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        summary = []
+
+        for name, elapsed in self._elapsed.items():
+            profiles = [p for (n, _), p in self._profiles.items() if n == name]
+            summary.append(f"== {name}: {elapsed:.2f}s\n")
+
+            if not profiles:
+                continue
+
+            stats = pstats.Stats(profiles[0], stream=io.StringIO())
+
+            for profile in profiles[1:]:
+                stats.add(profile)
+
+            stats.dump_stats(os.path.join(self.output_dir, f"{name}.pstats"))
+            summary.append(get_time_by_package(stats))
+
+            stream = io.StringIO()
+            stats.stream = stream
+            stats.sort_stats("tottime").print_stats(self.nb_hotspots)
+            summary.append(stream.getvalue().split("\n\n", 1)[-1].strip() + "\n\n")
+
+        with open(os.path.join(self.output_dir, "summary.txt"), "w") as f:
+            f.write("\n".join(summary))
+
+        logger.info(
+            f"Profiles are written to {self.output_dir}: "
+            + ", ".join(f"{name}={elapsed:.2f}s" for name, elapsed in self._elapsed.items())
+        )
+
+
+class NullProfiler:
+    """プロファイリングしない場合のプロファイラ、オーバーヘッドはない
+    """
+
+    def stage(self, name: str) -> contextlib.AbstractContextManager:
+        return contextlib.nullcontext()
+
+    def dump(self):
+        pass
+
+
+def in_current_stage(fn: F) -> F:
+    """fn を別のスレッド (スレッドプールなど) で呼んでも、呼び出し元のスレッドで計測中の段階のプロファイルに
+    含まれるように包む、計測していなければ fn をそのまま返す
+    """
+    profiler = getattr(_active, "profiler", None)
+    name = getattr(_active, "stage", None)
+
+    if profiler is None or name is None:
+        return fn
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with profiler._profile(name, record_elapsed=False):
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def get_profiler(profile_dir: Optional[str] = None) -> Union[StageProfiler, NullProfiler]:
+    """profile_dir (指定されていなければ METAANALYSER_PROFILE_DIR) の下に実行毎のディレクトリを作って
+    プロファイルを書き出すプロファイラを返す、どちらも指定されていなければ何もしないプロファイラを返す
+    """
+    profile_dir = profile_dir or PROFILE_DIR
+
+    if not profile_dir:
+        return NullProfiler()
+
+    run_id = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+
+    return StageProfiler(os.path.join(profile_dir, run_id))
+
+
+def get_time_by_package(stats: pstats.Stats, nb_packages: int = 8) -> str:
+    """関数の tottime をパッケージ (pdfminer, spacy, faiss, pydantic, socket など) 毎に集計する
+    """
+    elapsed = defaultdict(float)
+
+    for (file_name, _, func_name), (_, _, tottime, _, _) in stats.stats.items():
+        m = re.search(r"(?:site|dist)-packages/([^/]+)", file_name)
+
+        if m is not None:
+            package = m.group(1).split(".")[0]
+        elif file_name == "~":
+            # e.g. <method 'read' of '_ssl._SSLSocket' objects>, <built-in method time.sleep>
+            m = re.search(r"(?:of '|built-in method )_?([a-zA-Z0-9]+)\.", func_name)
+            package = f"<built-in {m.group(1)}>" if m is not None else "<built-in>"
+        else:
+            package = os.path.splitext(os.path.basename(file_name))[0]
+
+        elapsed[package] += tottime
+
+    top = sorted(elapsed.items(), key=lambda i: -i[1])[:nb_packages]
+
+    return "Time by package: " + ", ".join(f"{p}={t:.2f}s" for p, t in top) + "\n"
@@ -0,0 +1,11 @@
+from .client import ServiceError, ping, submit
+from .server import ReviewService, serve
+
+
+__all__ = [
+    "ReviewService",
+    "ServiceError",
+    "ping",
+    "serve",
+    "submit",
+]
@@ -0,0 +1,71 @@
+import argparse
+import json
+import logging
+import os
+
+from .client import SOCKET_PATH, ping, stop, submit
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a resident service that keeps models loaded, and send review jobs to it."
+    )
+    parser.add_argument(
+        "--socket-path",
+        default=SOCKET_PATH,
+        help="path of the Unix domain socket (default: METAANALYSER_SOCKET_PATH)",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="load the models and serve until stopped")
+    serve_parser.add_argument("--nb-workers", type=int, default=2, help="number of jobs run at once")
+    serve_parser.add_argument(
+        "--nb-paper-stores",
+        type=int,
+        default=8,
+        help="number of vector stores kept in memory and reused by later jobs",
+    )
+
+    submit_parser = subparsers.add_parser("submit", help="run a job on the service and wait for it")
+    submit_parser.add_argument("query")
+    submit_parser.add_argument("--kind", choices=["review", "ingest"], default="review")
+    submit_parser.add_argument(
+        "--options",
+        default="{}",
+        help='JSON of options passed to SRChain or search_on_google_scholar, e.g. {"nb_papers": 20}',
+    )
+    submit_parser.add_argument("--output-path", help="file the review is written to (review only)")
+
+    subparsers.add_parser("ping", help="show the status of the service")
+    subparsers.add_parser("stop", help="stop the service")
+
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        # サービスのみが重い依存を読み込む、クライアントのコマンドは標準ライブラリのみで動く
+        from .server import serve
+
+        logging.basicConfig()
+        logging.getLogger("metaanalyser").setLevel(level=logging.INFO)
+        serve(args.socket_path, args.nb_workers, nb_max_paper_stores=args.nb_paper_stores)
+    elif args.command == "submit":
+        payload = {"query": args.query, **json.loads(args.options)}
+
+        if args.output_path is not None:
+            # サービスは別の作業ディレクトリで動いているので、クライアントの作業ディレクトリからのパスにする
+            payload["output_path"] = os.path.abspath(args.output_path)
+
+        result = submit(args.kind, payload, args.socket_path)
+
+        if args.kind == "review" and args.output_path is None:
+            print(result["text"])
+        else:
+            print(json.dumps(result, indent=2, ensure_ascii=False))
+    elif args.command == "ping":
+        print(json.dumps(ping(args.socket_path), indent=2))
+    else:
+        print(json.dumps(stop(args.socket_path), indent=2))
+
+
+if __name__ == "__main__":
+    main()
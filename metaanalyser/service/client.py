@@ -0,0 +1,64 @@
+import json
+import os
+import socket
+import tempfile
+from typing import Any, Dict, Optional
+
+# UNIX ドメインソケットのパスは 100 文字程度までしか使えないので、キャッシュのディレクトリではなく一時ディレクトリに置く
+SOCKET_PATH = os.environ.get(
+    "METAANALYSER_SOCKET_PATH",
+    os.path.join(tempfile.gettempdir(), f"metaanalyser-{os.getuid()}.sock"),
+)
+
+
+class ServiceError(Exception):
+    """サービスがリクエストの処理に失敗した
+    """
+
+
+def request(
+        message: Dict[str, Any],
+        socket_path: str = SOCKET_PATH,
+        timeout: Optional[float] = None,
+) -> Any:
+    """常駐しているサービスに message を送り、その結果を返す
+
+    一行の JSON を送り、一行の JSON を受け取る。クライアントは langchain などの重い依存を読み込まない。
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+
+        with sock.makefile("rwb") as f:
+            f.write(json.dumps(message, ensure_ascii=False).encode("utf-8") + b"\n")
+            f.flush()
+            line = f.readline()
+
+    if not line:
+        raise ServiceError("The service closed the connection without a response")
+
+    response = json.loads(line)
+
+    if not response["ok"]:
+        raise ServiceError(response["error"])
+
+    return response["result"]
+
+
+def submit(
+        kind: str,
+        payload: Dict[str, Any],
+        socket_path: str = SOCKET_PATH,
+        timeout: Optional[float] = None,
+) -> Dict[str, Any]:
+    """kind ("review" か "ingest") のジョブをサービスで実行し、終わるまで待ってその結果を返す
+    """
+    return request({"command": "submit", "kind": kind, "payload": payload}, socket_path, timeout)
+
+
+def ping(socket_path: str = SOCKET_PATH, timeout: Optional[float] = 5.0) -> Dict[str, Any]:
+    return request({"command": "ping"}, socket_path, timeout)
+
+
+def stop(socket_path: str = SOCKET_PATH, timeout: Optional[float] = 5.0) -> Dict[str, Any]:
+    return request({"command": "stop"}, socket_path, timeout)
@@ -0,0 +1,188 @@
+import functools
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from .client import SOCKET_PATH
+
+logger = logging.getLogger(__name__)
+
+
+def warm_up(
+        tiktoken_encoder_model_name: str = "gpt-3.5-turbo",
+        chunk_size: int = 150,
+        chunk_overlap: int = 10,
+        nb_max_paper_stores: int = 8,
+        nb_max_llms: int = 8,
+) -> Dict[str, Callable[[Dict[str, Any]], Dict[str, Any]]]:
+    """langchain と FAISS、spaCy のモデル、tiktoken のエンコーダを読み込み、ジョブのハンドラを返す
+
+    get_text_splitter は引数毎にキャッシュするので、create_papers_vectorstor と同じ引数の並びで呼ぶ。
+    review のハンドラは、API キー毎の LLM を最大 nb_max_llms 個、作ったベクトルストアを本文を取得した論文と共に
+    最大 nb_max_paper_stores 個、プロセス内に保持してジョブ間で使い回す。
+    """
+    start = time.perf_counter()
+
+    import faiss  # noqa: F401
+    from ..api_keys import use_shared_openai_session
+    from ..memory import LRUCache
+    from ..paper.vectorstore import get_text_splitter
+    from ..worker.handlers import HANDLERS, check_api_keys, run_review
+
+    check_api_keys()
+    get_text_splitter(tiktoken_encoder_model_name, chunk_size, chunk_overlap)
+    use_shared_openai_session()
+
+    handlers = dict(HANDLERS)
+    handlers["review"] = functools.partial(
+        run_review,
+        llm_cache=LRUCache(nb_max_llms),
+        paper_store_cache=LRUCache(nb_max_paper_stores),
+    )
+
+    logger.info(f"Warmed up in {time.perf_counter() - start:.2f}s")
+
+    return handlers
+
+
+class ReviewService(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """重い依存を読み込んだまま常駐し、UNIX ドメインソケットでジョブを受け付ける
+
+    ジョブは決まった数のスレッドで実行するので、同時に実行するジョブ数が nb_workers に制限される。
+    warm_up が返すハンドラは、API キー毎の LLM と作ったベクトルストアをジョブ間で使い回すので、
+    同じクエリのレビューを書き直す場合は論文の取得や埋め込みをやり直さない。OpenAI への HTTP の接続は
+    use_shared_openai_session で全てのスレッドとジョブの間で共有する。
+    """
+
+    daemon_threads = True
+
+    def __init__(
+            self,
+            handlers: Dict[str, Callable[[Dict[str, Any]], Dict[str, Any]]],
+            socket_path: str = SOCKET_PATH,
+            nb_workers: int = 2,
+    ):
+        remove_stale_socket(socket_path)
+        # 他のユーザーから接続されないように、作る時点で所有者のみが読み書きできるソケットにする
+        umask = os.umask(0o177)
+
+        try:
+            super().__init__(socket_path, RequestHandler)
+        finally:
+            os.umask(umask)
+
+        self.socket_path = socket_path
+        self.handlers = handlers
+        self.executor = ThreadPoolExecutor(max_workers=nb_workers)
+        self.started_at = time.time()
+        self.nb_jobs = 0
+        self.nb_running = 0
+        self._lock = threading.Lock()
+
+    def run_job(self, kind: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+
+        def run():
+            with self._lock:
+                self.nb_running += 1
+
+            start = time.perf_counter()
+
+            try:
+                return self.handlers[kind](payload)
+            finally:
+                with self._lock:
+                    self.nb_running -= 1
+                    self.nb_jobs += 1
+
+                logger.info(f"Job ({kind}) finished in {time.perf_counter() - start:.2f}s")
+
+        return self.executor.submit(run).result()
+
+    def get_status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "pid": os.getpid(),
+                "uptime": time.time() - self.started_at,
+                "nb_jobs": self.nb_jobs,
+                "nb_running": self.nb_running,
+            }
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+def remove_stale_socket(socket_path: str):
+    """前に動いていたサービスが残したソケットを削除する、まだサービスが動いていれば例外を送出する
+    """
+    if not os.path.exists(socket_path):
+        return
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.unlink(socket_path)
+            return
+
+    raise RuntimeError(f"Another service is already listening on {socket_path}")
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    server: ReviewService
+
+    def handle(self):
+        line = self.rfile.readline()
+
+        if not line:
+            return
+
+        try:
+            result = self.dispatch(json.loads(line))
+            response = {"ok": True, "result": result}
+        except Exception as e:
+            logger.exception(f"Request failed, {e}")
+            response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+
+        self.wfile.write(json.dumps(response, ensure_ascii=False).encode("utf-8") + b"\n")
+
+    def dispatch(self, message: Dict[str, Any]) -> Any:
+        command = message.get("command")
+
+        if command == "submit":
+            return self.server.run_job(message["kind"], message["payload"])
+        elif command == "ping":
+            return self.server.get_status()
+        elif command == "stop":
+            # serve_forever を回しているスレッド以外から呼ぶ必要がある
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return self.server.get_status()
+
+        raise ValueError(f"Unknown command: {command}")
+
+
+def serve(
+        socket_path: str = SOCKET_PATH,
+        nb_workers: int = 2,
+        handlers: Optional[Dict] = None,
+        nb_max_paper_stores: int = 8,
+):
+    handlers = handlers if handlers is not None else warm_up(nb_max_paper_stores=nb_max_paper_stores)
+
+    with ReviewService(handlers, socket_path, nb_workers) as service:
+        logger.info(f"Listening on {socket_path} with {nb_workers} workers")
+        service.serve_forever()
+
+    logger.info("Stopped")
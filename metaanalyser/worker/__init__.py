@@ -0,0 +1,10 @@
+from .jobs import Job, JobQueue, LeaseLost
+from .worker import Worker
+
+
+__all__ = [
+    "Job",
+    "JobQueue",
+    "LeaseLost",
+    "Worker",
+]
@@ -0,0 +1,90 @@
+import argparse
+import json
+import logging
+
+from .jobs import JOB_STATUSES, QUEUE_PATH, JobQueue
+from .worker import Worker
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Enqueue review jobs and process them with any number of workers."
+    )
+    parser.add_argument(
+        "--queue-path",
+        default=QUEUE_PATH,
+        help="path of the SQLite job queue (default: METAANALYSER_QUEUE_PATH)",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = subparsers.add_parser("enqueue", help="add a job to the queue")
+    enqueue_parser.add_argument("query")
+    enqueue_parser.add_argument("--kind", choices=["review", "ingest"], default="review")
+    enqueue_parser.add_argument(
+        "--options",
+        default="{}",
+        help='JSON of options passed to SRChain or search_on_google_scholar, e.g. {"nb_papers": 20}',
+    )
+    enqueue_parser.add_argument("--output-path", help="file the review is written to (review only)")
+    enqueue_parser.add_argument("--max-attempts", type=int, default=3)
+
+    work_parser = subparsers.add_parser("work", help="process jobs until stopped")
+    work_parser.add_argument("--kinds", nargs="+", choices=["review", "ingest"])
+    work_parser.add_argument("--max-jobs", type=int)
+    work_parser.add_argument("--stop-when-empty", action="store_true")
+    work_parser.add_argument("--lease-seconds", type=float, default=600.0)
+    work_parser.add_argument("--poll-interval", type=float, default=5.0)
+
+    status_parser = subparsers.add_parser("status", help="show the number of jobs by status")
+    status_parser.add_argument("--job-id", type=int)
+    status_parser.add_argument("--status", choices=JOB_STATUSES)
+    status_parser.add_argument("--limit", type=int, default=20)
+
+    args = parser.parse_args()
+    queue = JobQueue(args.queue_path)
+
+    if args.command == "enqueue":
+        payload = {"query": args.query, **json.loads(args.options)}
+
+        if args.output_path is not None:
+            payload["output_path"] = args.output_path
+
+        job_id = queue.enqueue(args.kind, payload, max_attempts=args.max_attempts)
+        print(job_id)
+    elif args.command == "work":
+        # ハンドラは langchain や spaCy などの重い依存を持つので、ワーカーを起動する場合のみ読み込む
+        from ..api_keys import use_shared_openai_session
+        from .handlers import HANDLERS, check_api_keys
+
+        logging.basicConfig()
+        logging.getLogger("metaanalyser").setLevel(level=logging.INFO)
+        check_api_keys()
+        use_shared_openai_session()
+
+        handlers = {k: h for k, h in HANDLERS.items() if not args.kinds or k in args.kinds}
+        worker = Worker(
+            queue,
+            handlers,
+            lease_seconds=args.lease_seconds,
+            poll_interval=args.poll_interval,
+        )
+        worker.run(max_jobs=args.max_jobs, stop_when_empty=args.stop_when_empty)
+    elif args.job_id is not None:
+        job = queue.get(args.job_id)
+
+        if job is None:
+            parser.error(f"Job {args.job_id} is not found")
+
+        print(job.json(indent=2, ensure_ascii=False))
+    else:
+        print(", ".join(f"{status}: {n}" for status, n in queue.counts().items()))
+
+        for job in queue.list_jobs(args.status, args.limit):
+            print(
+                f"{job.id}\t{job.kind}\t{job.status}\t{job.attempts}/{job.max_attempts}"
+                f"\t{job.updated_at:%Y-%m-%d %H:%M:%S}\t{job.payload['query']}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import logging
+import os
+from typing import Any, Callable, Dict, Optional
+
+from ..api_keys import create_chat_model, resolve_openai_api_key
+from ..cancellation import CancellationToken
+from ..chains import SRChain
+from ..memory import LRUCache
+from ..paper import search_on_google_scholar
+
+logger = logging.getLogger(__name__)
+
+
+def run_review(
+        payload: Dict[str, Any],
+        cancellation_token: Optional[CancellationToken] = None,
+        llm_cache: Optional[LRUCache] = None,
+        paper_store_cache: Optional[LRUCache] = None,
+) -> Dict[str, Any]:
+    """payload["query"] のシステマティックレビューを書く
+
+    payload の query と output_path 以外のキー (nb_papers, extraction_mode など) は SRChain にそのまま渡す。
+    output_path が指定されていれば、書き上がったセクションから順にそのファイルへ書き出し、結果にはレビューの本文の
+    代わりにそのパスを返す (キューの結果の列にレビュー全体を保存しない)。
+    llm_cache と paper_store_cache が指定されていれば、API キー毎の LLM と作ったベクトルストアをジョブ間で使い回す。
+    cancellation_token が取り消されると (ワーカーがリースを失った場合など)、RunCancelled を送出して途中で止める。
+    """
+    options = dict(payload)
+    query = options.pop("query")
+    openai_api_key = resolve_openai_api_key(options.get("openai_api_key"))
+    llm = llm_cache.get(openai_api_key) if llm_cache is not None else None
+
+    if llm is None:
+        llm = create_chat_model(openai_api_key, temperature=0)
+
+        if llm_cache is not None:
+            llm_cache.put(openai_api_key, llm)
+
+    chain = SRChain(llm=llm, paper_store_cache=paper_store_cache, **options)
+
+    logger.info(f"Writing a review of `{query}`.")
+    text = chain.run({"query": query, "cancellation_token": cancellation_token})
+
+    if chain.output_path is not None:
+        return {"output_path": chain.output_path}
+
+    return {"text": text}
+
+
+def run_ingest(
+        payload: Dict[str, Any],
+        cancellation_token: Optional[CancellationToken] = None,
+) -> Dict[str, Any]:
+    """payload["query"] で検索した論文を取得して、共有のコーパスに取り込むだけのジョブ
+
+    レビューを書く前に論文の取得を別のワーカーに分散させておくと、review ジョブはコーパスから論文を読むだけで済む。
+    """
+    options = dict(payload)
+    query = options.pop("query")
+    papers = search_on_google_scholar(query, cancellation_token=cancellation_token, **options)
+
+    return {"arxiv_ids": [p.arxiv_id for p in papers]}
+
+
+HANDLERS: Dict[str, Callable[..., Dict[str, Any]]] = {
+    "review": run_review,
+    "ingest": run_ingest,
+}
+
+
+def check_api_keys():
+    missing = [k for k in ["OPENAI_API_KEY", "SERPAPI_API_KEY"] if k not in os.environ]
+
+    if missing:
+        raise RuntimeError(f"Environment variables {', '.join(missing)} are required")
@@ -0,0 +1,277 @@
+import contextlib
+import datetime
+import json
+import os
+import sqlite3
+import time
+from pydantic import BaseModel
+from typing import Any, ContextManager, Dict, Iterator, List, Optional
+
+from ..memory import CACHE_DIR
+
+# 複数のマシンで共有する場合は、全てのマシンから見えるファイルシステム上に置く
+QUEUE_PATH = os.environ.get(
+    "METAANALYSER_QUEUE_PATH",
+    os.path.join(CACHE_DIR, "queue.sqlite3")
+)
+
+JOB_STATUSES = ["queued", "running", "done", "failed"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    available_at REAL NOT NULL,
+    lease_owner TEXT,
+    lease_expires_at REAL,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status_available_at ON jobs (status, available_at);
+"""
+
+
+class Job(BaseModel):
+    """キューに積まれたジョブ、kind で処理するハンドラを決める
+    """
+
+    id: int
+    kind: str
+    payload: Dict[str, Any]
+    status: str
+    attempts: int
+    max_attempts: int
+    lease_owner: Optional[str]
+    lease_expires_at: Optional[datetime.datetime]
+    result: Optional[Dict[str, Any]]
+    error: Optional[str]
+    created_at: datetime.datetime
+    updated_at: datetime.datetime
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row) -> "Job":
+        def to_datetime(t: Optional[float]) -> Optional[datetime.datetime]:
+            return datetime.datetime.fromtimestamp(t) if t is not None else None
+
+        return cls(
+            id=row["id"],
+            kind=row["kind"],
+            payload=json.loads(row["payload"]),
+            status=row["status"],
+            attempts=row["attempts"],
+            max_attempts=row["max_attempts"],
+            lease_owner=row["lease_owner"],
+            lease_expires_at=to_datetime(row["lease_expires_at"]),
+            result=json.loads(row["result"]) if row["result"] is not None else None,
+            error=row["error"],
+            created_at=to_datetime(row["created_at"]),
+            updated_at=to_datetime(row["updated_at"]),
+        )
+
+
+class LeaseLost(Exception):
+    """リースが切れて、ジョブが他のワーカーに渡った
+    """
+
+
+class JobQueue:
+    """SQLite のファイルをバックエンドとする永続的なジョブキュー
+
+    ワーカーはジョブをリースして処理し、処理中は heartbeat でリースを延長する。
+    リースが切れたジョブ (ワーカーが落ちた場合など) は他のワーカーが取り直す。
+    失敗したジョブは max_attempts 回まで、retry_delay * 2^(attempts - 1) 秒待ってから再試行する。
+
+    NOTE: SQLite のロックは NFS などでは当てにならないことがあるので、
+    複数のマシンで共有する場合はロックが正しく動くファイルシステムに置く
+    """
+
+    def __init__(self, path: str = QUEUE_PATH, retry_delay: float = 30.0):
+        self.path = path
+        self.retry_delay = retry_delay
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def enqueue(self, kind: str, payload: Dict[str, Any], max_attempts: int = 3) -> int:
+        now = time.time()
+
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO jobs (kind, payload, max_attempts, available_at, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, json.dumps(payload), max_attempts, now, now, now),
+            )
+            return cursor.lastrowid
+
+    def lease(
+            self,
+            worker_id: str,
+            kinds: Optional[List[str]] = None,
+            lease_seconds: float = 600.0,
+    ) -> Optional[Job]:
+        """処理できるジョブを一つリースする、なければ None を返す
+        """
+        now = time.time()
+
+        with self._transaction() as conn:
+            self._expire_leases(conn, now)
+
+            query = "SELECT * FROM jobs WHERE status = 'queued' AND available_at <= ?"
+            params: List[Any] = [now]
+
+            if kinds:
+                query += f" AND kind IN ({', '.join('?' for _ in kinds)})"
+                params += kinds
+
+            row = conn.execute(query + " ORDER BY available_at, id LIMIT 1", params).fetchone()
+
+            if row is None:
+                return None
+
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1,"
+                " lease_owner = ?, lease_expires_at = ?, updated_at = ? WHERE id = ?",
+                (worker_id, now + lease_seconds, now, row["id"]),
+            )
+
+            return self._get(conn, row["id"])
+
+    def heartbeat(self, job_id: int, worker_id: str, lease_seconds: float = 600.0):
+        now = time.time()
+
+        with self._transaction() as conn:
+            self._update_leased(
+                conn,
+                job_id,
+                worker_id,
+                "lease_expires_at = ?, updated_at = ?",
+                (now + lease_seconds, now),
+            )
+
+    def complete(self, job_id: int, worker_id: str, result: Dict[str, Any]):
+        """リースが切れていなければジョブを完了とする、切れていれば (他のワーカーが取り直すので) LeaseLost を送出する
+        """
+        now = time.time()
+
+        with self._transaction() as conn:
+            self._update_leased(
+                conn,
+                job_id,
+                worker_id,
+                "status = 'done', result = ?, error = NULL,"
+                " lease_owner = NULL, lease_expires_at = NULL, updated_at = ?",
+                (json.dumps(result), now),
+                now,
+            )
+
+    def fail(self, job_id: int, worker_id: str, error: str) -> Job:
+        """ジョブを失敗とする、試行回数が残っていれば待ち行列に戻す
+        """
+        now = time.time()
+
+        with self._transaction() as conn:
+            job = self._get(conn, job_id)
+
+            if job.attempts < job.max_attempts:
+                status = "queued"
+                available_at = now + self.retry_delay * 2 ** (job.attempts - 1)
+            else:
+                status, available_at = "failed", now
+
+            self._update_leased(
+                conn,
+                job_id,
+                worker_id,
+                "status = ?, error = ?, available_at = ?,"
+                " lease_owner = NULL, lease_expires_at = NULL, updated_at = ?",
+                (status, error, available_at, now),
+            )
+
+            return self._get(conn, job_id)
+
+    def get(self, job_id: int) -> Optional[Job]:
+        with self._connect() as conn:
+            return self._get(conn, job_id)
+
+    def list_jobs(self, status: Optional[str] = None, limit: int = 20) -> List[Job]:
+        with self._connect() as conn:
+            if status is None:
+                rows = conn.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,))
+            else:
+                rows = conn.execute(
+                    "SELECT * FROM jobs WHERE status = ? ORDER BY id DESC LIMIT ?",
+                    (status, limit),
+                )
+
+            return [Job.from_row(row) for row in rows]
+
+    def counts(self) -> Dict[str, int]:
+        with self._connect() as conn:
+            counts = {s: 0 for s in JOB_STATUSES}
+            counts.update(dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")))
+            return counts
+
+    def _expire_leases(self, conn: sqlite3.Connection, now: float):
+        # リースが切れたジョブは、試行回数が残っていれば待ち行列に戻す
+        conn.execute(
+            "UPDATE jobs SET status = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,"
+            " error = 'lease expired', lease_owner = NULL, lease_expires_at = NULL, updated_at = ?"
+            " WHERE status = 'running' AND lease_expires_at < ?",
+            (now, now),
+        )
+
+    def _update_leased(
+            self,
+            conn: sqlite3.Connection,
+            job_id: int,
+            worker_id: str,
+            assignments: str,
+            params: tuple,
+            unexpired_at: Optional[float] = None,
+    ):
+        """worker_id がリースしているジョブを更新する、unexpired_at が指定されていればその時点でリースが
+        切れていないことも確かめる
+        """
+        query = f"UPDATE jobs SET {assignments} WHERE id = ? AND status = 'running' AND lease_owner = ?"
+        params += (job_id, worker_id)
+
+        if unexpired_at is not None:
+            query += " AND lease_expires_at >= ?"
+            params += (unexpired_at,)
+
+        cursor = conn.execute(query, params)
+
+        if cursor.rowcount == 0:
+            raise LeaseLost(f"Worker {worker_id} no longer holds the lease of job {job_id}")
+
+    def _get(self, conn: sqlite3.Connection, job_id: int) -> Optional[Job]:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return Job.from_row(row) if row is not None else None
+
+    def _connect(self) -> ContextManager[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return contextlib.closing(conn)
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        # 複数のワーカーが同じジョブをリースしないよう、書き込みロックを先に取る
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+            conn.execute("COMMIT")
@@ -0,0 +1,111 @@
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from typing import Any, Callable, Dict, Optional
+
+from ..cancellation import CancellationToken
+from .jobs import Job, JobQueue, LeaseLost
+
+logger = logging.getLogger(__name__)
+
+
+class Worker:
+    """キューからジョブをリースして、kind に対応するハンドラで処理する
+
+    処理している間は別スレッドで定期的にリースを延長する。リースを失った場合 (他のワーカーに渡った場合) は
+    ハンドラに渡した CancellationToken を取り消して、処理を途中で止める。
+    キャッシュ (METAANALYSER_CACHE_DIR) やコーパス (METAANALYSER_CORPUS_DIR) を共有のファイルシステムに
+    置いておけば、ワーカー間で SerpApi や arXiv の結果、論文の本文と埋め込みが共有される。
+    """
+
+    def __init__(
+            self,
+            queue: JobQueue,
+            handlers: Dict[str, Callable[..., Dict[str, Any]]],
+            worker_id: Optional[str] = None,
+            lease_seconds: float = 600.0,
+            poll_interval: float = 5.0,
+    ):
+        self.queue = queue
+        self.handlers = handlers
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+
+    def run(self, max_jobs: Optional[int] = None, stop_when_empty: bool = False) -> int:
+        """ジョブを処理し続ける、処理したジョブ数を返す
+        """
+        nb_jobs = 0
+
+        logger.info(f"Worker {self.worker_id} started, kinds: {', '.join(self.handlers)}")
+
+        while max_jobs is None or nb_jobs < max_jobs:
+            job = self.queue.lease(self.worker_id, list(self.handlers), self.lease_seconds)
+
+            if job is None:
+                if stop_when_empty:
+                    break
+
+                time.sleep(self.poll_interval)
+                continue
+
+            self.process(job)
+            nb_jobs += 1
+
+        return nb_jobs
+
+    def process(self, job: Job):
+        logger.info(f"Processing job {job.id} ({job.kind}), attempt {job.attempts} / {job.max_attempts}")
+        stop_heartbeat = threading.Event()
+        cancellation_token = CancellationToken()
+        heartbeat = threading.Thread(
+            target=self._heartbeat,
+            args=(job, stop_heartbeat, cancellation_token),
+            daemon=True,
+        )
+        heartbeat.start()
+        start = time.perf_counter()
+
+        try:
+            result = self.handlers[job.kind](job.payload, cancellation_token=cancellation_token)
+        except Exception as e:
+            stop_heartbeat.set()
+            heartbeat.join()
+            logger.exception(f"Job {job.id} failed, {e}")
+
+            try:
+                job = self.queue.fail(job.id, self.worker_id, traceback.format_exc())
+                logger.info(f"Job {job.id} is {job.status}")
+            except LeaseLost as e:
+                logger.warning(str(e))
+
+            return
+
+        stop_heartbeat.set()
+        heartbeat.join()
+
+        if cancellation_token.is_cancelled:
+            logger.warning(f"Job {job.id} finished after {cancellation_token.reason}, discarding the result")
+            return
+
+        try:
+            self.queue.complete(job.id, self.worker_id, result)
+            logger.info(f"Job {job.id} is done in {time.perf_counter() - start:.2f}s")
+        except LeaseLost as e:
+            logger.warning(str(e))
+
+    def _heartbeat(self, job: Job, stop: threading.Event, cancellation_token: CancellationToken):
+        while not stop.wait(self.lease_seconds / 3):
+            try:
+                self.queue.heartbeat(job.id, self.worker_id, self.lease_seconds)
+            except LeaseLost as e:
+                logger.warning(str(e))
+                cancellation_token.cancel("the lease is lost")
+                return
+            except Exception as e:
+                # 一時的にロックが取れないだけかもしれないので、次の周期で再試行する
+                logger.warning(f"Could not extend the lease of job {job.id}, {e}")
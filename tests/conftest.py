@@ -0,0 +1,115 @@
+import datetime
+import os
+import pytest
+import tempfile
+from typing import Callable, List, Optional
+
+# metaanalyser はキャッシュとコーパスのディレクトリを import 時に決めるので、テストでは一時ディレクトリを使う
+os.environ.setdefault("METAANALYSER_CACHE_DIR", tempfile.mkdtemp(prefix="metaanalyser-test-"))
+
+
+@pytest.fixture
+def make_paper():
+    """ネットワークに問合せずに Paper を作る
+    """
+    from metaanalyser.paper.paper import Citation, GoogleScholarItem, Paper
+
+    def make(
+            citation_id: int,
+            arxiv_id: Optional[str] = None,
+            title: Optional[str] = None,
+            summary: str = "",
+            text: Optional[str] = None,
+            nb_cited: int = 0,
+            **kwargs,
+    ) -> Paper:
+        arxiv_id = arxiv_id or f"2301.{citation_id:05d}"
+        title = title or f"Paper {citation_id}"
+
+        return Paper(
+            citation_id=citation_id,
+            google_scholar_item=GoogleScholarItem(
+                result_id=f"result-{arxiv_id}",
+                title=title,
+                link=f"https://arxiv.org/abs/{arxiv_id}",
+                nb_cited=nb_cited,
+                citations=[Citation(title="MLA", snippet=f"Author. \"{title}.\" arXiv ({arxiv_id}).")],
+            ),
+            entry_id=f"http://arxiv.org/abs/{arxiv_id}v1",
+            summary=summary,
+            published=datetime.datetime(2023, 1, 1),
+            primary_category="cs.CL",
+            categories=["cs.CL"],
+            text=text,
+            doi=None,
+            **kwargs,
+        )
+
+    return make
+
+
+@pytest.fixture
+def make_llm():
+    """OpenAI を呼ばずに、プロンプトから respond で応答を作る LLM を作る
+
+    トークン数は空白で区切った語の数で数える。
+    """
+    from langchain.llms.base import LLM
+
+    class FakeLLM(LLM):
+        respond: Callable[[str], str]
+        prompts: List[str] = []
+
+        @property
+        def _llm_type(self) -> str:
+            return "fake"
+
+        def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None) -> str:
+            self.prompts.append(prompt)
+            return self.respond(prompt)
+
+        def get_num_tokens(self, text: str) -> int:
+            return len(text.split())
+
+    def make(respond: Callable[[str], str]) -> LLM:
+        return FakeLLM(respond=respond)
+
+    return make
+
+
+@pytest.fixture
+def make_embeddings():
+    """OpenAI を呼ばずに、語のハッシュの頻度を正規化したベクトルを返す埋め込みを作る
+
+    語を共有するテキスト同士ほどコサイン類似度が高くなる。埋め込んだテキストは texts に記録する。
+    """
+    import re
+    import zlib
+    import numpy as np
+    from langchain.embeddings.base import Embeddings
+
+    class FakeEmbeddings(Embeddings):
+
+        model = "fake-embedding"
+
+        def __init__(self, dim: int):
+            self.dim = dim
+            self.texts: List[str] = []
+
+        def embed_documents(self, texts: List[str]) -> List[List[float]]:
+            return [self.embed_query(t) for t in texts]
+
+        def embed_query(self, text: str) -> List[float]:
+            self.texts.append(text)
+            vector = np.zeros(self.dim, dtype=np.float32)
+
+            for word in re.findall(r"\w+", text.lower()):
+                vector[zlib.crc32(word.encode("utf-8")) % self.dim] += 1
+
+            norm = np.linalg.norm(vector)
+            return list(vector / norm if norm > 0 else vector)
+
+    def make(dim: int = 64) -> Embeddings:
+        return FakeEmbeddings(dim)
+
+    return make
@@ -0,0 +1,107 @@
+import openai
+import threading
+from langchain.schema import HumanMessage
+
+from metaanalyser.api_keys import create_chat_model, use_shared_openai_session
+from metaanalyser.paper.vectorstore import get_embeddings
+
+
+class FakeOpenAIEndpoint:
+    """openai と同じく、api_key が渡されなければ openai.api_key で送ったものとして記録する
+    """
+
+    def __init__(self, response, get_session, nb_parties: int):
+        self.response = response
+        self.get_session = get_session
+        self.barrier = threading.Barrier(nb_parties, timeout=5)
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def create(self, **kwargs):
+        # 全てのセッションのリクエストが同時に送られている状態にする
+        self.barrier.wait()
+
+        with self.lock:
+            self.calls.append((self.get_session(kwargs), kwargs.get("api_key") or openai.api_key))
+
+        return self.response
+
+
+def run_sessions(sessions):
+    errors = []
+
+    def target(fn):
+        try:
+            fn()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=target, args=(fn,)) for fn in sessions]
+
+    for t in threads:
+        t.start()
+
+    for t in threads:
+        t.join()
+
+    assert not errors
+
+
+def test_chat_models_send_their_own_keys_concurrently(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-env")
+    monkeypatch.setattr(openai, "api_key", None)
+    endpoint = FakeOpenAIEndpoint({
+        "choices": [{"message": {"role": "assistant", "content": "ok"}}],
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+    }, lambda kwargs: kwargs["messages"][0]["content"], nb_parties=2)
+    monkeypatch.setattr(openai.ChatCompletion, "create", endpoint.create)
+
+    env_llm = create_chat_model(None, temperature=0)
+    user_llm = create_chat_model("sk-user", temperature=0)
+    # クライアントを作る度に langchain が openai.api_key を書き換える
+    assert openai.api_key == "sk-user"
+
+    run_sessions([
+        lambda: env_llm([HumanMessage(content="env")]),
+        lambda: user_llm([HumanMessage(content="user")]),
+    ])
+
+    assert sorted(endpoint.calls) == [("env", "sk-env"), ("user", "sk-user")]
+
+
+def test_embeddings_send_their_own_keys_concurrently(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-env")
+    monkeypatch.setattr(openai, "api_key", None)
+    endpoint = FakeOpenAIEndpoint(
+        {"data": [{"embedding": [1.0, 0.0]}]},
+        lambda kwargs: kwargs["input"][0],
+        nb_parties=2,
+    )
+    monkeypatch.setattr(openai.Embedding, "create", endpoint.create)
+
+    env_embeddings = get_embeddings(None)
+    user_embeddings = get_embeddings("sk-user")
+    assert openai.api_key == "sk-user"
+
+    run_sessions([
+        lambda: env_embeddings.embed_query("env"),
+        lambda: user_embeddings.embed_query("user"),
+    ])
+
+    assert sorted(endpoint.calls) == [("env", "sk-env"), ("user", "sk-user")]
+
+
+def test_openai_session_is_shared_across_threads(monkeypatch):
+    from openai import api_requestor
+
+    monkeypatch.setattr(openai, "requestssession", None)
+    session = use_shared_openai_session()
+    sessions = []
+
+    def target():
+        sessions.append(api_requestor._make_session())
+
+    run_sessions([target, target])
+
+    assert use_shared_openai_session() is session
+    assert sessions == [session, session]
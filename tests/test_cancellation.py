@@ -0,0 +1,119 @@
+import pytest
+import threading
+import time
+
+from metaanalyser.cancellation import CancellationToken, RunCancelled, raise_if_cancelled
+from metaanalyser.chains.scheduler import StageGraph
+from metaanalyser.paper import vectorstore
+from metaanalyser.paper.corpus import PaperChunks
+from metaanalyser.paper.ingest import run_pipeline
+
+
+def test_token_keeps_the_first_reason():
+    token = CancellationToken()
+    token.raise_if_cancelled()
+    raise_if_cancelled(None)
+
+    token.cancel("new query")
+    token.cancel("closed")
+
+    assert token.is_cancelled
+
+    with pytest.raises(RunCancelled, match="new query"):
+        raise_if_cancelled(token)
+
+
+def test_cancelled_graph_does_not_start_remaining_stages():
+    token = CancellationToken()
+    started = []
+
+    def overview(papers):
+        token.cancel("closed")
+        started.append("overview")
+
+    graph = StageGraph()
+    graph.add("papers", lambda: started.append("papers"))
+    graph.add("overview", overview, ["papers"])
+    graph.add("outline", lambda overview: started.append("outline"), ["overview"])
+
+    with pytest.raises(RunCancelled, match="closed"):
+        graph.run(cancellation_token=token)
+
+    assert started == ["papers", "overview"]
+
+
+def test_pipeline_passes_items_through_stages_in_order():
+    def slow_double(x):
+        time.sleep(0.01 * (x % 3))
+        return x * 2
+
+    results = list(run_pipeline(range(10), [("double", slow_double), ("add", lambda x: x + 1)]))
+
+    assert results == [x * 2 + 1 for x in range(10)]
+
+
+def test_cancelled_pipeline_stops_all_stages():
+    token = CancellationToken()
+    processed = []
+
+    def download(x):
+        processed.append(x)
+
+        if x == 2:
+            token.cancel("closed")
+
+        return x
+
+    nb_threads = threading.active_count()
+
+    with pytest.raises(RunCancelled, match="closed"):
+        list(run_pipeline(range(100), [("download", download), ("embed", lambda x: x)], cancellation_token=token))
+
+    # 取り消した後は新たな論文を取得しない
+    assert processed == [0, 1, 2]
+    assert threading.active_count() == nb_threads
+
+
+def test_pipeline_stops_when_the_reader_stops():
+    processed = []
+    nb_threads = threading.active_count()
+
+    for x in run_pipeline(range(100), [("download", lambda x: processed.append(x) or x)], nb_queue_size=1):
+        if x == 1:
+            break
+
+    # 先読みする件数は高々キューの長さの分だけ
+    assert len(processed) < 10
+    assert threading.active_count() == nb_threads
+
+
+def test_pipeline_raises_errors_of_stages():
+    def fail(x):
+        raise ValueError(f"failed on {x}")
+
+    with pytest.raises(ValueError, match="failed on 0"):
+        list(run_pipeline(range(3), [("fail", fail)]))
+
+
+def test_cancelled_vector_store_embeds_nothing(monkeypatch, make_embeddings, make_paper):
+    embeddings = make_embeddings()
+    token = CancellationToken()
+    split_papers = []
+
+    def split(p):
+        split_papers.append(p.citation_id)
+        token.cancel("closed")
+        return PaperChunks(texts=[p.text])
+
+    monkeypatch.setattr(vectorstore, "get_embeddings", lambda openai_api_key=None: embeddings)
+    monkeypatch.setattr(vectorstore, "get_paper_splitter", lambda *args: split)
+
+    with pytest.raises(RunCancelled):
+        vectorstore.create_papers_vectorstor(
+            [make_paper(1, text="a"), make_paper(2, text="b")],
+            corpus=None,
+            cancellation_token=token,
+        )
+
+    assert split_papers == [1]
+    assert embeddings.texts == []
@@ -0,0 +1,90 @@
+import arxiv
+import datetime
+import pytest
+
+from metaanalyser.paper import paper as paper_module
+from metaanalyser.paper.citation import create_local_citations, split_name
+
+
+def make_arxiv_result(authors, title="Toolformer:\n  Language Models Can Teach Themselves to Use Tools"):
+    return arxiv.Result(
+        entry_id="http://arxiv.org/abs/2302.04761v1",
+        published=datetime.datetime(2023, 2, 9),
+        title=title,
+        authors=[arxiv.Result.Author(a) for a in authors],
+        summary="summary",
+        primary_category="cs.CL",
+        categories=["cs.CL"],
+    )
+
+
+def test_citations_of_a_single_author():
+    citations = create_local_citations(make_arxiv_result(["Timo Schick"]))
+
+    assert citations == {
+        "MLA": "Schick, Timo. \"Toolformer: Language Models Can Teach Themselves to Use Tools.\""
+               " arXiv preprint arXiv:2302.04761 (2023).",
+        "APA": "Schick, T. (2023). Toolformer: Language Models Can Teach Themselves to Use Tools."
+               " arXiv preprint arXiv:2302.04761.",
+        "Chicago": "Schick, Timo. \"Toolformer: Language Models Can Teach Themselves to Use Tools.\""
+                   " arXiv preprint arXiv:2302.04761 (2023).",
+    }
+
+
+def test_citations_of_many_authors():
+    authors = ["Timo Schick", "Jane Dwivedi-Yu", "Roberto Dessì", "Roberta Raileanu"]
+    citations = create_local_citations(make_arxiv_result(authors))
+
+    assert citations["MLA"].startswith("Schick, Timo, et al. \"Toolformer")
+    assert citations["APA"].startswith("Schick, T., Dwivedi-Yu, J., Dessì, R., & Raileanu, R. (2023).")
+    assert citations["Chicago"].startswith(
+        "Schick, Timo, Jane Dwivedi-Yu, Roberto Dessì, and Roberta Raileanu. \"Toolformer"
+    )
+
+    citations = create_local_citations(make_arxiv_result(authors[:2]))
+
+    assert citations["MLA"].startswith("Schick, Timo, and Jane Dwivedi-Yu. \"Toolformer")
+
+    citations = create_local_citations(make_arxiv_result([f"Author{i} Name{i}" for i in range(9)]))
+
+    assert citations["APA"].startswith(
+        "Name0, A., Name1, A., Name2, A., Name3, A., Name4, A., Name5, A., ... & Name8, A. (2023)."
+    )
+
+
+@pytest.mark.parametrize("authors, title", [([], "Title"), (["Timo Schick"], "  ")])
+def test_no_citations_without_authors_or_title(authors, title):
+    assert create_local_citations(make_arxiv_result(authors, title)) is None
+
+
+def test_split_name():
+    assert split_name("Timo Schick") == ("Timo", "Schick")
+    assert split_name(" Jane  van Dwivedi ") == ("Jane van", "Dwivedi")
+    assert split_name("Plato") == ("", "Plato")
+
+
+@pytest.mark.parametrize("authors, nb_cite_calls", [(["Timo Schick"], 0), ([], 1)])
+def test_serpapi_is_asked_only_without_local_citations(monkeypatch, authors, nb_cite_calls):
+    cite_calls = []
+
+    def fetch_google_scholar_cite(result_id, serpapi_api_key=None):
+        cite_calls.append(result_id)
+        return {"citations": [{"title": "MLA", "snippet": "from SerpApi"}]}
+
+    monkeypatch.setattr(paper_module, "fetch_arxiv_result", lambda link: make_arxiv_result(authors))
+    monkeypatch.setattr(paper_module, "fetch_google_scholar_cite", fetch_google_scholar_cite)
+
+    paper = paper_module.Paper.from_google_scholar_result(
+        1,
+        {
+            "result_id": "result",
+            "title": "Toolformer",
+            "link": "https://arxiv.org/abs/2302.04761",
+            "inline_links": {},
+        },
+        citation_source="local",
+        fetch_text=False,
+    )
+
+    assert len(cite_calls) == nb_cite_calls
+    assert paper.mla_citiation.snippet.startswith("Schick" if authors else "from SerpApi")
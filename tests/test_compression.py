@@ -0,0 +1,67 @@
+from metaanalyser.chains.section.section import TextSplit, compress_splits
+from metaanalyser.chains.outline import Section
+from metaanalyser.chains.sr import FlattenSection
+from metaanalyser.paper.compression import compress_texts, is_boilerplate, split_sentences
+
+TEXT = (
+    "Language models can learn to call external tools. "
+    "Figure 2 shows the training pipeline of the model. "
+    "The weather in the lab was pleasant during the experiments. "
+    "Calling a calculator tool improves arithmetic accuracy of language models."
+)
+
+
+def test_relevant_sentences_are_kept_in_order():
+    [text] = compress_texts("language models calling tools", [TEXT], keep_ratio=0.5)
+
+    assert text == (
+        "Language models can learn to call external tools. "
+        "Calling a calculator tool improves arithmetic accuracy of language models."
+    )
+
+
+def test_sentences_without_query_terms_are_dropped():
+    [text] = compress_texts("calculator", [TEXT], keep_ratio=0.75)
+
+    assert text == "Calling a calculator tool improves arithmetic accuracy of language models."
+
+
+def test_at_least_one_sentence_is_kept():
+    texts = compress_texts("unrelated query", [TEXT, "Figure 1. Table 2."], keep_ratio=0.1)
+
+    assert texts[0] == "Language models can learn to call external tools."
+    # 根拠になる文がなければそのまま残す
+    assert texts[1] == "Figure 1. Table 2."
+
+
+def test_keep_ratio_one_returns_texts_as_they_are():
+    assert compress_texts("tools", [TEXT], keep_ratio=1.0) == [TEXT]
+
+
+def test_split_sentences():
+    assert split_sentences("First one.  Second one!\nThird [1] one? e.g. not split") == [
+        "First one.",
+        "Second one!",
+        "Third [1] one? e.g. not split",
+    ]
+
+
+def test_boilerplate_sentences():
+    assert is_boilerplate("Figure 3: accuracy of the models on the benchmark.")
+    assert is_boilerplate("[1], [2], [3].")
+    assert is_boilerplate("Code is available at https://github.com/example/repo for everyone.")
+    assert is_boilerplate("Too short.")
+    assert not is_boilerplate("Language models can learn to call external tools.")
+
+
+def test_snippets_are_compressed_towards_the_section():
+    section = FlattenSection(
+        level=2,
+        section=Section(title="Calculators", description="arithmetic with calculator tools", citation_ids=[1]),
+    )
+    splits = [TextSplit(title="Paper 1", citation_id=1, text=TEXT, relevance=0.5)]
+
+    [split] = compress_splits(section, splits, 0.25)
+
+    assert split.text == "Calling a calculator tool improves arithmetic accuracy of language models."
+    assert (split.title, split.citation_id, split.relevance) == ("Paper 1", 1, 0.5)
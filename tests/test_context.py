@@ -0,0 +1,103 @@
+from metaanalyser.chains.base import TokenUsage
+from metaanalyser.chains.outline import Outlint, Section
+from metaanalyser.chains.overview.prompt import Overview
+from metaanalyser.chains.section.section import get_input_list
+from metaanalyser.chains.sr import get_flatten_sections
+
+
+def make_section(title, children=None):
+    return Section(title=title, description=f"about {title}", citation_ids=[], children=children)
+
+
+OUTLINE = Outlint(
+    sections=[
+        make_section("Introduction"),
+        make_section("Methods", [make_section("Prompting"), make_section("Fine-tuning"), make_section("Tools")]),
+        make_section("Evaluation"),
+        make_section("Applications"),
+        make_section("Conclusion"),
+    ],
+    citations_ids=[],
+)
+OVERVIEW = Overview(
+    title="Review",
+    main_points=["point a", "point b"],
+    overview="First sentence. Second sentence! Third sentence? Fourth sentence.",
+)
+
+
+def test_compact_outline_describes_only_sections_near_the_current_one():
+    current = OUTLINE.sections[1].children[0]
+    lines = OUTLINE.to_compact_string(current).split("\n")
+
+    assert lines == [
+        "1. Introduction: about Introduction",
+        "2. Methods: about Methods",
+        "    1. Prompting: about Prompting",
+        "    2. Fine-tuning: about Fine-tuning",
+        "    3. Tools",
+        "3. Evaluation: about Evaluation",
+        "4. Applications",
+        "5. Conclusion",
+    ]
+
+
+def test_compact_outline_describes_children_of_the_current_section():
+    lines = OUTLINE.to_compact_string(OUTLINE.sections[4]).split("\n")
+
+    assert "4. Applications: about Applications" in lines
+    assert "1. Introduction" in lines
+    assert "2. Methods" in lines
+    assert "    1. Prompting" in lines
+
+    lines = OUTLINE.to_compact_string(OUTLINE.sections[1]).split("\n")
+
+    assert all(": about " in line for line in lines[:6])
+    assert lines[6:] == ["4. Applications", "5. Conclusion"]
+
+
+def test_compact_outline_of_unknown_section_is_the_full_outline():
+    assert OUTLINE.to_compact_string(make_section("Unknown")) == str(OUTLINE)
+
+
+def test_compact_overview_keeps_the_first_sentences():
+    assert OVERVIEW.to_compact_string() == (
+        "Title: Review\nPoints:\n  - point a\n  - point b\nOverview: First sentence. Second sentence!"
+    )
+    assert OVERVIEW.to_compact_string(nb_sentences=10) == str(OVERVIEW)
+
+
+def test_compact_context_tokens_are_counted(make_llm, make_paper):
+    llm = make_llm(lambda prompt: "")
+    flatten_sections = get_flatten_sections(OUTLINE)
+    token_usage = TokenUsage()
+
+    [inputs] = get_input_list(
+        llm, None, 2, "query", [make_paper(1)], OVERVIEW, OUTLINE, flatten_sections,
+        nb_categories=3, nb_token_limit=100, context_mode="compact",
+        token_usage=token_usage, evidence=["snippet"],
+    )
+
+    assert inputs["outline"] == OUTLINE.to_compact_string(flatten_sections[2].section)
+    assert inputs["overview"] == OVERVIEW.to_compact_string()
+    assert 0 < token_usage["context_tokens"] < token_usage["full_context_tokens"]
+
+    [inputs] = get_input_list(
+        llm, None, 2, "query", [make_paper(1)], OVERVIEW, OUTLINE, flatten_sections,
+        nb_categories=3, nb_token_limit=100, evidence=["snippet"],
+    )
+
+    assert inputs["outline"] == str(OUTLINE)
+    assert inputs["overview"] == str(OVERVIEW)
+
+
+def test_token_usage_sums_llm_outputs():
+    token_usage = TokenUsage()
+    token_usage.add_llm_output({"token_usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}})
+    token_usage.add_llm_output({"token_usage": {"prompt_tokens": 1, "completion_tokens": 2, "total_tokens": 3}})
+    token_usage.add_llm_output(None)
+
+    assert token_usage["prompt_tokens"] == 11
+    assert token_usage["total_tokens"] == 18
+    assert token_usage["nb_calls"] == 3
+    assert str(token_usage).startswith("prompt_tokens=11, completion_tokens=7, total_tokens=18")
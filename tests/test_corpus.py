@@ -0,0 +1,71 @@
+import numpy as np
+
+from metaanalyser.paper import paper as paper_module
+from metaanalyser.paper.corpus import PaperChunks, PaperCorpus
+
+
+def test_paper_is_shared_across_queries_with_their_citation_ids(tmp_path, make_paper):
+    corpus = PaperCorpus(str(tmp_path))
+    corpus.put_paper("2301.00001", make_paper(1, "2301.00001", text="body"))
+
+    paper = corpus.get_paper("2301.00001", citation_id=7)
+
+    assert paper.citation_id == 7
+    assert paper.text == "body"
+    assert corpus.get_paper("2301.00002", citation_id=1) is None
+
+
+def test_old_style_arxiv_ids_are_stored(tmp_path, make_paper):
+    corpus = PaperCorpus(str(tmp_path))
+    corpus.put_paper("cs/0101001", make_paper(1, "cs/0101001"))
+
+    assert corpus.get_paper("cs/0101001", citation_id=1).arxiv_id == "cs/0101001"
+
+
+def test_chunks_keep_partial_embeddings(tmp_path):
+    corpus = PaperCorpus(str(tmp_path))
+    chunks = PaperChunks(texts=["a", "b", "c"])
+    chunks.set_embeddings([0, 2], np.ones((2, 4), dtype=np.float32))
+    corpus.put_chunks("2301.00001", "key", chunks)
+
+    loaded = corpus.get_chunks("2301.00001", "key")
+
+    assert loaded.texts == ["a", "b", "c"]
+    assert [loaded.has_embedding(i) for i in range(3)] == [True, False, True]
+    assert corpus.get_chunks("2301.00001", "other-key") is None
+
+
+def test_new_text_drops_stale_chunks(tmp_path, make_paper):
+    corpus = PaperCorpus(str(tmp_path))
+    corpus.put_chunks("2301.00001", "key", PaperChunks(texts=["old"]))
+
+    corpus.put_paper("2301.00001", make_paper(1, "2301.00001", text="new"))
+
+    assert corpus.get_chunks("2301.00001", "key") is None
+
+
+def test_search_reads_papers_from_the_corpus(tmp_path, monkeypatch, make_paper):
+    corpus = PaperCorpus(str(tmp_path))
+    corpus.put_paper("2301.00001", make_paper(1, "2301.00001", text="body"))
+    fetched = []
+
+    def fetch_google_scholar(query, start, serpapi_api_key=None):
+        return [
+            {"title": f"Paper {i}", "link": f"https://arxiv.org/abs/2301.0000{i}"}
+            for i in [2, 1]
+        ]
+
+    def from_google_scholar_result(citation_id, item, **kwargs):
+        fetched.append(item["link"])
+        return make_paper(citation_id, item["link"].rsplit("/", 1)[1])
+
+    monkeypatch.setattr(paper_module, "fetch_google_scholar", fetch_google_scholar)
+    monkeypatch.setattr(paper_module.Paper, "from_google_scholar_result", from_google_scholar_result)
+
+    papers = paper_module.search_on_google_scholar("query", n=2, corpus=corpus, fetch_text=False)
+
+    assert [(p.citation_id, p.arxiv_id) for p in papers] == [(1, "2301.00002"), (2, "2301.00001")]
+    assert papers[1].text == "body"
+    # 新たに取得した論文はコーパスに保存される
+    assert fetched == ["https://arxiv.org/abs/2301.00002"]
+    assert corpus.get_paper("2301.00002", citation_id=1) is not None
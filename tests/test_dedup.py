@@ -0,0 +1,58 @@
+from metaanalyser.paper.dedup import MinHashDeduplicator, get_optimal_bands, get_shingles
+
+TEXT = (
+    "Large language models can use external tools such as search engines and calculators "
+    "by generating API calls, and recent work trains them to decide when to call which tool "
+    "and how to incorporate the results into the generated text."
+)
+
+
+def test_exact_and_near_duplicates_are_rejected():
+    deduplicator = MinHashDeduplicator(threshold=0.8)
+
+    assert deduplicator.add(TEXT)
+    assert not deduplicator.add(TEXT)
+    # 大文字小文字や句読点の違いは重複とみなす
+    assert not deduplicator.add(TEXT.upper().replace(",", ""))
+
+
+def test_different_texts_are_kept():
+    deduplicator = MinHashDeduplicator(threshold=0.8)
+
+    assert deduplicator.add(TEXT)
+    assert deduplicator.add(
+        "Pitman-Yor processes generalize the Dirichlet process and give power-law "
+        "distributions of word frequencies that match natural language better."
+    )
+    # 半分以上が異なるテキストは重複としない
+    words = TEXT.split()
+    assert deduplicator.add(" ".join(words[:len(words) // 3] + ["unrelated"] * 20))
+
+
+def test_empty_text_is_always_added():
+    deduplicator = MinHashDeduplicator()
+
+    assert deduplicator.add("")
+    assert deduplicator.add("  ...  ")
+
+
+def test_signature_is_deterministic_for_the_same_seed():
+    shingles = get_shingles(TEXT, 5)
+
+    assert (
+        MinHashDeduplicator(seed=3)._get_signature(shingles)
+        == MinHashDeduplicator(seed=3)._get_signature(shingles)
+    ).all()
+
+
+def test_shingles():
+    assert get_shingles("A b, c", 5) == {"a b c"}
+    assert get_shingles("a b c d", 3) == {"a b c", "b c d"}
+    assert get_shingles("", 3) == set()
+
+
+def test_optimal_bands_cover_all_permutations():
+    nb_bands, nb_rows = get_optimal_bands(0.8, 128)
+
+    assert nb_bands * nb_rows == 128
+    assert abs((1 / nb_bands) ** (1 / nb_rows) - 0.8) < 0.1
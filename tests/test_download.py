@@ -0,0 +1,101 @@
+import http.server
+import os
+import threading
+import pytest
+import requests
+
+from metaanalyser.paper.download import download_file, get_total_size
+
+CONTENT = bytes(range(256)) * 400
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # 最初のリクエストは途中で接続を閉じる
+    nb_truncated_responses = 1
+    supports_range = True
+    requests = []
+
+    def do_GET(self):
+        if self.path == "/missing":
+            self.send_error(404)
+            return
+
+        range_header = self.headers.get("Range")
+        self.requests.append(range_header)
+        offset = int(range_header[len("bytes="):-1]) if range_header and self.supports_range else 0
+        body = CONTENT[offset:]
+
+        self.send_response(206 if offset else 200)
+        self.send_header("Content-Length", str(len(body)))
+
+        if offset:
+            self.send_header("Content-Range", f"bytes {offset}-{len(CONTENT) - 1}/{len(CONTENT)}")
+
+        self.end_headers()
+
+        if Handler.nb_truncated_responses > 0:
+            Handler.nb_truncated_responses -= 1
+            self.wfile.write(body[:len(body) // 3])
+            return
+
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    Handler.nb_truncated_responses = 1
+    Handler.supports_range = True
+    Handler.requests = []
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_truncated_download_is_resumed_with_a_range_request(server, tmp_path):
+    file_path = str(tmp_path / "paper.pdf")
+
+    download_file(f"{server}/paper.pdf", file_path, backoff_factor=0, chunk_size=1024)
+
+    with open(file_path, "rb") as f:
+        assert f.read() == CONTENT
+
+    assert Handler.requests[0] is None
+    assert Handler.requests[1] is not None and Handler.requests[1] != "bytes=0-"
+    assert os.listdir(tmp_path) == ["paper.pdf"]
+
+
+def test_download_restarts_when_range_is_not_supported(server, tmp_path):
+    Handler.supports_range = False
+    file_path = str(tmp_path / "paper.pdf")
+
+    download_file(f"{server}/paper.pdf", file_path, backoff_factor=0, chunk_size=1024)
+
+    with open(file_path, "rb") as f:
+        assert f.read() == CONTENT
+
+
+def test_failed_download_leaves_no_part_file(server, tmp_path):
+    with pytest.raises(requests.HTTPError):
+        download_file(f"{server}/missing", str(tmp_path / "paper.pdf"), backoff_factor=0)
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_total_size_is_read_from_content_range():
+    response = requests.Response()
+    response.status_code = 206
+    response.headers.update({"Content-Range": "bytes 100-199/1000", "Content-Length": "100"})
+
+    assert get_total_size(response) == 1000
+
+    response.headers["Content-Encoding"] = "gzip"
+
+    assert get_total_size(response) is None
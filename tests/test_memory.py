@@ -0,0 +1,56 @@
+import numpy as np
+
+from metaanalyser.memory import LRUMemory, get_disk_usage
+
+
+def create_memory(tmp_path, monkeypatch, **kwargs):
+    memory = LRUMemory(str(tmp_path), verbose=0, **kwargs)
+    nb_listings = []
+    get_items = memory.store_backend.get_items
+
+    def counting_get_items():
+        nb_listings.append(1)
+        return get_items()
+
+    monkeypatch.setattr(memory.store_backend, "get_items", counting_get_items)
+
+    return memory, nb_listings
+
+
+def test_misses_do_not_list_the_cache_every_time(tmp_path, monkeypatch):
+    memory, nb_listings = create_memory(tmp_path, monkeypatch, bytes_limit="10M", reduce_size_interval=10)
+    square = memory.cache(lambda x: x * x)
+
+    for x in range(30):
+        assert square(x) == x * x
+
+    # 最初の書き込みで一度確かめた後は、10 回書き込む毎に確かめる
+    assert len(nb_listings) == 3
+
+
+def test_cache_is_kept_under_the_limit(tmp_path, monkeypatch):
+    memory, nb_listings = create_memory(
+        tmp_path,
+        monkeypatch,
+        bytes_limit=100_000,
+        reduce_size_interval=1_000,
+    )
+    create = memory.cache(lambda seed: np.random.RandomState(seed).bytes(30_000))
+
+    for seed in range(10):
+        create(seed)
+
+    # 最初の書き込みと、記録している容量が上限を超えた時のみ確かめる
+    assert len(nb_listings) < 10
+    assert sum(u["bytes"] for u in get_disk_usage(memory).values()) <= 100_000
+
+
+def test_hits_are_recorded(tmp_path, monkeypatch):
+    memory, _ = create_memory(tmp_path, monkeypatch)
+    square = memory.cache(lambda x: x * x)
+    square(2)
+    square(2)
+
+    stats = list(memory.stats.values())[0]
+
+    assert stats["misses"] == 1 and stats["hits"] == 1
@@ -0,0 +1,56 @@
+import numpy as np
+
+from metaanalyser.paper.packing import PackItem, pack_with_token_limit
+
+
+def test_packing_by_relevance_skips_texts_over_the_budget():
+    items = [
+        PackItem(text="a", num_tokens=40, relevance=0.9),
+        PackItem(text="b", num_tokens=70, relevance=0.8),
+        PackItem(text="c", num_tokens=50, relevance=0.7),
+        PackItem(text="d", num_tokens=10, relevance=0.1),
+    ]
+
+    # b は残りの予算に収まらないので飛ばし、後続の c と d で予算を使い切る
+    assert pack_with_token_limit(items, 100) == [0, 2, 3]
+
+
+def test_same_relevance_keeps_the_order_of_items():
+    items = [PackItem(text=str(i), num_tokens=1) for i in range(5)]
+
+    assert pack_with_token_limit(items, 3) == [0, 1, 2]
+    assert pack_with_token_limit(items, 0) == []
+    assert pack_with_token_limit([], 10) == []
+
+
+def test_mmr_prefers_texts_unlike_the_selected_ones():
+    items = [
+        PackItem(text="a", num_tokens=10, relevance=1.0, vector=np.array([1.0, 0.0])),
+        PackItem(text="a'", num_tokens=10, relevance=0.95, vector=np.array([1.0, 0.01])),
+        PackItem(text="b", num_tokens=10, relevance=0.8, vector=np.array([0.0, 1.0])),
+    ]
+
+    assert pack_with_token_limit(items, 20, mmr_lambda=1.0) == [0, 1]
+    assert pack_with_token_limit(items, 20, mmr_lambda=0.5) == [0, 2]
+
+
+def test_chunks_of_the_same_paper_are_redundant_without_vectors():
+    items = [
+        PackItem(text="1-a", num_tokens=10, relevance=1.0, group=1),
+        PackItem(text="1-b", num_tokens=10, relevance=0.9, group=1),
+        PackItem(text="2-a", num_tokens=10, relevance=0.7, group=2),
+    ]
+
+    assert pack_with_token_limit(items, 20, mmr_lambda=1.0) == [0, 1]
+    assert pack_with_token_limit(items, 20, mmr_lambda=0.7) == [0, 2]
+
+
+def test_items_without_vectors_are_packed_with_the_others():
+    items = [
+        PackItem(text="summary", num_tokens=10, relevance=1.0),
+        PackItem(text="a", num_tokens=10, relevance=0.9, vector=np.array([1.0, 0.0])),
+        PackItem(text="a'", num_tokens=10, relevance=0.85, vector=np.array([1.0, 0.0])),
+        PackItem(text="zero", num_tokens=10, relevance=0.5, vector=np.zeros(2)),
+    ]
+
+    assert pack_with_token_limit(items, 30, mmr_lambda=0.5) == [0, 1, 3]
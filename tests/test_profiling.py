@@ -0,0 +1,47 @@
+import os
+import pstats
+
+from metaanalyser.chains.base import run_concurrently
+from metaanalyser.paper.ingest import run_pipeline
+from metaanalyser.profiling import StageProfiler, in_current_stage
+
+
+def work_in_pool(x: int) -> int:
+    return sum(i * x for i in range(1000))
+
+
+def work_in_pipeline(x: int) -> int:
+    return sum(i * x for i in range(1000))
+
+
+def get_function_names(output_dir: str, name: str):
+    stats = pstats.Stats(os.path.join(output_dir, f"{name}.pstats"))
+    return {func_name for _, _, func_name in stats.stats}
+
+
+def test_stage_records_functions_run_in_a_pool(tmp_path):
+    profiler = StageProfiler(str(tmp_path))
+
+    with profiler.stage("map_reduce"):
+        results = run_concurrently(work_in_pool, list(range(8)), nb_max_concurrency=4)
+
+    profiler.dump()
+
+    assert results == [work_in_pool(x) for x in range(8)]
+    assert "work_in_pool" in get_function_names(str(tmp_path), "map_reduce")
+
+
+def test_stage_records_functions_run_in_a_pipeline(tmp_path):
+    profiler = StageProfiler(str(tmp_path))
+
+    with profiler.stage("vectorstore"):
+        results = list(run_pipeline(range(4), [("work", work_in_pipeline)]))
+
+    profiler.dump()
+
+    assert results == [work_in_pipeline(x) for x in range(4)]
+    assert "work_in_pipeline" in get_function_names(str(tmp_path), "vectorstore")
+
+
+def test_in_current_stage_returns_fn_outside_stages():
+    assert in_current_stage(work_in_pool) is work_in_pool
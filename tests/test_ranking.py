@@ -0,0 +1,112 @@
+import pytest
+
+from metaanalyser.paper import paper as paper_module
+from metaanalyser.paper.ranking import BM25Index, bm25_scores, rank_papers, tokenize
+
+
+def test_bm25_prefers_documents_with_rare_query_terms():
+    docs_tokens = [
+        tokenize("language models use tools"),
+        tokenize("language models"),
+        tokenize("a survey of graph neural networks"),
+    ]
+
+    scores = bm25_scores(tokenize("tools for language models"), docs_tokens)
+
+    assert scores[0] > scores[1] > scores[2] == 0
+    assert bm25_scores(["tools"], []) == []
+
+
+def test_title_matches_count_more_than_abstract_matches():
+    scores = rank_papers(
+        "tool use",
+        ["Tool use of language models", "Language models"],
+        ["We study language models.", "We study tool use of language models."],
+        [0, 0],
+    )
+
+    assert scores[0] > scores[1]
+
+
+def test_citations_break_ties_of_relevance():
+    scores = rank_papers("tool use", ["Tool use", "Tool use", "Unrelated"], ["", "", ""], [10, 1000, 1000])
+
+    assert scores[1] > scores[0]
+    assert scores[1] == 1.0
+    # 被引用数が多くても関連しない論文は上位にならない
+    assert scores[2] < scores[0]
+
+
+def test_citation_weight_zero_ranks_by_relevance_only():
+    scores = rank_papers("tool use", ["Tool use", "Unrelated"], ["", ""], [0, 10_000], citation_weight=0.0)
+
+    assert scores == [1.0, 0.0]
+    assert rank_papers("tool use", [], [], []) == []
+
+
+def test_full_text_is_selected_for_top_papers(make_paper):
+    papers = [
+        make_paper(1, title="Graph neural networks"),
+        make_paper(2, title="Tool use of language models", nb_cited=100),
+        make_paper(3, title="Language models call tools", summary="tool use"),
+    ]
+
+    assert paper_module.select_full_text_papers("tool use", papers, None) == {0, 1, 2}
+    assert paper_module.select_full_text_papers("tool use", papers, 5) == {0, 1, 2}
+    assert paper_module.select_full_text_papers("tool use", papers, 2) == {1, 2}
+    assert paper_module.select_full_text_papers("tool use", papers, 0) == set()
+
+
+def test_search_downloads_only_top_papers(monkeypatch, make_paper):
+    papers = {
+        f"2301.0000{i}": make_paper(i, f"2301.0000{i}", title=title)
+        for i, title in enumerate(["Graph neural networks", "Tool use", "Tool use of language models"], start=1)
+    }
+    downloaded = []
+
+    def get_paper_with_text(paper, extraction_mode, max_pages, corpus):
+        downloaded.append(paper.citation_id)
+        return paper.copy(update={"text": "body"})
+
+    monkeypatch.setattr(paper_module, "fetch_google_scholar", lambda query, start, serpapi_api_key=None: [
+        {"link": f"https://arxiv.org/abs/{arxiv_id}"} for arxiv_id in papers
+    ])
+    monkeypatch.setattr(
+        paper_module.Paper,
+        "from_google_scholar_result",
+        lambda citation_id, item, **kwargs: papers[item["link"].split("/")[-1]],
+    )
+    monkeypatch.setattr(paper_module, "get_paper_with_text", get_paper_with_text)
+
+    result = paper_module.search_on_google_scholar("tool use", n=3, corpus=None, nb_full_text=2)
+
+    assert downloaded == [2, 3]
+    assert [p.text for p in result] == [None, "body", "body"]
+
+
+def test_bm25_index_returns_top_documents_with_query_terms():
+    index = BM25Index()
+
+    assert index.search("tools") == []
+    assert [index.add(t) for t in ["language models use tools", "graph networks", "tools tools tools"]] == [0, 1, 2]
+
+    hits = index.search("tools for models", k=4)
+
+    assert sorted(idx for idx, _ in hits) == [0, 2]
+    assert all(score > 0 for _, score in hits)
+    assert len(index.search("tools for models", k=1)) == 1
+    assert len(index) == 3
+
+
+def test_bm25_index_scores_match_bm25_scores():
+    texts = ["language models use tools", "graph networks", "tools tools tools", "language of tools"]
+    index = BM25Index()
+
+    for text in texts:
+        index.add(text)
+
+    expected = bm25_scores(tokenize("language tools"), [tokenize(t) for t in texts])
+
+    assert pytest.approx(dict(index.search("language tools", k=10))) == {
+        idx: score for idx, score in enumerate(expected) if score > 0
+    }
@@ -0,0 +1,40 @@
+import pytest
+
+from metaanalyser.chains.outline import Outlint, Section
+from metaanalyser.chains.overview import Overview
+from metaanalyser.chains.report import open_report_writer
+
+
+def write_report(writer, papers):
+    overview = Overview(title="Review", main_points=["point"], overview="Overview.")
+    outline = Outlint(
+        sections=[Section(title="Intro", children=None, description="intro", citation_ids=[1])],
+        citations_ids=[1],
+    )
+    writer.write_header(overview, outline)
+    writer.write_section("## Intro\n\nText [^2]", [2])
+    writer.write_references(papers)
+
+
+def test_report_is_kept_in_memory_without_path(make_paper):
+    with open_report_writer() as writer:
+        write_report(writer, [make_paper(1), make_paper(2)])
+        text = writer.getvalue()
+
+    assert text.startswith("# Review\n\nOverview.")
+    assert "[^1]: " in text and "[^2]: " in text
+
+
+def test_report_written_to_path_is_not_read_back(tmp_path, make_paper):
+    path = tmp_path / "review.md"
+
+    with open_report_writer(str(path)) as writer:
+        write_report(writer, [make_paper(1), make_paper(2)])
+
+        with pytest.raises(ValueError):
+            writer.getvalue()
+
+    text = path.read_text(encoding="utf-8")
+
+    assert text.startswith("# Review\n\nOverview.")
+    assert text.endswith(")")
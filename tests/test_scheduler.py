@@ -0,0 +1,78 @@
+import pytest
+import threading
+import time
+
+from metaanalyser.chains.scheduler import StageGraph
+
+
+def test_stages_receive_results_of_their_dependencies():
+    graph = StageGraph()
+    graph.add("papers", lambda: [1, 2, 3])
+    graph.add("overview", lambda papers: f"overview of {len(papers)}", ["papers"])
+    graph.add("outline", lambda papers, overview: (overview, sum(papers)), ["papers", "overview"])
+
+    assert graph.run() == {
+        "papers": [1, 2, 3],
+        "overview": "overview of 3",
+        "outline": ("overview of 3", 6),
+    }
+
+
+def test_independent_stages_run_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+    order = []
+
+    def independent(name):
+        def fn(papers):
+            # 二つの段階が同時に実行されていなければ timeout で BrokenBarrierError となる
+            barrier.wait()
+            order.append(name)
+            return name
+
+        return fn
+
+    graph = StageGraph()
+    graph.add("papers", lambda: order.append("papers"))
+    graph.add("overview", independent("overview"), ["papers"])
+    graph.add("paper_store", independent("paper_store"), ["papers"])
+    graph.add("text", lambda overview, paper_store: order.append("text"), ["overview", "paper_store"])
+
+    graph.run(nb_max_workers=2)
+
+    assert order[0] == "papers"
+    assert sorted(order[1:3]) == ["overview", "paper_store"]
+    assert order[3] == "text"
+
+
+def test_stages_must_be_added_after_their_dependencies():
+    graph = StageGraph().add("papers", lambda: None)
+
+    with pytest.raises(ValueError, match="unknown stage"):
+        graph.add("outline", lambda overview: None, ["overview"])
+
+    with pytest.raises(ValueError, match="already added"):
+        graph.add("papers", lambda: None)
+
+
+def test_failure_does_not_start_dependent_stages():
+    started = []
+
+    def fail(papers):
+        raise RuntimeError("failed")
+
+    def slow(papers):
+        time.sleep(0.1)
+        started.append("slow")
+
+    graph = StageGraph()
+    graph.add("papers", lambda: None)
+    graph.add("overview", fail, ["papers"])
+    graph.add("paper_store", slow, ["papers"])
+    graph.add("outline", lambda overview: started.append("outline"), ["overview"])
+    graph.add("text", lambda paper_store: started.append("text"), ["paper_store"])
+
+    with pytest.raises(RuntimeError, match="failed"):
+        graph.run(nb_max_workers=2)
+
+    # 実行中だった段階は終わるまで待つが、まだ始まっていない段階は実行しない
+    assert started == ["slow"]
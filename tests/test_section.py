@@ -0,0 +1,99 @@
+import re
+import threading
+import time
+
+from metaanalyser.chains.outline import Outlint, Section
+from metaanalyser.chains.overview.prompt import Overview
+from metaanalyser.chains.section.section import condense_snippets, get_input_list
+from metaanalyser.chains.sr import get_flatten_sections
+
+OUTLINE = Outlint(
+    sections=[
+        Section(title="Introduction", description="intro", citation_ids=[1]),
+        Section(title="Tool use", description="how models call tools", citation_ids=[1, 2]),
+    ],
+    citations_ids=[1, 2],
+)
+OVERVIEW = Overview(title="Review", main_points=["point"], overview="First. Second. Third.")
+
+
+def make_snippet(citation_id: int, nb_words: int = 30) -> str:
+    return f"\nTitle: Paper {citation_id}\ncitation_id: {citation_id}\nText: {' '.join(['word'] * nb_words)}\n"
+
+
+def condense(prompt: str) -> str:
+    snippets = prompt.split("-----")[1]
+    return "note " + " ".join(f"[{i}]" for i in re.findall(r"citation_id: (\d+)", snippets))
+
+
+def test_snippets_within_the_limit_are_not_condensed(make_llm):
+    llm = make_llm(condense)
+    section = get_flatten_sections(OUTLINE)[1]
+    snippets = [make_snippet(1), make_snippet(2)]
+
+    text = condense_snippets(llm, "query", "cs.CL", section, snippets, 100, nb_max_concurrency=4)
+
+    assert llm.prompts == []
+    assert text == "\n".join(snippets).strip()
+
+
+def test_snippet_groups_are_condensed_concurrently(make_llm):
+    lock = threading.Lock()
+    nb_running = {"current": 0, "max": 0}
+
+    def slow_condense(prompt: str) -> str:
+        with lock:
+            nb_running["current"] += 1
+            nb_running["max"] = max(nb_running["max"], nb_running["current"])
+
+        time.sleep(0.05)
+
+        with lock:
+            nb_running["current"] -= 1
+
+        return condense(prompt)
+
+    llm = make_llm(slow_condense)
+    section = get_flatten_sections(OUTLINE)[1]
+    # 1 件 37 語のスニペットを 100 語毎にまとめるので、2 件ずつ 5 つのまとまりになる
+    snippets = [make_snippet(i) for i in range(1, 11)]
+
+    text = condense_snippets(llm, "query", "cs.CL", section, snippets, 100, nb_max_concurrency=2)
+
+    assert len(llm.prompts) == 5
+    assert 1 < nb_running["max"] <= 2
+    # メモは元のスニペットの順に並ぶ
+    assert text.split("\n\n") == [f"note [{i}] [{i + 1}]" for i in range(1, 11, 2)]
+    assert all("Tool use" in p and "how models call tools" in p for p in llm.prompts)
+
+
+def test_condensed_notes_are_packed_within_the_limit(make_llm):
+    llm = make_llm(lambda prompt: " ".join(["note"] * 40))
+    section = get_flatten_sections(OUTLINE)[1]
+    snippets = [make_snippet(i) for i in range(1, 11)]
+
+    text = condense_snippets(llm, "query", "cs.CL", section, snippets, 100, nb_max_concurrency=4)
+
+    assert len(llm.prompts) == 5
+    assert llm.get_num_tokens(text) <= 100
+
+
+def test_map_reduce_section_is_written_from_notes(make_llm, make_paper):
+    llm = make_llm(condense)
+    papers = [make_paper(1), make_paper(2)]
+    evidence = [make_snippet(i % 2 + 1) for i in range(6)]
+
+    [inputs] = get_input_list(
+        llm, None, 1, "query", papers, OVERVIEW, OUTLINE, get_flatten_sections(OUTLINE),
+        nb_categories=3, nb_token_limit=100, mode="map_reduce", evidence=evidence,
+    )
+
+    assert inputs["section_title"] == "Tool use"
+    assert inputs["snippets"].split("\n\n") == ["note [1] [2]"] * 3
+
+    [inputs] = get_input_list(
+        llm, None, 1, "query", papers, OVERVIEW, OUTLINE, get_flatten_sections(OUTLINE),
+        nb_categories=3, nb_token_limit=100, evidence=evidence,
+    )
+
+    assert inputs["snippets"] == "\n".join(evidence).strip()
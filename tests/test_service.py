@@ -0,0 +1,56 @@
+from metaanalyser.memory import LRUCache
+from metaanalyser.worker import handlers
+
+
+def test_lru_cache_keeps_recently_used_items():
+    cache = LRUCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_run_review_reuses_llm_and_paper_stores(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-env")
+    created_llms = []
+    chains = []
+
+    class FakeChain:
+
+        def __init__(self, **kwargs):
+            self.kwargs = kwargs
+            self.output_path = kwargs.get("output_path")
+            chains.append(self)
+
+        def run(self, inputs):
+            return inputs["query"]
+
+    def create_chat_model(openai_api_key, **kwargs):
+        created_llms.append(openai_api_key)
+        return object()
+
+    monkeypatch.setattr(handlers, "SRChain", FakeChain)
+    monkeypatch.setattr(handlers, "create_chat_model", create_chat_model)
+    llm_cache = LRUCache()
+    paper_store_cache = LRUCache()
+
+    results = [
+        handlers.run_review(payload, llm_cache=llm_cache, paper_store_cache=paper_store_cache)
+        for payload in [
+            {"query": "a"},
+            {"query": "b", "output_path": "/tmp/b.md"},
+            {"query": "c", "openai_api_key": "sk-user"},
+        ]
+    ]
+
+    # output_path に書き出した場合は、レビューの本文ではなくパスを返す
+    assert results == [{"text": "a"}, {"output_path": "/tmp/b.md"}, {"text": "c"}]
+    assert created_llms == ["sk-env", "sk-user"]
+    assert chains[0].kwargs["llm"] is chains[1].kwargs["llm"]
+    assert all(c.kwargs["paper_store_cache"] is paper_store_cache for c in chains)
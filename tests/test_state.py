@@ -0,0 +1,148 @@
+import itertools
+import pytest
+
+from metaanalyser.chains import sr
+from metaanalyser.chains.outline import Outlint, Section
+from metaanalyser.chains.overview.prompt import Overview
+from metaanalyser.chains.state import (
+    ReviewState,
+    SectionState,
+    load_review_state,
+    merge_papers,
+    save_review_state,
+)
+from metaanalyser.paper import vectorstore
+from metaanalyser.paper.corpus import PaperChunks
+
+QUERY = "llm tool use"
+OUTLINE = Outlint(
+    sections=[
+        Section(title="Calculators", description="arithmetic with calculators", citation_ids=[1]),
+        Section(title="Search engines", description="retrieval with search engines", citation_ids=[2]),
+    ],
+    citations_ids=[1, 2],
+)
+OVERVIEW = Overview(title="Review", main_points=["point"], overview="Overview.")
+
+
+def make_state(papers, sections=None):
+    return ReviewState(
+        query=QUERY,
+        papers=papers,
+        overview=OVERVIEW,
+        outline=OUTLINE,
+        sections=sections or [],
+    )
+
+
+def test_sections_are_matched_by_position_and_title(make_paper):
+    state = make_state([make_paper(1)], [
+        SectionState(title="Calculators", fingerprint="a", markdown="## Calculators"),
+    ])
+
+    assert state.get_section(0, "Calculators").markdown == "## Calculators"
+    assert state.get_section(0, "Search engines") is None
+    assert state.get_section(1, "Calculators") is None
+
+
+def test_merged_papers_keep_their_citation_ids(make_paper):
+    previous = [
+        make_paper(1, "2301.00001", text="previous text"),
+        make_paper(2, "2301.00002"),
+        make_paper(3, "2301.00003"),
+    ]
+    papers = [
+        make_paper(1, "2301.00004"),
+        make_paper(2, "2301.00003", nb_cited=10),
+        make_paper(3, "2301.00001"),
+        make_paper(4, "2301.00005"),
+    ]
+
+    merged = merge_papers(previous, papers)
+
+    assert [(p.citation_id, p.arxiv_id) for p in merged] == [
+        (1, "2301.00001"),
+        (2, "2301.00002"),
+        (3, "2301.00003"),
+        (4, "2301.00004"),
+        (5, "2301.00005"),
+    ]
+    # 今回の検索結果で更新しつつ、本文を取得しなかった論文は前回の本文を引き継ぐ
+    assert merged[0].text == "previous text"
+    assert merged[2].nb_cited == 10
+
+
+def test_state_is_saved_and_loaded(tmp_path, make_paper):
+    path = str(tmp_path / "state" / "review.json")
+
+    assert load_review_state(path) is None
+
+    state = make_state([make_paper(1, text="text")], [
+        SectionState(title="Calculators", fingerprint="a", markdown="## Calculators"),
+    ])
+    save_review_state(path, state)
+
+    assert load_review_state(path) == state
+    assert [p.name for p in (tmp_path / "state").iterdir()] == ["review.json"]
+
+
+@pytest.fixture
+def review(monkeypatch, tmp_path, make_llm, make_embeddings):
+    """検索結果を search_results に入れて SRChain を実行し、書き直したセクションのプロンプトを返す
+    """
+    search_results = []
+    embeddings = make_embeddings()
+
+    monkeypatch.setattr(sr, "search_on_google_scholar", lambda *args, **kwargs: list(search_results))
+    monkeypatch.setattr(vectorstore, "get_embeddings", lambda openai_api_key=None: embeddings)
+    monkeypatch.setattr(
+        vectorstore,
+        "get_paper_splitter",
+        lambda *args: lambda p: PaperChunks(texts=[t.strip() for t in p.text.split("|")]),
+    )
+
+    state_path = str(tmp_path / "review.json")
+    counter = itertools.count(1)
+    llm = make_llm(lambda prompt: f"section {next(counter)}")
+
+    def run(papers):
+        search_results[:] = papers
+        llm.prompts.clear()
+        text = sr.SRChain(
+            llm=llm,
+            state_path=state_path,
+            retrieval_mode="lexical",
+            nb_max_concurrency=1,
+        ).run({"query": QUERY})
+
+        return text, llm.prompts
+
+    return state_path, run
+
+
+def test_only_sections_with_new_evidence_are_rewritten(review, make_paper):
+    state_path, run = review
+    papers = [
+        make_paper(1, text="calculators help arithmetic | models call calculators"),
+        make_paper(2, text="search engines retrieve documents | models call search engines"),
+    ]
+    save_review_state(state_path, make_state(papers))
+
+    # 前回のセクションがないので全て書く
+    text, prompts = run(papers)
+
+    assert len(prompts) == 2
+    assert "section 1" in text and "section 2" in text
+
+    text, prompts = run(papers)
+
+    assert prompts == []
+    assert "section 1" in text and "section 2" in text
+
+    # 検索エンジンに関するチャンクを持つ論文が見つかると、そのセクションのみ書き直す
+    text, prompts = run(papers + [make_paper(3, text="web search engines for question answering")])
+
+    assert len(prompts) == 1
+    assert "Search engines" in prompts[0]
+    assert "section 1" in text and "section 2" not in text and "section 3" in text
+    assert [p.citation_id for p in load_review_state(state_path).papers] == [1, 2, 3]
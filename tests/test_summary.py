@@ -0,0 +1,73 @@
+import re
+
+from metaanalyser.chains.summary import get_abstracts, summarize_abstracts
+from metaanalyser.chains.summary.summary import split_into_batches
+
+
+def get_citation_ids(prompt: str):
+    abstracts = prompt.split("-----")[1]
+    ids = re.findall(r"citation_id: (\d+)", abstracts)
+
+    for group in re.findall(r"citation_ids: (\d+(?:, \d+)*)", abstracts):
+        ids += group.split(", ")
+
+    return ids
+
+
+def summarize(prompt: str) -> str:
+    return f"citation_ids: {', '.join(get_citation_ids(prompt))}\nSummary: summary"
+
+
+def test_abstracts_are_reduced_until_they_fit(make_llm, make_paper):
+    llm = make_llm(summarize)
+    papers = [make_paper(i, summary=" ".join(["word"] * 40)) for i in range(1, 13)]
+
+    text = summarize_abstracts(
+        llm, "query", papers, nb_categories=3, nb_token_limit=20,
+        nb_batch_token_limit=100, nb_max_concurrency=4,
+    )
+
+    assert llm.get_num_tokens(text) <= 20
+    # 要約を重ねても全ての論文の citation_id が残る
+    assert sorted(map(int, get_citation_ids(f"-----{text}-----"))) == list(range(1, 13))
+    # 12 件の要約 (1 件 47 語程度) を 100 語毎にまとめるので、map だけで 6 回呼ばれる
+    assert len(llm.prompts) > 6
+
+
+def test_abstracts_within_the_limit_are_not_summarized(make_llm, make_paper):
+    llm = make_llm(summarize)
+    papers = [make_paper(i, summary="short summary") for i in range(1, 4)]
+
+    text = summarize_abstracts(llm, "query", papers, nb_categories=3, nb_token_limit=1_000)
+
+    assert llm.prompts == []
+    assert [f"citation_id: {i}" in text for i in range(1, 4)] == [True] * 3
+
+
+def test_summaries_are_dropped_after_max_depth(make_llm, make_paper):
+    # 要約しても短くならない LLM
+    llm = make_llm(lambda prompt: prompt.split("-----")[1])
+    papers = [make_paper(i, summary=" ".join(["word"] * 40)) for i in range(1, 5)]
+
+    text = summarize_abstracts(
+        llm, "query", papers, nb_categories=3, nb_token_limit=100,
+        nb_batch_token_limit=50, nb_max_depth=2,
+    )
+
+    assert 0 < llm.get_num_tokens(text) <= 100
+
+
+def test_stuff_mode_does_not_call_llm(make_llm, make_paper):
+    llm = make_llm(summarize)
+    papers = [make_paper(i, summary=" ".join(["word"] * 40)) for i in range(1, 5)]
+
+    text = get_abstracts(llm, "query", papers, nb_categories=3, nb_token_limit=100)
+
+    assert llm.prompts == []
+    assert 0 < llm.get_num_tokens(text) <= 100
+
+
+def test_split_into_batches():
+    assert split_into_batches(["a", "b", "c", "d"], [3, 3, 5, 1], 6) == [["a", "b"], ["c", "d"]]
+    # 一つで上限を超えるテキストも一つのバッチにする
+    assert split_into_batches(["a", "b"], [10, 1], 6) == [["a"], ["b"]]
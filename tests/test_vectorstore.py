@@ -0,0 +1,182 @@
+import numpy as np
+import pytest
+from langchain.vectorstores import FAISS
+
+from metaanalyser.paper import vectorstore
+from metaanalyser.paper.corpus import PaperChunks, PaperCorpus
+from metaanalyser.paper.vectorstore import (
+    RRF_K,
+    PaperVectorStore,
+    create_papers_vectorstor,
+    get_paper_store_metadata,
+    normalize_scores,
+    reciprocal_rank_fusion,
+    similarity_search_with_vectors,
+)
+
+
+@pytest.fixture
+def embeddings(monkeypatch, make_embeddings):
+    embeddings = make_embeddings()
+    monkeypatch.setattr(vectorstore, "get_embeddings", lambda openai_api_key=None: embeddings)
+    # spaCy を読み込まずに、本文を "|" で区切ったものをチャンクとする
+    monkeypatch.setattr(
+        vectorstore,
+        "get_paper_splitter",
+        lambda *args: lambda p: PaperChunks(texts=[t.strip() for t in p.text.split("|")]),
+    )
+
+    return embeddings
+
+
+@pytest.fixture
+def papers(make_paper):
+    return [
+        make_paper(1, text="language models call search tools | models learn to use calculators"),
+        make_paper(2, text="pitman yor processes model word frequencies | hierarchical priors for smoothing"),
+    ]
+
+
+def test_paper_metadata_is_kept_once_per_paper(tmp_path, embeddings, papers):
+    db = create_papers_vectorstor(papers, corpus=PaperCorpus(str(tmp_path)))
+
+    assert db.papers == {p.arxiv_id: get_paper_store_metadata(p) for p in papers}
+
+    docs = [db.docstore.search(db.index_to_docstore_id[idx]) for idx in range(4)]
+
+    assert [d.metadata for d in docs] == [
+        {"paper_key": papers[0].arxiv_id, "offset": 0},
+        {"paper_key": papers[0].arxiv_id, "offset": 1},
+        {"paper_key": papers[1].arxiv_id, "offset": 0},
+        {"paper_key": papers[1].arxiv_id, "offset": 1},
+    ]
+    assert [db.get_paper_metadata(d)["citation_id"] for d in docs] == [1, 1, 2, 2]
+    assert db.get_paper_metadata(docs[0])["citiation"] == papers[0].mla_citiation.snippet
+
+
+def test_embeddings_are_reused_from_the_corpus(tmp_path, embeddings, papers):
+    corpus = PaperCorpus(str(tmp_path))
+    create_papers_vectorstor(papers[:1], corpus=corpus)
+    embeddings.texts = []
+
+    db = create_papers_vectorstor(papers, corpus=corpus)
+
+    assert embeddings.texts == [
+        "pitman yor processes model word frequencies",
+        "hierarchical priors for smoothing",
+    ]
+    assert len(db.index_to_docstore_id) == db.index.ntotal == 4
+
+
+def test_near_duplicate_chunks_are_not_embedded(tmp_path, embeddings, make_paper):
+    text = "large language models can teach themselves to use external tools via simple apis"
+    papers = [make_paper(1, text=text), make_paper(2, text=f"{text} | another chunk of the second paper")]
+
+    db = create_papers_vectorstor(papers, corpus=None)
+
+    assert embeddings.texts == [text, "another chunk of the second paper"]
+    assert set(db.papers) == {p.arxiv_id for p in papers}
+
+    db = create_papers_vectorstor(papers, corpus=None, deduplicate=False)
+
+    assert db.index.ntotal == 3
+
+
+def test_paper_metadata_is_saved_with_the_store(tmp_path, embeddings, papers):
+    db = create_papers_vectorstor(papers, corpus=None)
+    db.save_local(str(tmp_path / "store"))
+
+    loaded = PaperVectorStore.load_local(str(tmp_path / "store"), embeddings)
+
+    assert loaded.papers == db.papers
+    assert len(loaded.get_lexical_index()) == 4
+
+
+def test_chunk_metadata_of_old_stores_is_used_as_is(embeddings, papers):
+    db = create_papers_vectorstor(papers, corpus=None)
+    doc = db.docstore.search(db.index_to_docstore_id[0])
+    doc.metadata = {"title": "old", "citation_id": 3}
+
+    assert db.get_paper_metadata(doc) == {"title": "old", "citation_id": 3}
+
+
+def assert_in_sync(db):
+    assert len(db.lexical_index) == len(db.index_to_docstore_id) == db.index.ntotal
+
+    for idx in range(db.index.ntotal):
+        text = db.docstore.search(db.index_to_docstore_id[idx]).page_content
+
+        assert db.lexical_index.search(text, k=1)[0][0] == idx
+
+
+def test_lexical_index_follows_added_chunks(embeddings, papers, make_paper):
+    db = create_papers_vectorstor(papers, corpus=None)
+    assert_in_sync(db)
+
+    db.add_texts(["transformers attend to tokens"], [{"paper_key": papers[0].arxiv_id, "offset": 2}])
+    assert_in_sync(db)
+
+    db.add_embeddings([("retrieval augments generation", embeddings.embed_query("retrieval augments generation"))])
+    assert_in_sync(db)
+
+    other = create_papers_vectorstor([make_paper(3, text="reinforcement learning from feedback")], corpus=None)
+    db.merge_from(other)
+    assert_in_sync(db)
+
+    assert db.index.ntotal == 7
+    assert db.get_paper_metadata(db.docstore.search(db.index_to_docstore_id[6]))["citation_id"] == 3
+
+
+def test_lexical_index_is_rebuilt_when_out_of_sync(embeddings, papers):
+    db = create_papers_vectorstor(papers, corpus=None)
+    db.lexical_index = None
+
+    assert len(db.get_lexical_index()) == 4
+    assert_in_sync(db)
+
+    # FAISS の add_texts を直接呼ぶなどして BM25 のインデックスとずれた場合も作り直す
+    FAISS.add_texts(db, ["transformers attend to tokens"])
+
+    assert len(db.get_lexical_index()) == 5
+    assert_in_sync(db)
+
+
+def test_lexical_search_does_not_embed_the_query(embeddings, papers):
+    db = create_papers_vectorstor(papers, corpus=None)
+    embeddings.texts = []
+
+    hits = similarity_search_with_vectors(db, "calculators", k=4, retrieval_mode="lexical")
+
+    assert embeddings.texts == []
+    assert [(doc.page_content, relevance) for doc, relevance, _ in hits] == [
+        ("models learn to use calculators", 1.0),
+    ]
+    # flat のインデックスからは埋め込みを復元できる
+    assert np.allclose(hits[0][2], embeddings.embed_query("models learn to use calculators"))
+
+
+def test_hybrid_search_fuses_vector_and_lexical_rankings(embeddings, papers):
+    db = create_papers_vectorstor(papers, corpus=None)
+
+    vector_hits = similarity_search_with_vectors(db, "language models call search tools", k=4)
+
+    assert vector_hits[0][0].page_content == "language models call search tools"
+    assert vector_hits[0][1] == pytest.approx(1.0)
+
+    hybrid_hits = similarity_search_with_vectors(db, "hierarchical smoothing", k=2, retrieval_mode="hybrid")
+
+    assert hybrid_hits[0][0].page_content == "hierarchical priors for smoothing"
+    assert hybrid_hits[0][1] == 1.0
+    assert len(hybrid_hits) == 2
+
+    with pytest.raises(ValueError):
+        similarity_search_with_vectors(db, "query", retrieval_mode="unknown")
+
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion([[(0, 0.9), (1, 0.8), (2, 0.1)], [(1, 3.0), (3, 2.0)]])
+
+    assert [idx for idx, _ in fused] == [1, 0, 3, 2]
+    assert fused[0][1] == pytest.approx(1 / (RRF_K + 2) + 1 / (RRF_K + 1))
+    assert normalize_scores([(1, 2.0), (0, 1.0)]) == [(1, 1.0), (0, 0.5)]
+    assert normalize_scores([]) == []
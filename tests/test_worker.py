@@ -0,0 +1,98 @@
+import time
+import pytest
+
+from metaanalyser.worker import JobQueue, LeaseLost, Worker
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / "queue.sqlite3"), retry_delay=0.0)
+
+
+def test_a_job_is_leased_by_one_worker_at_a_time(queue):
+    job_id = queue.enqueue("review", {"query": "a"})
+
+    job = queue.lease("worker-1")
+
+    assert job.id == job_id and job.status == "running" and job.attempts == 1
+    assert queue.lease("worker-2") is None
+
+    with pytest.raises(LeaseLost):
+        queue.heartbeat(job_id, "worker-2")
+
+    with pytest.raises(LeaseLost):
+        queue.complete(job_id, "worker-2", {"text": "b"})
+
+
+def test_an_expired_lease_is_taken_over(queue):
+    job_id = queue.enqueue("review", {"query": "a"})
+    queue.lease("worker-1", lease_seconds=0.05)
+    time.sleep(0.1)
+
+    job = queue.lease("worker-2")
+
+    assert job.id == job_id and job.lease_owner == "worker-2" and job.attempts == 2
+
+    with pytest.raises(LeaseLost):
+        queue.complete(job_id, "worker-1", {"text": "late"})
+
+    queue.complete(job_id, "worker-2", {"text": "b"})
+
+    assert queue.get(job_id).result == {"text": "b"}
+
+
+def test_complete_is_refused_after_the_lease_expired(queue):
+    job_id = queue.enqueue("review", {"query": "a"})
+    queue.lease("worker-1", lease_seconds=0.05)
+    time.sleep(0.1)
+
+    with pytest.raises(LeaseLost):
+        queue.complete(job_id, "worker-1", {"text": "late"})
+
+    assert queue.get(job_id).result is None
+
+
+def test_failed_jobs_are_retried_until_max_attempts(queue):
+    job_id = queue.enqueue("review", {"query": "a"}, max_attempts=2)
+
+    assert queue.fail(queue.lease("worker-1").id, "worker-1", "error").status == "queued"
+    assert queue.fail(queue.lease("worker-1").id, "worker-1", "error").status == "failed"
+    assert queue.lease("worker-1") is None
+    assert queue.counts()["failed"] == 1
+    assert queue.get(job_id).error == "error"
+
+
+def test_handler_is_cancelled_when_the_lease_is_lost(queue):
+    job_id = queue.enqueue("review", {"query": "a"})
+    cancelled = []
+
+    def handler(payload, cancellation_token=None):
+        # 他のワーカーがリースを取り直したことにする
+        with queue._transaction() as conn:
+            conn.execute("UPDATE jobs SET lease_owner = 'worker-2' WHERE id = ?", (job_id,))
+
+        deadline = time.time() + 5
+
+        while not cancellation_token.is_cancelled and time.time() < deadline:
+            time.sleep(0.01)
+
+        cancelled.append(cancellation_token.is_cancelled)
+
+        return {"text": "stale"}
+
+    worker = Worker(queue, {"review": handler}, worker_id="worker-1", lease_seconds=0.3)
+    worker.run(max_jobs=1)
+
+    job = queue.get(job_id)
+
+    assert cancelled == [True]
+    assert job.status == "running" and job.lease_owner == "worker-2" and job.result is None
+
+
+def test_worker_completes_jobs(queue):
+    job_id = queue.enqueue("review", {"query": "a"})
+    worker = Worker(queue, {"review": lambda payload, cancellation_token=None: {"text": payload["query"]}})
+
+    assert worker.run(stop_when_empty=True) == 1
+    assert queue.get(job_id).status == "done"
+    assert queue.get(job_id).result == {"text": "a"}